@@ -1,6 +1,11 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Blueprint, Response, current_app, jsonify, request, g, stream_with_context
+import click
+import hashlib
+import json
+import queue
 import requests
 import os
+import uuid
 from datetime import datetime, timezone, timedelta, date as date_cls
 from copy import deepcopy
 
@@ -11,11 +16,15 @@ from utils.caromil import (
     get_meal_with_basis,
     get_user_info,              # 目標取得
     save_intake_breakdown,      # ★ 合計＋内訳を安全保存（期間一括対応）
+    calomeal_limiter,
+    INTAKE_RANGE_ENDPOINT,
+    METRICS_RANGE_ENDPOINT,
 )
 from utils.db import (
     save_request,
     update_request_with_advice,
     init_db,
+    get_engine,
     SessionLocal,
     Request,
     ensure_user_profile,
@@ -23,12 +32,61 @@ from utils.db import (
     get_user_profile_one,
     get_user_weights,
     get_user_intake,
+    iter_user_weights,          # ?stream=1 用（サーバーサイドカーソル）
+    iter_user_intake,
+    iter_goals_range,
+    get_users_weights_batch,    # 複数ユーザー一括（ANY）
+    get_users_intake_batch,
+    get_user_timeline,          # 体重・栄養・目標の日次結合
+    get_user_rollups,           # 週次・月次ロールアップ
+    ROLLUP_PERIOD_TYPES,
     upsert_metrics_daily,       # 体重/体脂肪の日次UPSERT
-    upsert_goals_daily_bulk,
+    new_upsert_counts,          # {"inserted","updated","unchanged"} の集計用
+    set_goal_interval,          # 目標を有効期間として保存
     fetch_goals_range,
     set_user_goals_json,
     list_paid_users,            # 互換：簡易ラッパ
     search_paid_users,          # ★ 厳密版（expires_at / days_30 / last_intake_date など）
+    USERS_CURSOR_KEYS,
+    USERS_SEARCH_CURSOR_KEYS,
+    PAID_USERS_CURSOR_KEYS,
+    PAID_USERS_SEARCH_CURSOR_KEYS,
+    summarize_llm_usage,        # LLM使用量の集計
+    find_data_gaps,             # 欠損区間（SQL）
+    list_sync_runs,             # バッチ実行履歴
+    DATA_GAP_KINDS,
+    get_range_version,          # 条件付きGET用の (件数, 最終更新)
+    notify_request_event,       # requests 変更の pg_notify
+    enqueue_line_push,          # LINE アウトボックスへ積む（呼び出し元のトランザクション内）
+    enqueue_line_multicast,
+    notify_request_events,
+    line_outbox_stats,
+)
+from utils.pagination import InvalidCursor, decode_cursor, next_cursor
+from utils.range_planner import planner
+from utils.rate_limit import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RateLimitTimeout, set_priority, reset_priority
+from utils.circuit_breaker import CircuitOpenError, breakers_snapshot
+from utils.response_utils import (
+    install_json_provider,
+    gzip_response,
+    payload_response,
+    response_variant,
+    shape_rows,
+    shape_grouped,
+    stream_rows_response,
+    wants_stream,
+)
+from utils.logging_utils import (
+    configure_logging,
+    set_request_id,
+    reset_request_id,
+    should_dump,
+)
+from utils.llm_usage import (
+    begin_usage_context,
+    end_usage_context,
+    update_usage_context,
+    writer_stats,
 )
 
 from utils.gpt_utils import (
@@ -39,17 +97,19 @@ from utils.gpt_utils import (
     generate_other_reply
 )
 from utils.formatting import format_daily_report
+from services.gap_fill import fill_gaps
+from services.scheduler import scheduler, last_closed_day
+from services.incremental_sync import SYNC_WINDOW_DAYS, sync_user_incremental
+from services.line_dispatcher import dispatcher as line_dispatcher
 from utils.line import (
-    send_line_message,
-    LineSendError,
+    LINE_MULTICAST_MAX_TO,
+    text_messages,
     get_line_profile,
     LineProfileError,
 )
 
-# ✅ DB初期化
-init_db()
-
-app = Flask(__name__)
+# ✅ ルートは Blueprint に定義し、create_app() で登録する（import 時に DB へ接続しない）
+bp = Blueprint("main", __name__)
 
 # ---------------------------
 # 管理API 用の簡易認証
@@ -62,7 +122,45 @@ def _require_admin():
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
     return None
 
-@app.route("/")
+# ---------------------------
+# リクエスト単位のコンテキスト（ログ相関ID・LLM使用量台帳・Calomeal 呼び出しの優先度）
+# ---------------------------
+# 大量に Calomeal を叩く管理APIは batch（それ以外の Webhook / 画面からの呼び出しは interactive で先に通す）
+_BATCH_ENDPOINTS = {
+    "main.backfill_daily",
+    "main.backfill_intake_missing",
+    "main.api_fill_gaps",
+    "main.api_sync_incremental",
+}
+
+@bp.before_app_request
+def _open_request_context():
+    g.request_id = (request.headers.get("X-Request-Id") or "").strip()[:64] or uuid.uuid4().hex
+    g._log_rid_token = set_request_id(g.request_id)
+    g._usage_ctx_token = begin_usage_context()
+    g._prio_token = set_priority(PRIORITY_BATCH if request.endpoint in _BATCH_ENDPOINTS else PRIORITY_INTERACTIVE)
+
+@bp.after_app_request
+def _finalize_response(resp):
+    """X-Request-Id を付け、大きな JSON / MessagePack は gzip 圧縮する"""
+    rid = g.get("request_id")
+    if rid:
+        resp.headers["X-Request-Id"] = rid
+    return gzip_response(resp)
+
+@bp.teardown_app_request
+def _close_request_context(exc):
+    token = g.pop("_usage_ctx_token", None)
+    if token is not None:
+        end_usage_context(token)
+    token = g.pop("_log_rid_token", None)
+    if token is not None:
+        reset_request_id(token)
+    token = g.pop("_prio_token", None)
+    if token is not None:
+        reset_priority(token)
+
+@bp.route("/")
 def index():
     return "Flask app is running!"
 
@@ -182,7 +280,7 @@ def _extract_nutrition_for_day(meal_data, yyyy_mm_dd: str):
 # ---------------------------
 # 検証用エンドポイント
 # ---------------------------
-@app.route("/test-caromil", methods=["POST"])
+@bp.route("/test-caromil", methods=["POST"])
 def test_caromil():
     try:
         data = request.get_json(force=True)
@@ -204,10 +302,10 @@ def test_caromil():
         )
         return jsonify({"status": "ok", "result": result})
     except Exception as e:
-        print("❌ Error in /test-caromil:", str(e))
+        current_app.logger.exception("/test-caromil failed")
         return jsonify({"status": "error", "message": str(e)}), 400
 
-@app.route("/test-userinfo", methods=["POST"])
+@bp.route("/test-userinfo", methods=["POST"])
 def test_userinfo():
     try:
         data = request.get_json(force=True)
@@ -237,7 +335,7 @@ def test_userinfo():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
-@app.route("/test-meal-basis", methods=["POST"])
+@bp.route("/test-meal-basis", methods=["POST"])
 def test_meal_basis():
     try:
         data = request.get_json(force=True)
@@ -253,10 +351,10 @@ def test_meal_basis():
         result = get_meal_with_basis(user_id, start_date, end_date)
         return jsonify({"status": "ok", "result": result})
     except Exception as e:
-        print("❌ Error in /test-meal-basis:", e)
+        current_app.logger.exception("/test-meal-basis failed")
         return jsonify({"status": "error", "message": str(e)}), 400
 
-@app.route("/callback")
+@bp.route("/callback")
 def callback():
     code = request.args.get("code")
     state = request.args.get("state")
@@ -273,11 +371,12 @@ def callback():
 # ---------------------------
 # LINE Webhook 受信
 # ---------------------------
-@app.route("/receive-request", methods=["POST"])
+@bp.route("/receive-request", methods=["POST"])
 def receive_request():
     try:
         data = request.get_json(force=True)
-        print("🔍 受信データ:", data)
+        if should_dump(current_app.logger):
+            current_app.logger.debug("webhook body", extra={"body": data})
 
         event = data.get("events", [{}])[0]
         event_type = event.get("type")
@@ -303,6 +402,7 @@ def receive_request():
         ts_ms = event.get("timestamp") or int(datetime.now().timestamp() * 1000)
         timestamp_str = datetime.fromtimestamp(ts_ms / 1000).isoformat()
         user_id = event.get("source", {}).get("userId")
+        update_usage_context(user_id=user_id)
 
         # ✅ プロフィール同期
         if user_id:
@@ -313,9 +413,9 @@ def receive_request():
                 display_name = prof.get("displayName") or ""
                 photo_url = prof.get("pictureUrl") or None
             except LineProfileError as e:
-                app.logger.warning(f"[profile-sync] {user_id}: {e}")
+                current_app.logger.warning(f"[profile-sync] {user_id}: {e}")
             except Exception as e:
-                app.logger.exception(f"[profile-sync] unexpected error: {e}")
+                current_app.logger.exception(f"[profile-sync] unexpected error: {e}")
 
             last_contact_dt = datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc)
             ensure_user_profile(
@@ -329,38 +429,53 @@ def receive_request():
 
         request_id = save_request({
             "message": message_text,
-            "timestamp": timestamp_str,
+            "timestamp": datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc),  # timestamptz で保存
             "user_id": user_id,
             "request_type": request_type,
             "status": "pending",
         })
+        update_usage_context(request_id=request_id)
+        current_app.logger.info(
+            "webhook request saved",
+            extra={"user_id": user_id, "request_db_id": request_id, "request_type": request_type},
+        )
 
+        # Calomeal / OpenAI が落ちている間はアドバイスを作らず pending のまま残す（管理画面から後で生成・返信できる）
         advice_text = None
-        if request_type == "meal_feedback":
-            meal_data = get_meal_with_basis(user_id, timestamp_str[:10], timestamp_str[:10])
-            body_data = get_anthropometric_data(
-                user_id,
-                start_date=timestamp_str[:10],
-                end_date=timestamp_str[:10]
-            )
-            advice_text = generate_meal_advice(
-                meal_data=meal_data,
-                body_data=body_data,
-                date_str=timestamp_str[:10],
-            )
-        elif request_type == "workout_question":
-            advice_text = generate_workout_advice(message_text)
-        elif request_type == "system_question":
-            advice_text = generate_operation_advice(message_text)
-        else:
-            advice_text = generate_other_reply(message_text)
+        degraded = []   # 障害中で省略した処理（Webhook 自体は 200 で返す）
+        try:
+            if request_type == "meal_feedback":
+                meal_data = get_meal_with_basis(user_id, timestamp_str[:10], timestamp_str[:10])
+                body_data = get_anthropometric_data(
+                    user_id,
+                    start_date=timestamp_str[:10],
+                    end_date=timestamp_str[:10]
+                )
+                advice_text = generate_meal_advice(
+                    meal_data=meal_data,
+                    body_data=body_data,
+                    date_str=timestamp_str[:10],
+                )
+            elif request_type == "workout_question":
+                advice_text = generate_workout_advice(message_text)
+            elif request_type == "system_question":
+                advice_text = generate_operation_advice(message_text)
+            else:
+                advice_text = generate_other_reply(message_text)
+        except CircuitOpenError as e:
+            current_app.logger.warning(f"[receive-request] {e.upstream} unavailable, skip advice: {e}")
+            degraded.append(e.upstream)
+        except RateLimitTimeout as e:
+            current_app.logger.warning(f"[receive-request] calomeal rate limited, skip advice: {e}")
+            degraded.append("calomeal")
 
         if advice_text:
-            print("🔍 生成されたアドバイス内容:", advice_text)
+            if should_dump(current_app.logger):
+                current_app.logger.debug("generated advice", extra={"advice": advice_text})
             update_request_with_advice(request_id, advice_text, status="pending")
 
         # ---- 当日分のUPSERT：体組成＋（合計＋内訳） ----
-        if user_id:
+        if user_id and "calomeal" not in degraded:
             day = timestamp_str[:10]  # 'YYYY-MM-DD'
             try:
                 body_data = get_anthropometric_data(user_id, start_date=day, end_date=day)
@@ -384,33 +499,58 @@ def receive_request():
 
                 # ★ 栄養は save_intake_breakdown で当日分を一括保存（合計＋内訳）
                 stat = save_intake_breakdown(user_id, day, day)
-                app.logger.info(f"[receive-request] save_intake_breakdown({user_id}, {day}) -> {stat}")
+                current_app.logger.info(f"[receive-request] save_intake_breakdown({user_id}, {day}) -> {stat}")
 
+            except (CircuitOpenError, RateLimitTimeout) as e:
+                current_app.logger.warning(f"[daily-upsert] {user_id} {day}: skipped ({e})")
+                degraded.append("calomeal")
             except Exception as e:
-                app.logger.warning(f"[daily-upsert] {user_id} {day}: {e}")
+                current_app.logger.warning(f"[daily-upsert] {user_id} {day}: {e}")
         # ---- ここまで ----
 
+        if degraded:
+            return jsonify({
+                "status": "degraded",
+                "message": f"Request saved; skipped steps while upstream unavailable (type: {request_type})",
+                "degraded": sorted(set(degraded)),
+            }), 200
         return jsonify({
             "status": "success",
             "message": f"Request saved and advice generated (type: {request_type})"
         }), 200
 
     except Exception as e:
-        print("❌ Error in /receive-request:", str(e))
+        current_app.logger.exception("/receive-request failed")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 # ---------------------------
 # Streamlit用：未返信取得（JOINで名前同梱）
 # ---------------------------
-@app.route("/get-unreplied", methods=["GET"])
+@bp.route("/get-unreplied", methods=["GET"])
 def get_unreplied():
     auth = _require_admin()
     if auth:
         return auth
 
+    # ?days=N で直近N日に限定（対象の月次パーティションだけを走査）
+    try:
+        days = int(request.args.get("days", 0))
+    except Exception:
+        days = 0
+    # ?limit=（既定20・最大200） / ?cursor= で続きを取得（timestamp desc, id desc のキーセット）
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 200))
+    except Exception:
+        limit = 20
+    try:
+        after = decode_cursor(request.args.get("cursor"), ("timestamp", "id"),
+                              types={"timestamp": datetime.fromisoformat, "id": int})
+    except InvalidCursor:
+        return jsonify({"status": "error", "message": "invalid cursor"}), 400
+
     session = SessionLocal()
     try:
-        sql = text("""
+        sql = text(f"""
             SELECT
                 r.id,
                 r.user_id,
@@ -422,10 +562,16 @@ def get_unreplied():
             FROM requests r
             LEFT JOIN user_profile u ON u.user_id = r.user_id
             WHERE r.status = :status
-            ORDER BY r.timestamp DESC
-            LIMIT 20
+            {"AND r.timestamp >= now() - make_interval(days => :days)" if days > 0 else ""}
+            {"AND (r.timestamp, r.id) < (:after_ts, :after_id)" if after else ""}
+            ORDER BY r.timestamp DESC, r.id DESC
+            LIMIT :limit
         """)
-        rows = session.execute(sql, {"status": "pending"}).fetchall()
+        params = {"status": "pending", "days": days, "limit": limit}
+        if after:
+            params["after_ts"] = after["timestamp"]
+            params["after_id"] = after["id"]
+        rows = session.execute(sql, params).fetchall()
 
         data = []
         for row in rows:
@@ -444,17 +590,53 @@ def get_unreplied():
                 "advice_text": advice,
             })
 
-        return jsonify({"status": "ok", "data": data})
+        return jsonify({"status": "ok", "data": data, "next_cursor": next_cursor(data, limit, ("timestamp", "id"))})
     except Exception as e:
-        print("❌ Error in /get-unreplied:", e)
+        current_app.logger.exception("/get-unreplied failed")
         return jsonify({"status": "error", "message": str(e)}), 500
     finally:
         session.close()
 
+# ---------------------------
+# ★ 未返信リクエストのリアルタイム配信（SSE）
+#   初回は /get-unreplied で取得し、以降はここで差分（created / updated / status）を受け取る。
+#   長時間接続になるため gunicorn は gthread / gevent ワーカーで動かすこと。
+# ---------------------------
+SSE_KEEPALIVE_SEC = 15
+
+@bp.route("/events/requests", methods=["GET"])
+def request_events():
+    auth = _require_admin()
+    if auth:
+        return auth
+
+    from utils.pg_events import hub  # LISTEN スレッドは最初の購読時に起動
+
+    sub = hub.subscribe()
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    msg = sub.get(timeout=SSE_KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                data = json.dumps(msg, ensure_ascii=False, default=str)
+                yield f"event: {msg.get('event') or 'message'}\ndata: {data}\n\n"
+        finally:
+            hub.unsubscribe(sub)
+
+    resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # プロキシのバッファリング無効化
+    return resp
+
 # ---------------------------
 # ★ 新規：整形レポート取得（MVP 1）
 # ---------------------------
-@app.route("/debug-formatted", methods=["GET"])
+@bp.route("/debug-formatted", methods=["GET"])
 def debug_formatted():
     auth = _require_admin()
     if auth:
@@ -470,13 +652,23 @@ def debug_formatted():
         text = format_daily_report(meal, body, date)
         return jsonify({"status": "ok", "text": text})
     except Exception as e:
-        print("❌ Error in /debug-formatted:", e)
+        current_app.logger.exception("/debug-formatted failed")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def _line_queued_response(body: dict):
+    """
+    アウトボックスに積んだ後の応答。このプロセスのディスパッチャが動いていればすぐ送るので ok、
+    動いていなければ（LINE_OUTBOX_ENABLED=0 等）まだ誰も送っていないので 202 queued を返す。
+    """
+    if line_dispatcher.running:
+        line_dispatcher.wake()
+        return jsonify({"status": "ok", **body})
+    return jsonify({"status": "queued", **body}), 202
+
 # ---------------------------
 # ★ 新規：返信送信（MVP 2）
 # ---------------------------
-@app.route("/send-reply", methods=["POST"])
+@bp.route("/send-reply", methods=["POST"])
 def send_reply():
     auth = _require_admin()
     if auth:
@@ -494,21 +686,19 @@ def send_reply():
         r = session.query(Request).filter(Request.id == request_id).first()
         if not r:
             return jsonify({"status": "error", "message": f"Request {request_id} が見つかりません"}), 404
+        if not r.user_id:
+            return jsonify({"status": "error", "message": "user_id が空のため送信できません"}), 400
 
-        try:
-            send_line_message(r.user_id, message_text)
-        except LineSendError as e:
-            print("❌ LINE送信エラー:", e)
-            return jsonify({"status": "error", "message": f"LINE送信失敗: {e}"}), 502
-
+        # 送信はアウトボックス経由（状態変更と同じトランザクションで積み、ディスパッチャが送る）
+        outbox_id = enqueue_line_push(session, r.user_id, text_messages(message_text), request_id=r.id)
         r.status = "replied"
         r.advice_text = message_text
+        notify_request_event(session, r.id, "status", status="replied", user_id=r.user_id)
         session.commit()
-
-        return jsonify({"status": "ok"})
+        return _line_queued_response({"outbox_id": outbox_id})
     except Exception as e:
         session.rollback()
-        print("❌ Error in /send-reply:", e)
+        current_app.logger.exception("/send-reply failed")
         return jsonify({"status": "error", "message": str(e)}), 500
     finally:
         session.close()
@@ -516,7 +706,7 @@ def send_reply():
 # ---------------------------
 # ★ 新規：サマリー＋アドバイス一括送信
 # ---------------------------
-@app.route("/send-summary-and-advice", methods=["POST"])
+@bp.route("/send-summary-and-advice", methods=["POST"])
 def send_summary_and_advice():
     auth = _require_admin()
     if auth:
@@ -547,20 +737,113 @@ def send_summary_and_advice():
             f"{advice_text if advice_text else '（未作成）'}"
         )
 
-        try:
-            send_line_message(r.user_id, message_text)
-        except LineSendError as e:
-            print("❌ LINE送信エラー:", e)
-            return jsonify({"status": "error", "message": f"LINE送信失敗: {e}"}), 502
-
+        # 送信はアウトボックス経由（状態変更と同じトランザクションで積み、ディスパッチャが送る）
+        outbox_id = enqueue_line_push(session, r.user_id, text_messages(message_text), request_id=r.id)
         r.status = "replied"
         r.advice_text = message_text
+        notify_request_event(session, r.id, "status", status="replied", user_id=r.user_id)
+        session.commit()
+        return _line_queued_response({"outbox_id": outbox_id})
+    except Exception as e:
+        session.rollback()
+        current_app.logger.exception("/send-summary-and-advice failed")
+        return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        session.close()
+
+# ---------------------------
+# ★ 一括送信（同じ本文は LINE multicast にまとめる）
+#   POST /send-bulk
+#   {"items": [{"request_id": 1, "message": "..."}, {"user_id": "U...", "message": "..."}]}
+#   または共通本文: {"message": "...", "request_ids": [...], "user_ids": [...]}
+#   - 本文ごとに宛先をまとめ、500人ずつ multicast（1人だけなら push）。長文は 5000字×最大5通に分割
+#   - request_id 指定分は replied に更新。更新とアウトボックス投入は1トランザクション
+#   - 送信はディスパッチャが非同期で行うので 202 {"status": "queued", "outbox_ids": [...]} を返す
+# ---------------------------
+BULK_SEND_MAX_ITEMS = 5000
+
+@bp.post("/send-bulk")
+def send_bulk():
+    auth = _require_admin()
+    if auth:
+        return auth
+
+    session = SessionLocal()
+    try:
+        payload = request.get_json(force=True) or {}
+        items = list(payload.get("items") or [])
+        common = payload.get("message")
+        if common:
+            items += [{"request_id": rid, "message": common} for rid in payload.get("request_ids") or []]
+            items += [{"user_id": uid, "message": common} for uid in payload.get("user_ids") or []]
+        if not items:
+            return jsonify({"status": "error", "message": "items（または message と request_ids / user_ids）は必須です"}), 400
+        if len(items) > BULK_SEND_MAX_ITEMS:
+            return jsonify({"status": "error", "message": f"items は最大 {BULK_SEND_MAX_ITEMS} 件です"}), 400
+
+        try:
+            rid_list = [int(it["request_id"]) for it in items if it.get("request_id") is not None]
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "request_id が不正です"}), 400
+        if len(rid_list) != len(set(rid_list)):
+            return jsonify({"status": "error", "message": "同じ request_id が複数回指定されています"}), 400
+
+        # 対象 requests を1回でまとめて取得
+        reqs = {r.id: r for r in session.query(Request).filter(Request.id.in_(rid_list)).all()} if rid_list else {}
+        missing = sorted(set(rid_list) - reqs.keys())
+        if missing:
+            return jsonify({"status": "error", "message": "requests が見つかりません", "missing_request_ids": missing}), 404
+
+        # 本文ごとに {宛先: [request_id, ...]}（宛先の順序は保ち、重複は1回だけ送る）
+        groups: dict[str, dict[str, list[int]]] = {}
+        for i, it in enumerate(items):
+            message_text = it.get("message") or ""
+            if not message_text.strip():
+                return jsonify({"status": "error", "message": f"items[{i}].message が空です"}), 400
+            r = reqs.get(int(it["request_id"])) if it.get("request_id") is not None else None
+            uid = r.user_id if r is not None else (it.get("user_id") or "").strip()
+            if not uid:
+                return jsonify({"status": "error", "message": f"items[{i}] の送信先 user_id がありません"}), 400
+            rids = groups.setdefault(message_text, {}).setdefault(uid, [])
+            if r is not None:
+                rids.append(r.id)
+                r.status = "replied"
+                r.advice_text = message_text
+
+        outbox_ids = []
+        recipients = 0
+        for message_text, to in groups.items():
+            messages = text_messages(message_text)
+            uids = list(to)
+            recipients += len(uids)
+            for k in range(0, len(uids), LINE_MULTICAST_MAX_TO):
+                chunk = uids[k:k + LINE_MULTICAST_MAX_TO]
+                chunk_rids = [rid for u in chunk for rid in to[u]]
+                if len(chunk) == 1 and len(chunk_rids) <= 1:
+                    outbox_ids.append(enqueue_line_push(
+                        session, chunk[0], messages, request_id=chunk_rids[0] if chunk_rids else None,
+                    ))
+                else:
+                    outbox_ids.append(enqueue_line_multicast(session, chunk, messages, request_ids=chunk_rids))
+
+        notify_request_events(session, [
+            {"id": r.id, "event": "status", "status": "replied", "user_id": r.user_id} for r in reqs.values()
+        ])
         session.commit()
+        line_dispatcher.wake()
 
-        return jsonify({"status": "ok"})
+        # 送信は非同期（件数が多く即時には終わらない）。結果は GET /line-outbox で確認
+        return jsonify({
+            "status": "queued",
+            "requests_updated": len(reqs),
+            "recipients": recipients,
+            "distinct_messages": len(groups),
+            "queued_calls": len(outbox_ids),
+            "outbox_ids": outbox_ids,
+        }), 202
     except Exception as e:
         session.rollback()
-        print("❌ Error in /send-summary-and-advice:", e)
+        current_app.logger.exception("/send-bulk failed")
         return jsonify({"status": "error", "message": str(e)}), 500
     finally:
         session.close()
@@ -568,7 +851,7 @@ def send_summary_and_advice():
 # ---------------------------
 # ★ 新規：除外API
 # ---------------------------
-@app.route("/update-status", methods=["POST"])
+@bp.route("/update-status", methods=["POST"])
 def update_status():
     auth = _require_admin()
     if auth:
@@ -591,16 +874,17 @@ def update_status():
             return jsonify({"status": "error", "error": "not found"}), 404
 
         r.status = status
+        notify_request_event(session, r.id, "status", status=status, user_id=r.user_id)
         session.commit()
         return jsonify({"status": "ok"}), 200
     except Exception as e:
         session.rollback()
-        print("❌ Error in /update-status:", e)
+        current_app.logger.exception("/update-status failed")
         return jsonify({"status": "error", "error": str(e)}), 500
     finally:
         session.close()
 
-@app.route("/discard-request", methods=["POST"])
+@bp.route("/discard-request", methods=["POST"])
 def discard_request():
     auth = _require_admin()
     if auth:
@@ -620,19 +904,30 @@ def discard_request():
         if not r:
             return jsonify({"status": "error", "error": "not found"}), 404
         r.status = "ignored"
+        notify_request_event(session, r.id, "status", status="ignored", user_id=r.user_id)
         session.commit()
         return jsonify({"status": "ok"}), 200
     except Exception as e:
         session.rollback()
-        print("❌ Error in /discard-request:", e)
+        current_app.logger.exception("/discard-request failed")
         return jsonify({"status": "error", "error": str(e)}), 500
     finally:
         session.close()
 
+def _float_arg(name: str):
+    v = request.args.get(name)
+    if v in (None, ""):
+        return None
+    try:
+        return float(v)
+    except Exception:
+        return None
+
 # ---------------------------
-# ★ /users
+# ★ /users  （?q= は pg_trgm の類似度順、?min_similarity=0.3）
+#   ページング: レスポンスの next_cursor を ?cursor= に渡す（offset より優先）
 # ---------------------------
-@app.route("/users", methods=["GET"])
+@bp.route("/users", methods=["GET"])
 def api_users():
     auth = _require_admin()
     if auth:
@@ -643,13 +938,19 @@ def api_users():
         offset = int(request.args.get("offset", 0))
     except Exception:
         limit, offset = 20, 0
-    rows = search_users(q=q, limit=limit, offset=offset)
-    return jsonify({"data": rows}), 200
+    min_similarity = _float_arg("min_similarity")
+    keys = USERS_SEARCH_CURSOR_KEYS if q else USERS_CURSOR_KEYS
+    try:
+        after = decode_cursor(request.args.get("cursor"), keys)
+    except InvalidCursor:
+        return jsonify({"error": "invalid_cursor"}), 400
+    rows = search_users(q=q, limit=limit, offset=offset, min_similarity=min_similarity, after=after)
+    return jsonify({"data": rows, "next_cursor": next_cursor(rows, limit, keys)}), 200
 
 # ---------------------------
 # ★ /users/premium  ← 厳密：有料会員リスト
 # ---------------------------
-@app.route("/users/premium", methods=["GET"])
+@bp.route("/users/premium", methods=["GET"])
 def api_users_premium():
     auth = _require_admin()
     if auth:
@@ -662,13 +963,22 @@ def api_users_premium():
     except Exception:
         limit, offset, active_days = 50, 0, 0
     valid_only = (request.args.get("valid_only", "true").lower() != "false")
-    rows = search_paid_users(q=q, limit=limit, offset=offset, active_days=active_days, valid_only=valid_only)
-    return jsonify({"data": rows}), 200
+    min_similarity = _float_arg("min_similarity")
+    keys = PAID_USERS_SEARCH_CURSOR_KEYS if q else PAID_USERS_CURSOR_KEYS
+    try:
+        after = decode_cursor(request.args.get("cursor"), keys)
+    except InvalidCursor:
+        return jsonify({"error": "invalid_cursor"}), 400
+    rows = search_paid_users(
+        q=q, limit=limit, offset=offset, active_days=active_days, valid_only=valid_only,
+        min_similarity=min_similarity, after=after,
+    )
+    return jsonify({"data": rows, "next_cursor": next_cursor(rows, limit, keys)}), 200
 
 # ---------------------------
 # ★ /paid-users  ← 互換（内部は厳密版で返す）
 # ---------------------------
-@app.route("/paid-users", methods=["GET"])
+@bp.route("/paid-users", methods=["GET"])
 def api_paid_users():
     auth = _require_admin()
     if auth:
@@ -679,13 +989,21 @@ def api_paid_users():
         offset = int(request.args.get("offset", 0))
     except Exception:
         limit, offset = 50, 0
-    rows = search_paid_users(q=q, limit=limit, offset=offset, active_days=0, valid_only=True)
-    return jsonify({"data": rows}), 200
+    keys = PAID_USERS_SEARCH_CURSOR_KEYS if q else PAID_USERS_CURSOR_KEYS
+    try:
+        after = decode_cursor(request.args.get("cursor"), keys)
+    except InvalidCursor:
+        return jsonify({"error": "invalid_cursor"}), 400
+    rows = search_paid_users(
+        q=q, limit=limit, offset=offset, active_days=0, valid_only=True,
+        min_similarity=_float_arg("min_similarity"), after=after,
+    )
+    return jsonify({"data": rows, "next_cursor": next_cursor(rows, limit, keys)}), 200
 
 # ---------------------------
 # ★ /user/profile
 # ---------------------------
-@app.route("/user/profile", methods=["GET"])
+@bp.route("/user/profile", methods=["GET"])
 def api_user_profile():
     auth = _require_admin()
     if auth:
@@ -701,7 +1019,7 @@ def api_user_profile():
 # ---------------------------
 # ★ NEW: /user/coaching（開始・終了・目標体重・コース期間＋新規欄を保存）
 # ---------------------------
-@app.route("/user/coaching", methods=["POST"])
+@bp.route("/user/coaching", methods=["POST"])
 def api_user_coaching():
     auth = _require_admin()
     if auth:
@@ -796,13 +1114,35 @@ def api_user_coaching():
 
         return jsonify({"status": "ok", "user_id": uid, "goals_json": base_goals}), 200
     except Exception as e:
-        app.logger.exception(e)
+        current_app.logger.exception(e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# ---------------------------
+# 条件付きGET（ETag / If-None-Match）
+#   (件数, max(updated_at)) から ETag を作り、一致すれば本体を取得せず 304 を返す
+# ---------------------------
+def _range_etag(kind: str, uid: str, s, e):
+    cnt, last = get_range_version(kind, uid, s, e)
+    raw = f"{kind}:{uid}:{s.isoformat()}:{e.isoformat()}:{cnt}:{last.isoformat() if last else '-'}:{response_variant()}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24], last
+
+def _not_modified_or_none(etag: str, last_modified):
+    if request.if_none_match.contains_weak(etag):  # gzip 時は弱い ETag で返している
+        resp = current_app.response_class(status=304)
+        return _with_validators(resp, etag, last_modified)
+    return None
+
+def _with_validators(resp, etag: str, last_modified):
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "private, no-cache"  # 毎回再検証させる
+    return resp
+
 # ---------------------------
 # ★ /user/weights
 # ---------------------------
-@app.route("/user/weights", methods=["GET"])
+@bp.route("/user/weights", methods=["GET"])
 def api_user_weights():
     auth = _require_admin()
     if auth:
@@ -817,13 +1157,19 @@ def api_user_weights():
         e = datetime.fromisoformat(end).date()
     except Exception:
         return jsonify({"error": "invalid_date"}), 400
+    etag, last = _range_etag("weights", uid, s, e)
+    not_modified = _not_modified_or_none(etag, last)
+    if not_modified is not None:
+        return not_modified
+    if wants_stream():
+        return _with_validators(stream_rows_response(iter_user_weights(uid, s, e)), etag, last)
     rows = get_user_weights(uid, s, e)
-    return jsonify({"data": rows}), 200
+    return _with_validators(payload_response({"data": shape_rows(rows)}), etag, last)
 
 # ---------------------------
 # ★ /user/intake
 # ---------------------------
-@app.route("/user/intake", methods=["GET"])
+@bp.route("/user/intake", methods=["GET"])
 def api_user_intake():
     auth = _require_admin()
     if auth:
@@ -838,13 +1184,111 @@ def api_user_intake():
         e = datetime.fromisoformat(end).date()
     except Exception:
         return jsonify({"error": "invalid_date"}), 400
+    etag, last = _range_etag("intake", uid, s, e)
+    not_modified = _not_modified_or_none(etag, last)
+    if not_modified is not None:
+        return not_modified
+    if wants_stream():
+        return _with_validators(stream_rows_response(iter_user_intake(uid, s, e)), etag, last)
     rows = get_user_intake(uid, s, e)
-    return jsonify({"data": rows}), 200
+    return _with_validators(payload_response({"data": shape_rows(rows)}), etag, last)
+
+# ---------------------------
+# ★ /user/timeline（体重・栄養・目標を日付で結合した密な日次行。最大 TIMELINE_MAX_DAYS 日）
+# ---------------------------
+TIMELINE_MAX_DAYS = 731
+
+@bp.route("/user/timeline", methods=["GET"])
+def api_user_timeline():
+    auth = _require_admin()
+    if auth:
+        return auth
+    uid = (request.args.get("user_id") or "").strip()
+    start = (request.args.get("start") or "").strip()
+    end = (request.args.get("end") or "").strip()
+    if not uid or not start or not end:
+        return jsonify({"error": "bad_request"}), 400
+    try:
+        s = datetime.fromisoformat(start).date()
+        e = datetime.fromisoformat(end).date()
+    except Exception:
+        return jsonify({"error": "invalid_date"}), 400
+    if e < s or (e - s).days >= TIMELINE_MAX_DAYS:
+        return jsonify({"error": "invalid_range", "max_days": TIMELINE_MAX_DAYS}), 400
+    rows = get_user_timeline(uid, s, e)
+    return payload_response({"data": shape_rows(rows)})
+
+# ---------------------------
+# ★ /user/rollups?period=week|month（既定 week）&start=&end=
+#   日次テーブルのトリガで維持される user_rollups を返す（長期トレンド用）
+# ---------------------------
+@bp.route("/user/rollups", methods=["GET"])
+def api_user_rollups():
+    auth = _require_admin()
+    if auth:
+        return auth
+    uid = (request.args.get("user_id") or "").strip()
+    period = (request.args.get("period") or "week").strip()
+    start = (request.args.get("start") or "").strip()
+    end = (request.args.get("end") or "").strip()
+    if not uid or not start or not end:
+        return jsonify({"error": "bad_request"}), 400
+    if period not in ROLLUP_PERIOD_TYPES:
+        return jsonify({"error": "invalid_period", "allowed": list(ROLLUP_PERIOD_TYPES)}), 400
+    try:
+        s = datetime.fromisoformat(start).date()
+        e = datetime.fromisoformat(end).date()
+    except Exception:
+        return jsonify({"error": "invalid_date"}), 400
+    rows = get_user_rollups(uid, period, s, e)
+    return payload_response({"period": period, "data": shape_rows(rows)})
+
+# ---------------------------
+# ★ 複数ユーザー一括：POST /users/weights-batch, /users/intake-batch
+#   body: {"user_ids": [...], "start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}
+#   → {"data": {user_id: [...], ...}}（テーブルごとに1クエリ）
+# ---------------------------
+BATCH_MAX_USERS = 500
+
+def _parse_batch_payload():
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get("user_ids")
+    if not isinstance(ids, list) or not ids:
+        return None, (jsonify({"error": "bad_request", "message": "user_ids (list) is required"}), 400)
+    ids = [str(u).strip() for u in ids if str(u or "").strip()]
+    if len(ids) > BATCH_MAX_USERS:
+        return None, (jsonify({"error": "too_many_users", "max": BATCH_MAX_USERS}), 400)
+    try:
+        s = datetime.fromisoformat((payload.get("start") or "").strip()).date()
+        e = datetime.fromisoformat((payload.get("end") or "").strip()).date()
+    except Exception:
+        return None, (jsonify({"error": "invalid_date"}), 400)
+    return (ids, s, e), None
+
+@bp.post("/users/weights-batch")
+def api_users_weights_batch():
+    auth = _require_admin()
+    if auth:
+        return auth
+    args, err = _parse_batch_payload()
+    if err:
+        return err
+    return payload_response({"data": shape_grouped(get_users_weights_batch(*args))})
+
+@bp.post("/users/intake-batch")
+def api_users_intake_batch():
+    auth = _require_admin()
+    if auth:
+        return auth
+    args, err = _parse_batch_payload()
+    if err:
+        return err
+    return payload_response({"data": shape_grouped(get_users_intake_batch(*args))})
 
 # ---------------------------
 # ★ バックフィル（合計＋内訳を期間一括保存）
 # ---------------------------
-@app.post("/backfill-daily")
+@bp.post("/backfill-daily")
 def backfill_daily():
     auth = _require_admin()
     if auth:
@@ -862,46 +1306,46 @@ def backfill_daily():
         if e < s:
             return jsonify({"error": "invalid_date_range"}), 400
 
-        CHUNK_DAYS = 7
         rows_written = 0        # 体組成の保存行数
         empty_days = 0          # 体組成が空だった日数
         intake_written = 0      # 栄養（合計＋内訳）の書き込み件数
+        metrics_counts = new_upsert_counts()   # 体組成：inserted / updated / unchanged
+        intake_counts = new_upsert_counts()    # 栄養：同上
 
-        dbs = SessionLocal()
-        try:
-            cur = s
-            while cur <= e:
-                chunk_end = min(cur + timedelta(days=CHUNK_DAYS - 1), e)
-                sd, ed = cur.isoformat(), chunk_end.isoformat()
+        # 窓サイズは range_planner が API ごとの実績から決める（タイムアウト等は半分に割って取り直す）
+        def _fetch_body(a, b):
+            return get_anthropometric_data(uid, start_date=a.isoformat(), end_date=b.isoformat())
 
-                # 1) 体組成はチャンク取得 → 日別UPSERT
-                body = None
-                try:
-                    body = get_anthropometric_data(uid, start_date=sd, end_date=ed)
-                except Exception as be:
-                    app.logger.warning(f"[backfill-daily] anthropometric chunk fail {uid} {sd}..{ed}: {be}")
+        def _save_intake(a, b):
+            return save_intake_breakdown(uid, a.isoformat(), b.isoformat())
 
-                d = cur
-                while d <= chunk_end:
+        dbs = SessionLocal()
+        try:
+            # 1) 体組成は窓ごとに取得 → 日別UPSERT（取得に失敗した窓は従来通り NULL 行）
+            for a, b, body, be in planner.run(METRICS_RANGE_ENDPOINT, s, e, _fetch_body):
+                if be is not None:
+                    current_app.logger.warning(f"[backfill-daily] anthropometric chunk fail {uid} {a}..{b}: {be}")
+                d = a
+                while d <= b:
                     day = d.isoformat()
                     try:
                         w, bf = _extract_body_for_day(body, day) if body is not None else (None, None)
-                        upsert_metrics_daily(uid, d, w, bf, session=dbs)
+                        metrics_counts[upsert_metrics_daily(uid, d, w, bf, session=dbs)] += 1
                         rows_written += 1
                         if w is None:
                             empty_days += 1
                     except Exception as de:
-                        app.logger.warning(f"[backfill-daily] save metrics fail {uid} {day}: {de}")
+                        current_app.logger.warning(f"[backfill-daily] save metrics fail {uid} {day}: {de}")
                     d += timedelta(days=1)
 
-                # 2) 栄養は save_intake_breakdown でチャンク一括保存（合計＋内訳）
-                try:
-                    stat = save_intake_breakdown(uid, sd, ed)
-                    intake_written += int(stat.get("written", 0))
-                except Exception as me:
-                    app.logger.warning(f"[backfill-daily] save_intake_breakdown fail {uid} {sd}..{ed}: {me}")
-
-                cur = chunk_end + timedelta(days=1)
+            # 2) 栄養は save_intake_breakdown で窓ごとに一括保存（合計＋内訳）
+            for a, b, stat, me in planner.run(INTAKE_RANGE_ENDPOINT, s, e, _save_intake):
+                if me is not None:
+                    current_app.logger.warning(f"[backfill-daily] save_intake_breakdown fail {uid} {a}..{b}: {me}")
+                    continue
+                intake_written += int(stat.get("written", 0))
+                for k in intake_counts:
+                    intake_counts[k] += int(stat.get(k, 0))
 
             dbs.commit()
         except Exception:
@@ -918,15 +1362,17 @@ def backfill_daily():
             "rows_written": rows_written,      # 体組成のUPSERT件数
             "empty_days": empty_days,          # 体組成が空だった日
             "intake_written": intake_written,  # 栄養（日数）書き込み件数（参考）
+            "metrics_upserts": metrics_counts, # inserted / updated / unchanged
+            "intake_upserts": intake_counts,
         })
     except Exception as e:
-        app.logger.exception(e)
+        current_app.logger.exception(e)
         return jsonify({"error": "internal_error", "detail": str(e)}), 500
 
 # ---------------------------
 # ★ 不足分だけ同期（合計 or 内訳が欠けている日を埋める）
 # ---------------------------
-@app.post("/backfill-intake-missing")
+@bp.post("/backfill-intake-missing")
 def backfill_intake_missing():
     """
     表示期間のうち「行が無い / 合計のどれかがNULL / meals_breakdownがNULL/空」の日だけ
@@ -982,7 +1428,7 @@ def backfill_intake_missing():
             if rec["mb"] in (None, {}, ""):
                 need_dates.append(d); continue
 
-        # 3) 連続区間にまとめて API 呼び出し回数を減らす
+        # 3) 連続区間にまとめて API 呼び出し回数を減らす（長い区間は range_planner の窓で分割）
         def _group_ranges(dates: list[date_cls]) -> list[tuple[date_cls, date_cls]]:
             if not dates:
                 return []
@@ -1000,9 +1446,16 @@ def backfill_intake_missing():
 
         ranges = _group_ranges(need_dates)
         total_written = 0
+        calls = 0
         for (d1, d2) in ranges:
-            stat = save_intake_breakdown(uid, d1.isoformat(), d2.isoformat())
-            total_written += int(stat.get("written", 0))
+            for a, b, stat, err in planner.run(
+                INTAKE_RANGE_ENDPOINT, d1, d2,
+                lambda a, b: save_intake_breakdown(uid, a.isoformat(), b.isoformat()),
+            ):
+                if err is not None:
+                    raise err
+                calls += 1
+                total_written += int(stat.get("written", 0))
 
         return jsonify({
             "status": "ok",
@@ -1011,16 +1464,185 @@ def backfill_intake_missing():
             "end_date": e.isoformat(),
             "need_days": len(need_dates),
             "written": total_written,
+            "calls": calls,
             "ranges": [{"start": a.isoformat(), "end": b.isoformat()} for (a, b) in ranges],
         })
     except Exception as e:
-        app.logger.exception(e)
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# ---------------------------
+# ★ 欠損区間の検出 / 補完（全連携ユーザー・栄養＋体組成）
+#   GET  /data-gaps?start=&end=&user_id=&kinds=intake,metrics  … 検出のみ（既定は直近30日）
+#   POST /fill-gaps {"start","end","user_ids":[...],"kinds":[...],"max_calls":N,"dry_run":bool}
+# ---------------------------
+def _gap_range(src):
+    end = src.get("end")
+    start = src.get("start")
+    e = datetime.fromisoformat(end).date() if end else date_cls.today() - timedelta(days=1)
+    s = datetime.fromisoformat(start).date() if start else e - timedelta(days=29)
+    return s, e
+
+def _gap_kinds(v):
+    if isinstance(v, str):
+        v = v.split(",")
+    kinds = [k.strip() for k in (v or DATA_GAP_KINDS) if k and k.strip() in DATA_GAP_KINDS]
+    return kinds or list(DATA_GAP_KINDS)
+
+@bp.get("/data-gaps")
+def api_data_gaps():
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        try:
+            s, e = _gap_range(request.args)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "invalid date"}), 400
+        uid = (request.args.get("user_id") or "").strip()
+        gaps = find_data_gaps(s, e, user_ids=[uid] if uid else None, kinds=_gap_kinds(request.args.get("kinds")))
+        return jsonify({
+            "status": "ok",
+            "start_date": s.isoformat(),
+            "end_date": e.isoformat(),
+            "missing_days": sum(g["days"] for g in gaps),
+            "data": [{**g, "start": g["start"].isoformat(), "end": g["end"].isoformat()} for g in gaps],
+        })
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@bp.post("/fill-gaps")
+def api_fill_gaps():
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        payload = request.get_json(silent=True) or {}
+        try:
+            s, e = _gap_range(payload)
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "invalid date"}), 400
+        if e < s:
+            return jsonify({"status": "error", "message": "invalid date range"}), 400
+        max_calls = payload.get("max_calls")
+        stats = fill_gaps(
+            s, e,
+            user_ids=payload.get("user_ids") or None,
+            kinds=_gap_kinds(payload.get("kinds")),
+            max_calls=int(max_calls) if max_calls is not None else None,
+            dry_run=bool(payload.get("dry_run")),
+        )
+        return jsonify({"status": "ok", "start_date": s.isoformat(), "end_date": e.isoformat(), **stats})
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# ---------------------------
+# ★ 差分同期（1ユーザー）：直近 window_days 日＋ウォーターマーク以降を取り直す
+#   POST /sync-incremental {"user_id": "...", "window_days": 7, "end": "YYYY-MM-DD"(省略時は15時締めの確定日)}
+# ---------------------------
+@bp.post("/sync-incremental")
+def api_sync_incremental():
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        payload = request.get_json(silent=True) or {}
+        uid = (payload.get("user_id") or "").strip()
+        if not uid:
+            return jsonify({"status": "error", "message": "user_id is required"}), 400
+        end = payload.get("end")
+        try:
+            e = datetime.fromisoformat(end).date() if end else last_closed_day()
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "invalid date"}), 400
+        window_days = max(1, min(int(payload.get("window_days") or SYNC_WINDOW_DAYS), 62))
+        result = sync_user_incremental(uid, e, window_days=window_days)
+        return jsonify({"status": "ok" if not result["errors"] else "partial", "user_id": uid, **result})
+    except Exception as e:
+        current_app.logger.exception(e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# ---------------------------
+# ★ LINE アウトボックスの滞留状況（status ごとの件数・最古の未送信の経過秒）
+# ---------------------------
+@bp.get("/line-outbox")
+def api_line_outbox():
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        return jsonify({"status": "ok", **line_outbox_stats()})
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# ---------------------------
+# ★ 外部API（Calomeal / OpenAI / LINE）のサーキットブレーカ状態
+# ---------------------------
+@bp.get("/metrics/breakers")
+def api_metrics_breakers():
+    auth = _require_admin()
+    if auth:
+        return auth
+    return jsonify({"status": "ok", "data": breakers_snapshot()})
+
+# ---------------------------
+# ★ Calomeal レート制限の待ち時間（優先度別：呼び出し数・累計/平均/最大待ち・タイムアウト数）
+# ---------------------------
+@bp.get("/metrics/rate-limit")
+def api_metrics_rate_limit():
+    auth = _require_admin()
+    if auth:
+        return auth
+    return jsonify({"status": "ok", "data": calomeal_limiter.snapshot()})
+
+# ---------------------------
+# ★ Calomeal 期間取得の窓サイズ（range_planner の学習状況）
+# ---------------------------
+@bp.get("/range-planner")
+def api_range_planner():
+    auth = _require_admin()
+    if auth:
+        return auth
+    return jsonify({"status": "ok", "data": planner.snapshot()})
+
+# ---------------------------
+# ★ スケジューラ（夜間同期など）の実行履歴 / 手動実行
+#   GET  /sync-runs?job=nightly_sync&limit=50
+#   POST /sync-runs/<job>  … バックグラウンドで即時実行（他プロセス実行中ならスキップ）
+# ---------------------------
+@bp.get("/sync-runs")
+def api_sync_runs():
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        job = (request.args.get("job") or "").strip() or None
+        try:
+            limit = int(request.args.get("limit", 50))
+        except Exception:
+            limit = 50
+        return jsonify({"status": "ok", "data": list_sync_runs(job, limit)})
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@bp.post("/sync-runs/<job>")
+def api_sync_run_now(job):
+    auth = _require_admin()
+    if auth:
+        return auth
+    if job not in scheduler.jobs:
+        return jsonify({"status": "error", "message": f"unknown job: {job}", "jobs": list(scheduler.jobs)}), 404
+    scheduler.run_now(job)
+    return jsonify({"status": "accepted", "job": job}), 202
+
 # ---------------------------
 # ★ 期間目標バックフィル
 # ---------------------------
-@app.post("/sync-goals-range")
+@bp.post("/sync-goals-range")
 def sync_goals_range():
     auth = _require_admin()
     if auth:
@@ -1057,13 +1679,9 @@ def sync_goals_range():
         f    = _safe_num(raw_goal.get("lipid")   or raw_goal.get("fat") or raw_goal.get("fat_g"))
         c    = _safe_num(raw_goal.get("carbohydrate") or raw_goal.get("carb") or raw_goal.get("carb_g"))
 
-        rows = []
-        cur = s
-        while cur <= e:
-            rows.append({"date": cur, "kcal": kcal, "p": p, "f": f, "c": c})
-            cur += timedelta(days=1)
-
-        stat = upsert_goals_daily_bulk(uid, rows)
+        # 1日1行ではなく [s, e] の1区間として保存（同値の隣接区間とは結合される）
+        stat = set_goal_interval(uid, s, e, {"kcal": kcal, "p": p, "f": f, "c": c})
+        days = (e - s).days + 1
 
         set_user_goals_json(uid, {
             "calorie": kcal,
@@ -1079,17 +1697,19 @@ def sync_goals_range():
             "user_id": uid,
             "start_date": s.isoformat(),
             "end_date": e.isoformat(),
-            "rows_written": stat["written"],
-            "empty_days": stat["empty"],
+            "rows_written": days,
+            "empty_days": days if all(v is None for v in (kcal, p, f, c)) else 0,
+            "intervals_inserted": stat["inserted"],
+            "intervals_deleted": stat["deleted"],
         })
     except Exception as e:
-        app.logger.exception(e)
+        current_app.logger.exception(e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # ---------------------------
 # ★ 期間目標取得
 # ---------------------------
-@app.get("/user/goals-range")
+@bp.get("/user/goals-range")
 def user_goals_range():
     auth = _require_admin()
     if auth:
@@ -1103,11 +1723,93 @@ def user_goals_range():
 
         s = datetime.fromisoformat(start).date()
         e = datetime.fromisoformat(end).date()
+        etag, last = _range_etag("goals", uid, s, e)
+        not_modified = _not_modified_or_none(etag, last)
+        if not_modified is not None:
+            return not_modified
+        if wants_stream():
+            return _with_validators(stream_rows_response(iter_goals_range(uid, s, e), {"status": "ok"}), etag, last)
         rows = fetch_goals_range(uid, s, e)
-        return jsonify({"status": "ok", "data": rows})
+        return _with_validators(payload_response({"status": "ok", "data": shape_rows(rows)}), etag, last)
     except Exception as e:
-        app.logger.exception(e)
+        current_app.logger.exception(e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# ---------------------------
+# ★ LLM使用量の集計（日別 / ユーザー別 / 呼び出し元別）
+# ---------------------------
+@bp.get("/llm-usage")
+def api_llm_usage():
+    """
+    ?group_by=day,user_id,call_site,model（カンマ区切り・既定は day）
+    &start=YYYY-MM-DD&end=YYYY-MM-DD&user_id=...&limit=200
+    """
+    auth = _require_admin()
+    if auth:
+        return auth
+    try:
+        group_by = [x.strip() for x in (request.args.get("group_by") or "day").split(",") if x.strip()]
+        start = (request.args.get("start") or "").strip()
+        end = (request.args.get("end") or "").strip()
+        s = datetime.fromisoformat(start).date() if start else None
+        e = datetime.fromisoformat(end).date() if end else None
+        uid = (request.args.get("user_id") or "").strip() or None
+        try:
+            limit = int(request.args.get("limit", 200))
+        except Exception:
+            limit = 200
+
+        rows = summarize_llm_usage(group_by, start=s, end=e, user_id=uid, limit=limit)
+        return jsonify({"status": "ok", "group_by": group_by, "data": rows, "writer": writer_stats()})
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# ---------------------------
+# アプリファクトリ
+# ---------------------------
+@click.command("init-db")
+def init_db_command():
+    """テーブルを作成する（flask --app app init-db）"""
+    init_db()
+    click.echo("✅ PostgreSQL テーブル初期化完了")
+
+@click.command("migrate")
+@click.option("--target", type=int, default=None)
+@click.option("--no-concurrently", is_flag=True, default=False)
+def migrate_command(target, no_concurrently):
+    """スキーママイグレーションを適用する（flask --app app migrate）"""
+    from utils.migrations import apply_migrations
+    done = apply_migrations(target=target, concurrently=not no_concurrently)
+    click.echo(f"✅ 適用したマイグレーション: {done or 'なし'}")
+
+def create_app() -> Flask:
+    """
+    Flask アプリを生成する。DB エンジン・OpenAI・Calomeal クライアントは初回利用時に生成される。
+    スキーマ作成は init-db コマンド（または scripts/init_postgres.py）で明示的に行う。
+    """
+    configure_logging()
+    app = Flask(__name__)
+    install_json_provider(app)  # orjson があれば高速な JSON シリアライザへ
+    app.register_blueprint(bp)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
+
+    # 起動直後に接続を張っておきたい場合のみ（既定は遅延）
+    if os.getenv("DB_EAGER_CONNECT", "").lower() in ("1", "true"):
+        get_engine()
+    # 夜間同期などのスケジューラ（複数ワーカーでも各ジョブは advisory lock で1回だけ実行）
+    if os.getenv("SCHEDULER_ENABLED", "").lower() in ("1", "true"):
+        scheduler.start()
+    # LINE 送信（/send-reply 等で積んだアウトボックス）のディスパッチャ。既定で有効、最初のリクエストで起動する
+    # （import / CLI / ベンチはリクエストを処理しないのでスレッドや LISTEN 接続を作らない。gunicorn の fork 後にも起動できる）
+    # 別プロセス（python -m scripts.line_dispatcher）で回す場合は LINE_OUTBOX_ENABLED=0
+    if os.getenv("LINE_OUTBOX_ENABLED", "1").lower() not in ("0", "false"):
+        app.before_request(line_dispatcher.ensure_started)
+    return app
+
+# gunicorn app:app 互換
+app = create_app()
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,17 +1,17 @@
-from utils.db import get_unreplied_requests, update_advice_text
+from utils.db import get_unreplied_requests, update_advice_text, to_request_local
 from utils.caromil import get_meal_with_basis, get_anthropometric_data
 from utils.gpt_utils import generate_advice_by_prompt
 
-from datetime import datetime, timedelta
+from datetime import timedelta
 import time
 
 
-def get_target_date_from_timestamp(timestamp: str) -> str:
+def get_target_date_from_timestamp(timestamp) -> str:
     """
-    タイムスタンプから「分析対象の日付（YYYY/MM/DD）」を決定
+    タイムスタンプ（ISO文字列 or datetime）から「分析対象の日付（YYYY/MM/DD）」を決定
     15時を境に、前日 or 当日を返す
     """
-    dt = datetime.fromisoformat(timestamp)
+    dt = to_request_local(timestamp)
     if dt.hour < 15:
         target_date = dt.date() - timedelta(days=1)
     else:
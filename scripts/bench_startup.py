@@ -0,0 +1,38 @@
+# scripts/bench_startup.py
+"""
+コールドスタート計測：新しいプロセスで `import app` と create_app() の所要時間を測る。
+使い方: python scripts/bench_startup.py [回数]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, time
+t0 = time.perf_counter()
+import app as app_module
+t1 = time.perf_counter()
+app_module.create_app()
+t2 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "create_app_ms": (t2 - t1) * 1000}))
+"""
+
+
+def run_once() -> dict:
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE] if os.getenv("BENCH_IMPORTTIME") else [sys.executable, "-c", PROBE],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    samples = [run_once() for _ in range(n)]
+    for key in ("import_ms", "create_app_ms"):
+        vals = [s[key] for s in samples]
+        print(f"⏱ {key}: median={statistics.median(vals):.1f}ms min={min(vals):.1f}ms max={max(vals):.1f}ms (n={n})")
@@ -0,0 +1,36 @@
+# scripts/fill_gaps.py
+"""
+欠損日（栄養 / 体組成）の検出と補完を全連携ユーザーに対して行う。
+使い方（リポジトリ直下で、1日1回 cron 等）:
+  python -m scripts.fill_gaps                 # 直近30日
+  python -m scripts.fill_gaps --days 90 --max-calls 500
+  python -m scripts.fill_gaps --dry-run       # 検出だけ
+"""
+import argparse
+import json
+from datetime import date, timedelta
+
+from services.gap_fill import fill_gaps
+from utils.logging_utils import configure_logging
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--days", type=int, default=30)
+    ap.add_argument("--kinds", default="intake,metrics")
+    ap.add_argument("--max-calls", type=int, default=None)
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args()
+
+    configure_logging()
+    end = date.today() - timedelta(days=1)   # 当日分は webhook で入るので前日まで
+    start = end - timedelta(days=args.days - 1)
+    kw = {"workers": args.workers} if args.workers else {}
+    stats = fill_gaps(
+        start, end,
+        kinds=[k.strip() for k in args.kinds.split(",") if k.strip()],
+        max_calls=args.max_calls,
+        dry_run=args.dry_run,
+        **kw,
+    )
+    print("✅ gap fill:", json.dumps(stats, ensure_ascii=False, default=str))
@@ -1,5 +1,6 @@
 from utils.db import init_db
 
 if __name__ == "__main__":
+    # スキーマ作成は明示コマンドのみ（app import 時には実行しない）
     init_db()
     print("✅ PostgreSQL テーブル初期化完了")
@@ -0,0 +1,29 @@
+# scripts/line_dispatcher.py
+"""
+LINE アウトボックスのディスパッチャを専用プロセスで回す（Web ワーカーで LINE_OUTBOX_ENABLED=1 にしない場合）。
+使い方: python -m scripts.line_dispatcher [--once]
+  --once … 送信待ちを1回送り切って終了（cron 用）
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from services.line_dispatcher import LINE_OUTBOX_WORKERS, dispatcher, drain_once
+from utils.logging_utils import configure_logging
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--once", action="store_true")
+    args = ap.parse_args()
+
+    configure_logging()
+    if args.once:
+        with ThreadPoolExecutor(max_workers=LINE_OUTBOX_WORKERS, thread_name_prefix="line-push") as pool:
+            stats = drain_once(pool, LINE_OUTBOX_WORKERS)
+        print("✅ line outbox:", json.dumps(stats, ensure_ascii=False))
+    else:
+        print("✅ line outbox dispatcher: running (Ctrl+C で終了)")
+        try:
+            dispatcher.run_forever()
+        except KeyboardInterrupt:
+            dispatcher.stop()
@@ -0,0 +1,28 @@
+# scripts/migrate.py
+"""
+スキーママイグレーションの適用 / 状態表示。
+使い方（リポジトリ直下で）:
+  python -m scripts.migrate                 # 未適用を全て適用（インデックスは CONCURRENTLY）
+  python -m scripts.migrate --status        # 適用状況を表示
+  python -m scripts.migrate --target 1      # version 1 まで適用
+  python -m scripts.migrate --no-concurrently  # メンテナンス時間中の高速適用
+"""
+import argparse
+
+from utils.logging_utils import configure_logging
+from utils.migrations import apply_migrations, migration_status
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--status", action="store_true")
+    ap.add_argument("--target", type=int, default=None)
+    ap.add_argument("--no-concurrently", action="store_true")
+    args = ap.parse_args()
+
+    configure_logging()
+    if args.status:
+        for m in migration_status():
+            print(f"{'✅' if m['applied'] else '⏳'} {m['version']:04d} {m['name']}")
+    else:
+        done = apply_migrations(target=args.target, concurrently=not args.no_concurrently)
+        print(f"✅ 適用したマイグレーション: {done or 'なし'}")
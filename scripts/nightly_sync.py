@@ -0,0 +1,23 @@
+# scripts/nightly_sync.py
+"""
+夜間同期を1回だけ実行する（アプリ内スケジューラを使わず cron で回す場合）。
+使い方: python -m scripts.nightly_sync [--job nightly_sync|maintenance]
+"""
+import argparse
+import json
+
+from services.scheduler import run_job, scheduler
+from utils.logging_utils import configure_logging
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--job", default="nightly_sync", choices=sorted(scheduler.jobs))
+    args = ap.parse_args()
+
+    configure_logging()
+    job = scheduler.jobs[args.job]
+    result = run_job(job.name, job.fn)
+    if result is None:
+        print(f"⏭ {args.job}: 他プロセスで実行中のためスキップ")
+    else:
+        print(f"✅ {args.job}:", json.dumps(result, ensure_ascii=False, default=str))
@@ -0,0 +1,12 @@
+# scripts/rollover_activity_summary.py
+"""
+user_activity_summary の夜間ロールオーバー（days_30 の窓を今日基準に再計算）。
+使い方: python -m scripts.rollover_activity_summary   （1日1回、cron 等で実行）
+"""
+from utils.db import rollover_activity_summary
+from utils.logging_utils import configure_logging
+
+if __name__ == "__main__":
+    configure_logging()
+    n = rollover_activity_summary()
+    print(f"✅ user_activity_summary 更新: {n} 行")
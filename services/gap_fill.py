@@ -0,0 +1,111 @@
+# services/gap_fill.py
+"""
+欠損日の検出と補完（全連携ユーザー × 栄養 / 体組成）。
+- 検出: utils.db.find_data_gaps（generate_series のアンチジョイン＋連続区間化を SQL 1本で）
+- 補完: 区間を range_planner の窓サイズで分割し（失敗時は自動で半分に）、workers 並列で取得
+  呼び出し数/秒は utils.caromil の共有レート制限（calomeal_limiter・バッチ優先度）に従う（待ち時間は /metrics/rate-limit）
+夜間バッチ: python -m scripts.fill_gaps --days 30
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from utils.caromil import (
+    INTAKE_RANGE_ENDPOINT,
+    METRICS_RANGE_ENDPOINT,
+    save_body_metrics_range,
+    save_intake_breakdown,
+)
+from utils.db import DATA_GAP_KINDS, find_data_gaps
+from utils.range_planner import RangePlanner, planner as default_planner
+
+logger = logging.getLogger(__name__)
+
+GAP_FILL_WORKERS = int(os.getenv("GAP_FILL_WORKERS", "2"))
+
+_SAVERS = {
+    "intake": save_intake_breakdown,
+    "metrics": save_body_metrics_range,
+}
+_ENDPOINTS = {
+    "intake": INTAKE_RANGE_ENDPOINT,
+    "metrics": METRICS_RANGE_ENDPOINT,
+}
+
+Fetch = Tuple[str, str, date, date]  # (kind, user_id, start, end)
+
+
+def plan_fetches(gaps: List[Dict], planner: RangePlanner = default_planner) -> List[Fetch]:
+    """欠損区間を range_planner の窓サイズ以下の取得単位に分割する（区間が短ければそのまま1回）"""
+    out: List[Fetch] = []
+    for g in gaps:
+        for a, b in planner.plan(_ENDPOINTS[g["kind"]], g["start"], g["end"]):
+            out.append((g["kind"], g["user_id"], a, b))
+    return out
+
+
+def fill_gaps(
+    start: date,
+    end: date,
+    user_ids: Optional[Sequence[str]] = None,
+    kinds: Sequence[str] = DATA_GAP_KINDS,
+    workers: int = GAP_FILL_WORKERS,
+    max_calls: Optional[int] = None,
+    dry_run: bool = False,
+) -> Dict:
+    """
+    欠損を検出して埋める。1ユーザー・1区間の失敗は記録して続行する。
+    max_calls で1回の実行の呼び出し数に上限をかけられる（残りは次回の検出で再び拾われる）。
+    """
+    t0 = time.monotonic()
+    gaps = find_data_gaps(start, end, user_ids=list(user_ids) if user_ids else None, kinds=kinds)
+    fetches = plan_fetches(gaps)
+    stats = {
+        "gaps": len(gaps),
+        "missing_days": sum(g["days"] for g in gaps),
+        "planned_calls": len(fetches),
+        "calls": 0,
+        "errors": 0,
+        "written": {k: 0 for k in DATA_GAP_KINDS},
+        "skipped_calls": 0,
+    }
+    if max_calls is not None and len(fetches) > max_calls:
+        stats["skipped_calls"] = len(fetches) - max_calls
+        fetches = fetches[:max_calls]
+    if dry_run or not fetches:
+        stats["elapsed_sec"] = round(time.monotonic() - t0, 2)
+        return stats
+
+    def _run(f: Fetch) -> Dict:
+        kind, uid, a, b = f
+        saver = _SAVERS[kind]
+        out = {"calls": 0, "written": 0, "errors": 0}
+
+        def _fetch(x: date, y: date) -> Dict:
+            out["calls"] += 1
+            return saver(uid, x.isoformat(), y.isoformat())
+
+        # タイムアウト等で失敗した窓は range_planner が半分に割って取り直す
+        for x, y, stat, err in default_planner.run(_ENDPOINTS[kind], a, b, _fetch):
+            if err is not None:
+                out["errors"] += 1
+                logger.warning("gap fill failed", extra={"kind": kind, "user_id": uid, "start": str(x), "end": str(y), "error": str(err)})
+            else:
+                out["written"] += int(stat.get("written", 0))
+        return out
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gap-fill") as ex:
+        futures = {ex.submit(_run, f): f for f in fetches}
+        for fut in as_completed(futures):
+            kind = futures[fut][0]
+            r = fut.result()
+            stats["calls"] += r["calls"]
+            stats["errors"] += r["errors"]
+            stats["written"][kind] += r["written"]
+
+    stats["elapsed_sec"] = round(time.monotonic() - t0, 2)
+    logger.info("gap fill done", extra=stats)
+    return stats
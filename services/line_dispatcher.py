@@ -0,0 +1,165 @@
+# services/line_dispatcher.py
+"""
+LINE アウトボックス（line_outbox）の送信スレッド。
+- Web ワーカーでは最初のリクエストで ensure_started() される（既定。import / CLI / ベンチでは起動しない）
+  専用プロセスで回す場合は Web 側を LINE_OUTBOX_ENABLED=0 にして python -m scripts.line_dispatcher（--once で1回だけ送り切る）
+  このプロセスで動いていない時、/send-* は 202 queued を返す（滞留は GET /line-outbox で確認）
+- 積まれた行は pg_notify で即座に起きて送る（取りこぼしは LINE_OUTBOX_POLL_SEC ごとの見回りで拾う）
+- 取得は FOR UPDATE SKIP LOCKED なので複数ワーカー / 複数インスタンスで同時に動かしてよい
+- 1行 = push（1人）または multicast（最大500人）1回。同時送信数は LINE_OUTBOX_WORKERS まで
+- 再送は行ごとの X-Line-Retry-Key で重複配信されない
+- 5xx / 429 / ネットワーク / ブレーカ open は指数バックオフで再送、4xx と上限到達は failed
+"""
+import logging
+import os
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from utils.db import (
+    LINE_OUTBOX_CHANNEL,
+    claim_line_outbox,
+    get_engine,
+    mark_line_outbox_failed,
+    mark_line_outbox_sent,
+)
+from utils.line import LineSendError, multicast_messages, push_messages
+
+logger = logging.getLogger(__name__)
+
+LINE_OUTBOX_WORKERS = int(os.getenv("LINE_OUTBOX_WORKERS", "4"))
+LINE_OUTBOX_POLL_SEC = float(os.getenv("LINE_OUTBOX_POLL_SEC", "5"))
+LINE_OUTBOX_LEASE_SEC = int(os.getenv("LINE_OUTBOX_LEASE_SEC", "120"))     # sending のまま止まった行を再取得するまで
+LINE_OUTBOX_MAX_ATTEMPTS = int(os.getenv("LINE_OUTBOX_MAX_ATTEMPTS", "8"))
+LINE_OUTBOX_RETRY_BASE_SEC = 5.0
+LINE_OUTBOX_RETRY_MAX_SEC = 600.0
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(LINE_OUTBOX_RETRY_MAX_SEC, LINE_OUTBOX_RETRY_BASE_SEC * (2 ** (attempts - 1)))
+
+
+def deliver(row: Dict) -> str:
+    """1行送る。戻り値: sent / retry / failed"""
+    try:
+        if row.get("to_user_ids"):
+            multicast_messages(row["to_user_ids"], row["messages"], retry_key=row["retry_key"])
+        else:
+            push_messages(row["to_user_id"], row["messages"], retry_key=row["retry_key"])
+    except LineSendError as e:
+        if e.retryable and row["attempts"] < LINE_OUTBOX_MAX_ATTEMPTS:
+            mark_line_outbox_failed(row["id"], str(e), retry_in_sec=_retry_delay(row["attempts"]))
+            return "retry"
+        logger.warning("line outbox give up", extra={"outbox_id": row["id"], "attempts": row["attempts"], "error": str(e)})
+        mark_line_outbox_failed(row["id"], str(e))
+        return "failed"
+    except Exception as e:
+        logger.exception("line outbox unexpected error", extra={"outbox_id": row["id"], "attempts": row["attempts"]})
+        # 想定外の例外も上限までで打ち切る（毎回落ちる行を永久に再送しない）
+        if row["attempts"] < LINE_OUTBOX_MAX_ATTEMPTS:
+            mark_line_outbox_failed(row["id"], str(e), retry_in_sec=_retry_delay(row["attempts"]))
+            return "retry"
+        mark_line_outbox_failed(row["id"], str(e))
+        return "failed"
+    mark_line_outbox_sent(row["id"])
+    return "sent"
+
+
+def drain_once(pool: ThreadPoolExecutor, workers: int = LINE_OUTBOX_WORKERS) -> Dict[str, int]:
+    """送信待ちを workers 件ずつ取り、全部送り終わるまで繰り返す（空になったら戻る）"""
+    stats = {"sent": 0, "retry": 0, "failed": 0}
+    while True:
+        rows = claim_line_outbox(limit=workers, lease_sec=LINE_OUTBOX_LEASE_SEC)
+        if not rows:
+            return stats
+        for outcome in pool.map(deliver, rows):
+            stats[outcome] += 1
+
+
+class LineOutboxDispatcher:
+    def __init__(self, workers: int = LINE_OUTBOX_WORKERS):
+        self.workers = max(1, workers)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        t = self._thread
+        return t is not None and t.is_alive()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name="line-outbox", daemon=True)
+            self._thread.start()
+        logger.info("line outbox dispatcher started", extra={"workers": self.workers})
+
+    def ensure_started(self) -> None:
+        """before_request 用。fork 後のワーカーでも最初のリクエストで起動する（起動済みなら何もしない）"""
+        if not self.running and not self._stop.is_set():
+            self.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self) -> None:
+        """同じプロセスで積んだ直後に呼ぶと pg_notify を待たずに送る"""
+        self._wake.set()
+
+    def _listen(self):
+        fairy = get_engine().raw_connection()
+        fairy.detach()
+        conn = getattr(fairy, "driver_connection", None) or fairy.connection
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{LINE_OUTBOX_CHANNEL}"')
+        return conn
+
+    def _wait(self, conn) -> None:
+        """通知 / wake() / POLL_SEC 経過のいずれかまで待つ"""
+        if conn is None:
+            self._wake.wait(LINE_OUTBOX_POLL_SEC)
+        else:
+            deadline = time.monotonic() + LINE_OUTBOX_POLL_SEC
+            while not self._wake.is_set() and time.monotonic() < deadline:
+                if select.select([conn], [], [], 0.5) != ([], [], []):
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        break
+        self._wake.clear()
+
+    def run_forever(self) -> None:
+        """stop() まで送信ループを回す（start() は別スレッドでこれを呼ぶ）"""
+        conn = None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="line-push") as pool:
+            while not self._stop.is_set():
+                try:
+                    if conn is None:
+                        try:
+                            conn = self._listen()
+                        except Exception:
+                            logger.warning("line outbox listen failed; polling", exc_info=True)
+                    stats = drain_once(pool, self.workers)
+                    if any(stats.values()):
+                        logger.info("line outbox drained", extra=stats)
+                    self._wait(conn)
+                except Exception:
+                    logger.exception("line outbox dispatcher error")
+                    if conn is not None:
+                        try:
+                            conn.close()
+                        except Exception:
+                            pass
+                        conn = None
+                    self._stop.wait(LINE_OUTBOX_POLL_SEC)
+
+
+dispatcher = LineOutboxDispatcher()
@@ -0,0 +1,193 @@
+# services/scheduler.py
+"""
+アプリ内スケジューラ（スレッド1本）。
+- SCHEDULER_ENABLED=1 の時だけ create_app() から start() される
+- 複数ワーカー / 複数インスタンスで動いていても、各ジョブは pg_try_advisory_lock を取れた1プロセスだけが実行
+- 実行履歴（所要時間・件数）は sync_runs に記録（GET /sync-runs で確認）
+
+ジョブ:
+  nightly_sync … 15時締め（generate_advice と同じ）で確定した日までを全連携ユーザーについて差分同期
+                 （直近の窓＋ウォーターマーク以降：services.incremental_sync）
+  maintenance  … requests の月次パーティション先行作成＋ user_activity_summary のロールオーバー
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from zoneinfo import ZoneInfo
+from zlib import crc32
+
+from sqlalchemy import text
+
+from services.incremental_sync import SYNC_WINDOW_DAYS, sync_user_incremental
+from utils.db import (
+    REQUESTS_LEGACY_TZ,
+    ensure_request_partitions,
+    finish_sync_run,
+    get_engine,
+    last_sync_run_started,
+    list_token_user_ids,
+    rollover_activity_summary,
+    start_sync_run,
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TZ = os.getenv("SCHEDULER_TZ", REQUESTS_LEGACY_TZ)
+ADVICE_CUTOFF_HOUR = 15                                              # generate_advice の「15時締め」
+NIGHTLY_SYNC_HOUR = int(os.getenv("NIGHTLY_SYNC_HOUR", str(ADVICE_CUTOFF_HOUR)))
+NIGHTLY_SYNC_WORKERS = int(os.getenv("NIGHTLY_SYNC_WORKERS", "4"))
+NIGHTLY_SYNC_JITTER_SEC = float(os.getenv("NIGHTLY_SYNC_JITTER_SEC", "2"))
+MAINTENANCE_HOUR = int(os.getenv("MAINTENANCE_HOUR", "3"))
+TICK_SEC = 30
+
+
+def _now_local() -> datetime:
+    return datetime.now(ZoneInfo(SCHEDULER_TZ))
+
+
+def last_closed_day(now_local: Optional[datetime] = None) -> date:
+    """
+    分析が締まった最後の日。15時前は「前日」がまだ分析対象なので前々日、15時以降は前日。
+    （generate_advice.get_target_date_from_timestamp の裏返し）
+    """
+    now_local = now_local or _now_local()
+    back = 1 if now_local.hour >= ADVICE_CUTOFF_HOUR else 2
+    return now_local.date() - timedelta(days=back)
+
+
+# =========================
+# ジョブ本体
+# =========================
+def run_nightly_sync(
+    end: Optional[date] = None,
+    window_days: int = SYNC_WINDOW_DAYS,
+    user_ids: Optional[List[str]] = None,
+    workers: int = NIGHTLY_SYNC_WORKERS,
+) -> Dict:
+    """
+    全連携ユーザーを end まで差分同期する（直近 window_days 日＋ウォーターマーク以降）。
+    並列数は workers、呼び出し数/秒は共有レート制限（utils.caromil.calomeal_limiter）、
+    開始時刻はユーザーごとにジッタを入れて Calomeal への同時到着を散らす。
+    """
+    end = end or last_closed_day()
+    uids = user_ids if user_ids is not None else list_token_user_ids()
+
+    def _sync_user(uid: str) -> Dict:
+        time.sleep(random.uniform(0, NIGHTLY_SYNC_JITTER_SEC))
+        return sync_user_incremental(uid, end, window_days=window_days)
+
+    totals = {
+        "end": end.isoformat(), "window_days": window_days, "users": len(uids), "failed_users": 0,
+        "calls": 0, "errors": 0, "intake_written": 0, "metrics_written": 0, "unchanged": 0,
+    }
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="nightly-sync") as ex:
+        for fut in as_completed([ex.submit(_sync_user, u) for u in uids]):
+            r = fut.result()
+            totals["calls"] += r["calls"]
+            totals["errors"] += r["errors"]
+            for kind in ("intake", "metrics"):
+                if kind in r:
+                    totals[f"{kind}_written"] += r[kind]["written"]
+                    totals["unchanged"] += r[kind]["unchanged"]
+            if r["errors"]:
+                totals["failed_users"] += 1
+    return totals
+
+
+def run_maintenance() -> Dict:
+    return {
+        "partitions_created": ensure_request_partitions(),
+        "activity_summary_rows": rollover_activity_summary(),
+    }
+
+
+# =========================
+# スケジューラ
+# =========================
+@dataclass
+class Job:
+    name: str
+    hour: int                      # SCHEDULER_TZ での実行時刻（時）
+    fn: Callable[[], Dict]
+    last_run_day: Optional[date] = field(default=None)
+
+
+def run_job(name: str, fn: Callable[[], Dict], not_run_since: Optional[datetime] = None) -> Optional[Dict]:
+    """
+    advisory lock を取れたら実行して sync_runs に記録する。
+    他プロセスが実行中、または not_run_since 以降に他プロセスが実行済みなら何もせず None。
+    """
+    lock_key = crc32(f"scheduler:{name}".encode("utf-8"))
+    # ロックはセッション単位なので AUTOCOMMIT の専用接続で持つ（ジョブ中に idle in transaction を作らない）
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": lock_key}).scalar():
+            logger.info("job skipped: locked elsewhere", extra={"job": name})
+            return None
+        try:
+            if not_run_since is not None:
+                last = last_sync_run_started(name)
+                if last is not None and last >= not_run_since:
+                    return None
+            run_id = start_sync_run(name)
+            try:
+                stats = fn()
+            except Exception as e:
+                logger.exception("job failed", extra={"job": name})
+                finish_sync_run(run_id, "error", {"error": str(e)})
+                return {"status": "error", "error": str(e)}
+            status = "partial" if stats.get("errors") else "ok"
+            finish_sync_run(run_id, status, stats)
+            logger.info("job done", extra={"job": name, "status": status, **stats})
+            return {"status": status, **stats}
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": lock_key})
+
+
+class Scheduler:
+    def __init__(self, jobs: List[Job]):
+        self.jobs = {j.name: j for j in jobs}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self._thread.start()
+        logger.info("scheduler started", extra={"jobs": list(self.jobs), "tz": SCHEDULER_TZ})
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(TICK_SEC):
+            now = _now_local()
+            for job in self.jobs.values():
+                # 1日1回・指定時刻以降の最初の tick で実行。
+                # 同時実行は advisory lock、他プロセスが今日すでに実行したかは sync_runs で判定
+                if now.hour >= job.hour and job.last_run_day != now.date():
+                    job.last_run_day = now.date()
+                    due = now.replace(hour=job.hour, minute=0, second=0, microsecond=0)
+                    try:
+                        run_job(job.name, job.fn, not_run_since=due)
+                    except Exception:
+                        logger.exception("scheduler tick failed", extra={"job": job.name})
+
+    def run_now(self, name: str) -> threading.Thread:
+        """手動実行（バックグラウンド）"""
+        job = self.jobs[name]
+        t = threading.Thread(target=run_job, args=(job.name, job.fn), name=f"job-{name}", daemon=True)
+        t.start()
+        return t
+
+
+scheduler = Scheduler([
+    Job("nightly_sync", NIGHTLY_SYNC_HOUR, run_nightly_sync),
+    Job("maintenance", MAINTENANCE_HOUR, run_maintenance),
+])
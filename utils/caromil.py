@@ -1,15 +1,27 @@
 # utils/caromil.py
 import json
+import logging
+import os
 import re
+import threading
+import time
 import requests
 from datetime import datetime, timedelta, date as date_cls
 from dateutil import parser  # pip install python-dateutil
 
 from utils.db import (
+    SessionLocal,
     get_tokens, update_tokens,
     upsert_nutrition_daily,
+    upsert_metrics_daily,
+    new_upsert_counts,
 )
 from utils.env_utils import CALOMEAL_CLIENT_ID, CALOMEAL_CLIENT_SECRET
+from utils.range_planner import planner, window_days_of
+from utils.rate_limit import PRIORITY_BATCH, PRIORITY_INTERACTIVE, SharedRateLimiter
+from utils.circuit_breaker import UPSTREAM_CALOMEAL, get_breaker, is_failure_status
+
+logger = logging.getLogger(__name__)
 
 # カロミルAPIエンドポイント
 TOKEN_URL = "https://test-connect.calomeal.com/auth/accesstoken"
@@ -17,6 +29,79 @@ ANTHRO_URL = "https://test-connect.calomeal.com/api/anthropometric"
 MEAL_BASIS_URL = "https://test-connect.calomeal.com/api/meal_with_basis"
 USER_INFO_URL = "https://test-connect.calomeal.com/api/user_info"
 
+# ✅ Calomeal 用 HTTP クライアント（初回利用時に生成し、接続を使い回す）
+_http = None
+_http_lock = threading.Lock()
+
+
+def get_http() -> requests.Session:
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                _http = requests.Session()
+    return _http
+
+
+# ✅ Calomeal への全呼び出しを1つのトークンバケットで絞る（既定は Postgres 経由で全ワーカー共通）
+#   batch（バックフィル・夜間同期）は CALOMEAL_BATCH_RESERVE 個を残して待つ → Webhook 等の interactive が先に通る
+CALOMEAL_RATE_PER_SEC = float(os.getenv("CALOMEAL_RATE_PER_SEC", "5"))
+CALOMEAL_RATE_BURST = float(os.getenv("CALOMEAL_RATE_BURST", "10"))
+CALOMEAL_BATCH_RESERVE = float(os.getenv("CALOMEAL_BATCH_RESERVE", "3"))
+CALOMEAL_INTERACTIVE_MAX_WAIT_SEC = float(os.getenv("CALOMEAL_INTERACTIVE_MAX_WAIT_SEC", "10"))
+
+calomeal_limiter = SharedRateLimiter(
+    "calomeal",
+    CALOMEAL_RATE_PER_SEC,
+    burst=CALOMEAL_RATE_BURST,
+    backend=os.getenv("CALOMEAL_RATE_BACKEND", "postgres").lower(),
+    reserves={PRIORITY_BATCH: CALOMEAL_BATCH_RESERVE},
+    max_wait={PRIORITY_INTERACTIVE: CALOMEAL_INTERACTIVE_MAX_WAIT_SEC},
+)
+
+
+calomeal_breaker = get_breaker(UPSTREAM_CALOMEAL)
+
+
+def _calomeal_post(url: str, **kwargs) -> requests.Response:
+    """
+    Calomeal への POST は必ずここを通す（ブレーカ → レート制限 → 送信）。
+    Calomeal が落ちている間は CircuitOpenError を即座に送出する（30秒のタイムアウトを待たない）。
+    """
+    calomeal_breaker.before_call()
+    try:
+        calomeal_limiter.acquire()
+    except Exception:
+        calomeal_breaker.release()
+        raise
+    try:
+        resp = get_http().post(url, **kwargs)
+    except requests.RequestException:
+        calomeal_breaker.record(False)
+        raise
+    calomeal_breaker.record(not is_failure_status(resp.status_code))
+    return resp
+
+
+class CalomealAPIError(RuntimeError):
+    """Calomeal が 200 以外を返した（status_code で 5xx / 413 などを判定できる）"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _observe_range(endpoint: str, start_date: str, end_date: str, t0: float, resp) -> None:
+    """期間取得の所要時間とサイズを range_planner に渡す（窓サイズの学習用）"""
+    try:
+        days = window_days_of(
+            datetime.strptime(to_slash_date(start_date)[:10], "%Y/%m/%d").date(),
+            datetime.strptime(to_slash_date(end_date)[:10], "%Y/%m/%d").date(),
+        )
+    except ValueError:
+        return
+    planner.observe(endpoint, days, time.monotonic() - t0, len(resp.content))
+
 
 def to_slash_date(date_str: str) -> str:
     """YYYY-MM-DD → YYYY/MM/DD に変換（Calomeal要件）"""
@@ -48,8 +133,8 @@ def get_access_token(user_id: str, *, force_refresh: bool = False) -> str:
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-    print("🔁 トークンリフレッシュ開始")
-    resp = requests.post(TOKEN_URL, headers=headers, data=data, timeout=30)
+    logger.info("calomeal token refresh start", extra={"user_id": user_id})
+    resp = _calomeal_post(TOKEN_URL, headers=headers, data=data, timeout=30)
     if resp.status_code != 200:
         raise RuntimeError(f"トークン更新失敗: {resp.status_code} - {resp.text}")
 
@@ -59,7 +144,7 @@ def get_access_token(user_id: str, *, force_refresh: bool = False) -> str:
     new_expires_at = datetime.utcnow() + timedelta(seconds=tokens.get("expires_in", 86400))
 
     update_tokens(user_id, new_access_token, new_refresh_token, new_expires_at)
-    print("✅ アクセストークン更新成功")
+    logger.info("calomeal token refreshed", extra={"user_id": user_id})
     return new_access_token
 
 
@@ -76,23 +161,27 @@ def get_anthropometric_data(user_id: str, start_date: str, end_date: str, unit:
         "unit": unit
     }
 
-    print("📤 anthropometric 送信:", data)
-    resp = requests.post(ANTHRO_URL, headers=headers, data=data, timeout=30)
+    logger.debug("anthropometric request", extra={"user_id": user_id, "payload": data})
+    t0 = time.monotonic()
+    resp = _calomeal_post(ANTHRO_URL, headers=headers, data=data, timeout=30)
 
     if resp.status_code == 200:
-        print("✅ anthropometric 取得成功")
+        logger.debug("anthropometric ok", extra={"user_id": user_id})
+        _observe_range("anthropometric", start_date, end_date, t0, resp)
         return resp.json()
     if resp.status_code == 401:
-        print("⚠️ トークン期限/権限問題。強制リフレッシュして再試行")
+        logger.warning("calomeal 401, force refresh and retry", extra={"user_id": user_id})
         # ★ 変更点: 強制リフレッシュ
         access_token = get_access_token(user_id, force_refresh=True)
         headers["Authorization"] = f"Bearer {access_token}"
-        retry = requests.post(ANTHRO_URL, headers=headers, data=data, timeout=30)
+        t0 = time.monotonic()
+        retry = _calomeal_post(ANTHRO_URL, headers=headers, data=data, timeout=30)
         if retry.status_code == 200:
-            print("✅ 再試行成功")
+            logger.info("calomeal retry ok", extra={"user_id": user_id})
+            _observe_range("anthropometric", start_date, end_date, t0, retry)
             return retry.json()
-        raise RuntimeError(f"anthropometric retry failed: {retry.status_code} - {retry.text}")
-    raise RuntimeError(f"anthropometric error: {resp.status_code} - {resp.text}")
+        raise CalomealAPIError(f"anthropometric retry failed: {retry.status_code} - {retry.text}", retry.status_code)
+    raise CalomealAPIError(f"anthropometric error: {resp.status_code} - {resp.text}", resp.status_code)
 
 
 def get_meal_with_basis(user_id: str, start_date: str, end_date: str):
@@ -107,23 +196,27 @@ def get_meal_with_basis(user_id: str, start_date: str, end_date: str):
         "end_date": to_slash_date(end_date)
     }
 
-    print("📤 meal_with_basis 送信:", data)
-    resp = requests.post(MEAL_BASIS_URL, headers=headers, data=data, timeout=30)
+    logger.debug("meal_with_basis request", extra={"user_id": user_id, "payload": data})
+    t0 = time.monotonic()
+    resp = _calomeal_post(MEAL_BASIS_URL, headers=headers, data=data, timeout=30)
 
     if resp.status_code == 200:
-        print("✅ meal_with_basis 取得成功")
+        logger.debug("meal_with_basis ok", extra={"user_id": user_id})
+        _observe_range("meal_with_basis", start_date, end_date, t0, resp)
         return resp.json()
     if resp.status_code == 401:
-        print("⚠️ トークン期限/権限問題。強制リフレッシュして再試行")
+        logger.warning("calomeal 401, force refresh and retry", extra={"user_id": user_id})
         # ★ 変更点: 強制リフレッシュ
         access_token = get_access_token(user_id, force_refresh=True)
         headers["Authorization"] = f"Bearer {access_token}"
-        retry = requests.post(MEAL_BASIS_URL, headers=headers, data=data, timeout=30)
+        t0 = time.monotonic()
+        retry = _calomeal_post(MEAL_BASIS_URL, headers=headers, data=data, timeout=30)
         if retry.status_code == 200:
-            print("✅ 再試行成功")
+            logger.info("calomeal retry ok", extra={"user_id": user_id})
+            _observe_range("meal_with_basis", start_date, end_date, t0, retry)
             return retry.json()
-        raise RuntimeError(f"meal_with_basis retry failed: {retry.status_code} - {retry.text}")
-    raise RuntimeError(f"meal_with_basis error: {resp.status_code} - {resp.text}")
+        raise CalomealAPIError(f"meal_with_basis retry failed: {retry.status_code} - {retry.text}", retry.status_code)
+    raise CalomealAPIError(f"meal_with_basis error: {resp.status_code} - {resp.text}", resp.status_code)
 
 
 def get_user_info(user_id: str) -> dict:
@@ -133,18 +226,18 @@ def get_user_info(user_id: str) -> dict:
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    resp = requests.post(USER_INFO_URL, headers=headers, timeout=30)
+    resp = _calomeal_post(USER_INFO_URL, headers=headers, timeout=30)
     if resp.status_code == 200:
         return resp.json()
     if resp.status_code == 401:
         # ★ 変更点: 強制リフレッシュで再試行
         access_token = get_access_token(user_id, force_refresh=True)
         headers["Authorization"] = f"Bearer {access_token}"
-        retry = requests.post(USER_INFO_URL, headers=headers, timeout=30)
+        retry = _calomeal_post(USER_INFO_URL, headers=headers, timeout=30)
         if retry.status_code == 200:
             return retry.json()
-        raise RuntimeError(f"user_info retry failed: {retry.status_code} - {retry.text}")
-    raise RuntimeError(f"user_info error: {resp.status_code} - {resp.text}")
+        raise CalomealAPIError(f"user_info retry failed: {retry.status_code} - {retry.text}", retry.status_code)
+    raise CalomealAPIError(f"user_info error: {resp.status_code} - {resp.text}", resp.status_code)
 
 
 # ============================================================
@@ -179,6 +272,13 @@ def _pick(lst_json: dict) -> list:
     return []
 
 
+def _has_meal_with_basis(lst_json) -> bool:
+    """meal_with_basis の配列を含む（＝認識できる形式。空配列なら「記録なし」と判断してよい）か"""
+    if isinstance(lst_json, dict) and isinstance(lst_json.get("result"), dict):
+        lst_json = lst_json["result"]
+    return isinstance(lst_json, dict) and isinstance(lst_json.get("meal_with_basis"), list)
+
+
 def _extract_breakdown(day_obj: dict) -> dict | None:
     """
     Calomealの1日分オブジェクトから「朝/昼/夜/間食」のカロリー・PFC内訳を抽出。
@@ -300,35 +400,125 @@ def _parse_date(dstr: str) -> date_cls | None:
         return None
 
 
+# range_planner のエンドポイント名（保存関数ごとにどの API の窓サイズを使うか）
+INTAKE_RANGE_ENDPOINT = "meal_with_basis"
+METRICS_RANGE_ENDPOINT = "anthropometric"
+
+
 def save_intake_breakdown(user_id: str, start_date: str, end_date: str) -> dict:
     """
     Calomeal meal_with_basis を取得し、日合計＋meals_breakdown を user_nutrition_daily に保存する。
-    返り値: {"written": n, "empty": m}
+    レスポンスに無い日（食事記録なし）も期間内は NULL 行として保存する（取得済みの印。欠損検出で再取得しない）。
+    ただし meal_with_basis を含まない（形式が違う・200 で返ったエラー等）レスポンスでは何も書かない
+    （既存の値を NULL で消さないため）。
+    返り値: {"written": n, "empty": m, "inserted": i, "updated": u, "unchanged": k}
+    （written = inserted + updated + unchanged。empty = NULL 行にした日数＋日付を読めなかった要素数。値が同じ日は UPDATE しない）
     """
     payload = get_meal_with_basis(user_id, start_date, end_date)
+    if not _has_meal_with_basis(payload):
+        logger.warning("meal_with_basis missing in response; nothing written",
+                       extra={"user_id": user_id, "start": start_date, "end": end_date})
+        return {"written": 0, "empty": 0, **new_upsert_counts()}
     days = _pick(payload)
-    if not days:
-        return {"written": 0, "empty": 0}
+    s = datetime.fromisoformat(start_date[:10].replace("/", "-")).date()
+    e = datetime.fromisoformat(end_date[:10].replace("/", "-")).date()
 
     written, empty = 0, 0
-    for day_obj in days:
-        d = _parse_date(day_obj.get("date") or day_obj.get("day") or day_obj.get("dt"))
-        if not d:
-            empty += 1
+    counts = new_upsert_counts()
+    seen = set()
+    session = SessionLocal()
+    try:
+        for day_obj in days:
+            d = _parse_date(day_obj.get("date") or day_obj.get("day") or day_obj.get("dt"))
+            if not d:
+                empty += 1
+                continue
+
+            breakdown = _extract_breakdown(day_obj)
+            totals = _extract_totals(day_obj, breakdown)
+
+            outcome = upsert_nutrition_daily(
+                user_id=user_id,
+                d=d,
+                calorie_kcal=totals.get("calorie_kcal"),
+                protein_g=totals.get("protein_g"),
+                fat_g=totals.get("fat_g"),
+                carb_g=totals.get("carb_g"),
+                meals_breakdown=breakdown,  # JSONB で保存
+                session=session,
+            )
+            counts[outcome] += 1
+            written += 1
+            seen.add(d)
+
+        # 記録の無い日は合計 NULL・内訳 {} の行（save_body_metrics_range と同じ。消された食事の内訳も残さない）
+        d = s
+        while d <= e:
+            if d not in seen:
+                counts[upsert_nutrition_daily(user_id, d, None, None, None, None, {}, session=session)] += 1
+                written += 1
+                empty += 1
+            d += timedelta(days=1)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return {"written": written, "empty": empty, **counts}
+
+
+def _body_by_date(body_data) -> dict:
+    """anthropometric のレスポンスを {date: (weight_kg, body_fat_pc)} に（形式差を吸収）"""
+    rows = None
+    if isinstance(body_data, dict):
+        if isinstance(body_data.get("data"), list):
+            rows = body_data["data"]
+        elif isinstance(body_data.get("result"), list):
+            rows = body_data["result"]
+    elif isinstance(body_data, list):
+        rows = body_data
+    out = {}
+    for r in rows or []:
+        if not isinstance(r, dict):
             continue
+        d = _parse_date(r.get("date"))
+        if d:
+            out[d] = (
+                _to_float(r.get("weight") or r.get("weight_kg")),
+                _to_float(r.get("body_fat") or r.get("body_fat_pc") or r.get("fat")),
+            )
+    return out
 
-        breakdown = _extract_breakdown(day_obj)
-        totals = _extract_totals(day_obj, breakdown)
-
-        upsert_nutrition_daily(
-            user_id=user_id,
-            d=d,
-            calorie_kcal=totals.get("calorie_kcal"),
-            protein_g=totals.get("protein_g"),
-            fat_g=totals.get("fat_g"),
-            carb_g=totals.get("carb_g"),
-            meals_breakdown=breakdown  # JSONB で保存
-        )
-        written += 1
 
-    return {"written": written, "empty": empty}
+def save_body_metrics_range(user_id: str, start_date: str, end_date: str) -> dict:
+    """
+    Calomeal anthropometric を期間で1回取得し、期間の全日を user_metrics_daily に保存する。
+    計測の無い日も NULL 行として保存する（取得済みの印。欠損検出で再取得しない）。
+    返り値: {"written": n, "empty": 計測なしの日数, "inserted", "updated", "unchanged"}
+    """
+    body = get_anthropometric_data(user_id, start_date, end_date)
+    by_date = _body_by_date(body)
+    s = datetime.fromisoformat(start_date[:10].replace("/", "-")).date()
+    e = datetime.fromisoformat(end_date[:10].replace("/", "-")).date()
+
+    written, empty = 0, 0
+    counts = new_upsert_counts()
+    session = SessionLocal()
+    try:
+        d = s
+        while d <= e:
+            w, bf = by_date.get(d, (None, None))
+            counts[upsert_metrics_daily(user_id, d, w, bf, session=session)] += 1
+            written += 1
+            if w is None:
+                empty += 1
+            d += timedelta(days=1)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return {"written": written, "empty": empty, **counts}
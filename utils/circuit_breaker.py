@@ -0,0 +1,179 @@
+# utils/circuit_breaker.py
+"""
+外部API（Calomeal / OpenAI / LINE）ごとのサーキットブレーカ（プロセス内・スレッドセーフ）。
+- closed    … 通常。直近 window_sec 秒の失敗率が failure_rate 以上（かつ min_calls 回以上）で open へ
+- open      … open_sec 秒間は呼び出さずに CircuitOpenError を即座に送出（タイムアウトまで待たない）
+- half_open … open_sec 経過後に1本だけ試し、成功なら closed、失敗なら再び open
+失敗に数えるのはタイムアウト・接続エラー・5xx・429 など「相手が落ちている」ものだけ（4xx は数えない）。
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+BREAKER_WINDOW_SEC = float(os.getenv("BREAKER_WINDOW_SEC", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "30"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+UPSTREAM_CALOMEAL = "calomeal"
+UPSTREAM_OPENAI = "openai"
+UPSTREAM_LINE = "line"
+
+
+class CircuitOpenError(RuntimeError):
+    """ブレーカが open のため呼び出さなかった（retry_after 秒後に再試行可能）"""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} circuit open (retry after {retry_after:.0f}s)")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_sec: float = BREAKER_WINDOW_SEC,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        open_sec: float = BREAKER_OPEN_SEC,
+    ):
+        self.name = name
+        self.window_sec = window_sec
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_sec = open_sec
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._outcomes: Deque[Tuple[float, bool]] = deque()   # (monotonic, ok)
+        self._lock = threading.Lock()
+        self.rejected = 0       # open で即座に断った回数
+        self.opened_count = 0   # open になった回数
+
+    def _trim(self, now: float) -> None:
+        while self._outcomes and self._outcomes[0][0] < now - self.window_sec:
+            self._outcomes.popleft()
+
+    def _open(self, now: float) -> None:
+        self._state = OPEN
+        self._opened_at = now
+        self._probing = False
+        self.opened_count += 1
+
+    # -------------------------
+    # 呼び出し前後
+    # -------------------------
+    def before_call(self) -> None:
+        """呼んでよければ何もしない。open（または half_open で試行中）なら CircuitOpenError"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == OPEN:
+                remaining = self._opened_at + self.open_sec - now
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, 1.0)
+                self._probing = True
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if ok:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    self._probing = False
+                else:
+                    self._open(now)
+                return
+            self._outcomes.append((now, ok))
+            self._trim(now)
+            if self._state == CLOSED and not ok and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for _, o in self._outcomes if not o)
+                if failures / len(self._outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def release(self) -> None:
+        """before_call 後、相手を呼ばずにやめた時（レート制限の待ち切れ等）。half_open の試行枠を返す"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+
+    @contextmanager
+    def guard(self, is_failure: Optional[Callable[[BaseException], bool]] = None) -> Iterator[None]:
+        """
+        with breaker.guard(): を通った呼び出しの成否を記録する。
+        例外のうち is_failure（既定 is_upstream_failure）が False のもの（4xx 等）は「相手は生きている」として成功扱い。
+        """
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            self.record(not (is_failure or is_upstream_failure)(e))
+            raise
+        self.record(True)
+
+    # -------------------------
+    # 監視用
+    # -------------------------
+    def snapshot(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            calls = len(self._outcomes)
+            failures = sum(1 for _, o in self._outcomes if not o)
+            return {
+                "state": self._state,
+                "window_calls": calls,
+                "window_failures": failures,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "retry_after_sec": round(max(0.0, self._opened_at + self.open_sec - now), 1) if self._state == OPEN else 0.0,
+                "opened_count": self.opened_count,
+                "rejected": self.rejected,
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(name)
+        if b is None:
+            b = _breakers[name] = CircuitBreaker(name)
+        return b
+
+
+def breakers_snapshot() -> Dict[str, Dict]:
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {name: b.snapshot() for name, b in items}
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """
+    requests / httpx（openai）共通の判定。タイムアウト・接続エラー・5xx・429 を失敗とする。
+    status_code を持たない例外はネットワーク系とみなす（HTTP 応答が無かった）。
+    """
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        resp = getattr(exc, "response", None)
+        status = getattr(resp, "status_code", None)
+    if status is None:
+        return True
+    return status >= 500 or status == 429
+
+
+def is_failure_status(status_code: int) -> bool:
+    return status_code >= 500 or status_code == 429
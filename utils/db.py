@@ -1,22 +1,46 @@
+import json
+import logging
+import os
+import threading
+import uuid
 from datetime import datetime, timezone, date, timedelta
-from typing import List, Dict, Optional
+from decimal import Decimal
+from typing import Iterator, List, Dict, Optional, Tuple, Union
+from zoneinfo import ZoneInfo
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, TIMESTAMP, Date, Numeric,
-    func, or_, and_, exists
+    create_engine, Column, Integer, BigInteger, String, Text, TIMESTAMP, Date, Numeric, Float,
+    Boolean, Index, func, or_, and_, insert, text, literal, literal_column, tuple_, cast
 )
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY, insert as pg_insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # ✅ POSTGRES_URL に統一して読み込む
-from utils.env_utils import POSTGRES_URL
+from utils.env_utils import require_postgres_url
 
-# ✅ SQLAlchemy エンジン・セッション初期化（安定性&利便性UP）
-engine = create_engine(
-    POSTGRES_URL,
-    pool_pre_ping=True,   # 接続切れ対策
-)
-SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+logger = logging.getLogger(__name__)
+
+# ✅ SQLAlchemy エンジン・セッション（初回利用時に遅延生成：import を軽く保つ）
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker(expire_on_commit=False)
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(
+                    require_postgres_url(),
+                    pool_pre_ping=True,   # 接続切れ対策
+                )
+                _session_factory.configure(bind=_engine)
+    return _engine
+
+def SessionLocal(**kwargs):
+    """従来の sessionmaker 互換：SessionLocal() でセッションを返す"""
+    get_engine()
+    return _session_factory(**kwargs)
 
 Base = declarative_base()
 
@@ -29,7 +53,7 @@ class Request(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String)
     message = Column(Text)
-    timestamp = Column(String)  # 既存互換：ISO文字列
+    timestamp = Column(TIMESTAMP(timezone=True), nullable=False)  # ★ timestamptz（月次パーティションキー）
     request_type = Column(String)
     status = Column(String, default="pending")  # ★運用を 'pending' に統一
     advice_text = Column(Text)
@@ -90,7 +114,7 @@ class UserNutritionDaily(Base):
     updated_at    = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
 
 # =========================
-# 日次目標（スナップショット）
+# 日次目標（旧：1日1行のスナップショット。migration 6 で user_goal_intervals へ移行済み・書き込み停止）
 # =========================
 class UserGoalsDaily(Base):
     __tablename__ = "user_goals_daily"
@@ -104,59 +128,372 @@ class UserGoalsDaily(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
 
+# =========================
+# 目標（有効期間つき）：[valid_from, valid_to) 。valid_to=NULL は無期限
+#   値が変わった日で区間を閉じて新しい区間を作る。日次形式へは読み出し時に展開
+# =========================
+class UserGoalInterval(Base):
+    __tablename__ = "user_goal_intervals"
+
+    user_id    = Column(String(64), primary_key=True)
+    valid_from = Column(Date, primary_key=True)
+    valid_to   = Column(Date, nullable=True)   # 排他（この日を含まない）
+    kcal       = Column(Numeric(7, 1), nullable=True)
+    p          = Column(Numeric(6, 1), nullable=True)
+    f          = Column(Numeric(6, 1), nullable=True)
+    c          = Column(Numeric(6, 1), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+# =========================
+# ユーザー活動サマリ（有料会員一覧用・トリガで差分更新）
+# =========================
+class UserActivitySummary(Base):
+    __tablename__ = "user_activity_summary"
+    __table_args__ = (
+        Index("ix_user_activity_last_intake", text("last_intake_date DESC NULLS LAST"), "user_id"),
+    )
+
+    user_id           = Column(String(64), primary_key=True)
+    last_intake_date  = Column(Date, nullable=True)
+    days_30           = Column(Integer, nullable=False, default=0)   # 直近30日の記録日数（夜間ロールオーバーで補正）
+    has_meal_feedback = Column(Boolean, nullable=False, default=False)
+    token_expires_at  = Column(TIMESTAMP, nullable=True)  # tokens.expires_at と同じく naive
+    updated_at        = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+# =========================
+# 週次・月次ロールアップ（日次テーブルのトリガで差分再集計：migration 5）
+# =========================
+class UserRollup(Base):
+    __tablename__ = "user_rollups"
+
+    user_id      = Column(String(64), primary_key=True)
+    period_type  = Column(String(8), primary_key=True)   # week（ISO週・月曜始まり） / month
+    period_start = Column(Date, primary_key=True)
+    days_logged  = Column(Integer, nullable=False, default=0)   # 栄養の記録日数
+    avg_kcal     = Column(Numeric(7, 1))
+    avg_p        = Column(Numeric(6, 1))
+    avg_f        = Column(Numeric(6, 1))
+    avg_c        = Column(Numeric(6, 1))
+    weight_days  = Column(Integer, nullable=False, default=0)
+    avg_weight   = Column(Numeric(5, 2))
+    weight_delta = Column(Numeric(5, 2))   # 期間内の最終計測 − 最初の計測
+    goal_days    = Column(Integer, nullable=False, default=0)   # 目標 kcal ±10% 以内の日数
+    pct_in_goal  = Column(Numeric(5, 1))   # goal_days / （目標と摂取が両方ある日数）
+    updated_at   = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+# =========================
+# LLM 使用量台帳
+# =========================
+class LlmUsage(Base):
+    __tablename__ = "llm_usage"
+    __table_args__ = (
+        Index("ix_llm_usage_created_at", "created_at"),
+        Index("ix_llm_usage_user_created", "user_id", "created_at"),
+    )
+
+    id                = Column(BigInteger, primary_key=True)
+    created_at        = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    call_site         = Column(String(64), nullable=False)   # classify_request_type / generate_meal_advice など
+    model             = Column(String(64), nullable=True)
+    prompt_tokens     = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    cached_tokens     = Column(Integer, nullable=True)
+    latency_ms        = Column(Integer, nullable=True)
+    cache_hit         = Column(Boolean, nullable=False, default=False)
+    cost_usd          = Column(Numeric(12, 6), nullable=True)
+    status            = Column(String(16), nullable=False, default="ok")  # ok / error
+    user_id           = Column(String(64), nullable=True)
+    request_id        = Column(Integer, nullable=True)
+
+# =========================
+# 同期ウォーターマーク（ユーザー×種類ごとに「どの日まで取得済みか」）
+# =========================
+class UserSyncWatermark(Base):
+    __tablename__ = "user_sync_watermarks"
+
+    user_id        = Column(String(64), primary_key=True)
+    kind           = Column(String(16), primary_key=True)   # intake / metrics
+    synced_through = Column(Date, nullable=False)            # この日まで取得済み（含む）
+    last_synced_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    last_status    = Column(String(16), nullable=False, default="ok")   # ok / error
+    last_error     = Column(Text, nullable=True)
+
+# =========================
+# 外部API用の共有トークンバケット（全ワーカー共通。utils.rate_limit.PgTokenBucket）
+# =========================
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+
+    name       = Column(String(64), primary_key=True)        # 例: calomeal
+    tokens     = Column(Float, nullable=False)               # updated_at 時点の残量
+    updated_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+# =========================
+# バッチ実行履歴（夜間同期など）
+# =========================
+class SyncRun(Base):
+    __tablename__ = "sync_runs"
+    __table_args__ = (
+        Index("ix_sync_runs_job_started", "job", text("started_at DESC")),
+    )
+
+    id          = Column(BigInteger, primary_key=True)
+    job         = Column(String(64), nullable=False)          # nightly_sync / maintenance など
+    started_at  = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    duration_ms = Column(Integer, nullable=True)
+    status      = Column(String(16), nullable=False, default="running")  # running / ok / partial / error
+    stats       = Column(JSONB, nullable=True)
+
+# =========================
+# LINE 送信のアウトボックス（状態変更と同じトランザクションで積み、services.line_dispatcher が送る）
+# =========================
+class LineOutbox(Base):
+    __tablename__ = "line_outbox"
+
+    id              = Column(BigInteger, primary_key=True)
+    to_user_id      = Column(String(64), nullable=True)            # push の宛先（multicast は NULL）
+    to_user_ids     = Column(ARRAY(Text), nullable=True)           # multicast の宛先（最大500）
+    messages        = Column(JSONB, nullable=False)                # LINE の messages 配列（最大5件）
+    retry_key       = Column(String(36), nullable=False, unique=True)  # X-Line-Retry-Key（再送しても重複配信されない）
+    request_id      = Column(Integer, nullable=True)               # 返信元の requests.id（無ければ NULL）
+    request_ids     = Column(ARRAY(Integer), nullable=True)        # multicast で返信扱いにした requests.id
+    status          = Column(String(16), nullable=False, default="pending")  # pending / sending / sent / failed
+    attempts        = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    locked_until    = Column(TIMESTAMP(timezone=True), nullable=True)    # sending の期限（過ぎたら再取得可）
+    last_error      = Column(Text, nullable=True)
+    created_at      = Column(TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    sent_at         = Column(TIMESTAMP(timezone=True), nullable=True)
+
 # =========================
 # 初期化関数
 # =========================
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    """テーブル作成（明示コマンド専用：flask init-db / scripts/init_postgres.py）"""
+    Base.metadata.create_all(bind=get_engine())
+
+# =========================
+# requests.timestamp 互換ヘルパ
+# =========================
+# 旧 String 列の naive ISO 文字列はサーバーのローカル時刻（Render では UTC）で作られていた
+REQUESTS_LEGACY_TZ = os.getenv("REQUESTS_LEGACY_TZ", "UTC")
+
+def to_request_ts(ts: Union[str, datetime, None]) -> Optional[datetime]:
+    """ISO文字列 / naive / aware datetime を aware datetime に揃える（naive は REQUESTS_LEGACY_TZ とみなす）"""
+    if ts is None or ts == "":
+        return None
+    dt = ts if isinstance(ts, datetime) else datetime.fromisoformat(str(ts))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo(REQUESTS_LEGACY_TZ))
+    return dt
+
+def to_request_local(ts: Union[str, datetime, None]) -> Optional[datetime]:
+    """旧来の「ローカル時刻」での判定（15時区切り等）用に REQUESTS_LEGACY_TZ の naive datetime へ変換"""
+    dt = to_request_ts(ts)
+    return dt.astimezone(ZoneInfo(REQUESTS_LEGACY_TZ)).replace(tzinfo=None) if dt else None
+
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
+
+def _add_months(d: date, n: int) -> date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return date(d.year + y, m + 1, 1)
+
+REQUEST_PARTITIONS_LOCK = "requests_partitions"
+
+def _utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+def _create_request_partition(c, name: str, cur: date, nxt: date) -> None:
+    """
+    1か月分のパーティションを作る。既に requests_default にその月の行があると
+    CREATE ... PARTITION OF が失敗するので、その場合は行を新テーブルへ移してから ATTACH する。
+    """
+    lo, hi = f"{cur.isoformat()} 00:00:00+00", f"{nxt.isoformat()} 00:00:00+00"
+    stray = c.execute(text(
+        "SELECT 1 FROM requests_default WHERE timestamp >= CAST(:lo AS timestamptz) AND timestamp < CAST(:hi AS timestamptz) LIMIT 1"
+    ), {"lo": lo, "hi": hi}).first()
+    if not stray:
+        c.execute(text(f"CREATE TABLE {name} PARTITION OF requests FOR VALUES FROM ('{lo}') TO ('{hi}')"))
+        return
+    c.execute(text(f"CREATE TABLE {name} (LIKE requests INCLUDING DEFAULTS)"))
+    moved = c.execute(text(f"""
+        WITH m AS (
+            DELETE FROM requests_default
+            WHERE timestamp >= CAST(:lo AS timestamptz) AND timestamp < CAST(:hi AS timestamptz)
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM m
+    """), {"lo": lo, "hi": hi}).rowcount
+    c.execute(text(f"ALTER TABLE requests ATTACH PARTITION {name} FOR VALUES FROM ('{lo}') TO ('{hi}')"))
+    logger.warning("request partition created from default partition rows", extra={"partition": name, "moved": moved})
+
+def ensure_request_partitions(
+    conn=None, months_ahead: int = 3, since: Optional[date] = None, until: Optional[date] = None,
+) -> List[str]:
+    """
+    requests の月次パーティション（requests_yYYYYmMM）を since の月〜until の月（既定: 当月+months_ahead）まで作成する。
+    月の境界は UTC。パーティション化前（マイグレーション未適用）なら何もしない。作成したテーブル名を返す。
+    同時実行は advisory lock で直列化する（夜間メンテ・migrate・save_request のオンデマンド作成）。
+    """
+    def _run(c) -> List[str]:
+        kind = c.execute(text("SELECT relkind FROM pg_class WHERE relname = 'requests' AND relkind IN ('r', 'p')")).scalar()
+        if kind != "p":
+            return []
+        c.execute(text("SELECT pg_advisory_xact_lock(hashtext(:k))"), {"k": REQUEST_PARTITIONS_LOCK})
+        created = []
+        today = _utc_today()
+        cur = _month_start(since or today)
+        last = _month_start(until) if until else _add_months(_month_start(today), months_ahead)
+        while cur <= last:
+            nxt = _add_months(cur, 1)
+            name = f"requests_y{cur.year:04d}m{cur.month:02d}"
+            exists_ = c.execute(text("SELECT 1 FROM pg_class WHERE relname = :n"), {"n": name}).first()
+            if not exists_:
+                _create_request_partition(c, name, cur, nxt)
+                created.append(name)
+            cur = nxt
+        return created
+
+    if conn is not None:
+        return _run(conn)
+    with get_engine().begin() as c:
+        created = _run(c)
+    if created:
+        logger.info("request partitions created", extra={"partitions": created})
+    return created
+
+# save_request 用：このプロセスで存在を確認済みの月（月初, UTC）
+_request_months_ready: set = set()
+_request_months_lock = threading.Lock()
+
+def ensure_request_partition_for(ts: datetime) -> None:
+    """
+    ts の月のパーティションが無ければ作る（夜間メンテが動いていなくても requests_default に落ちないように）。
+    確認はプロセスごとに月1回だけ。
+    """
+    month = _month_start(ts.astimezone(timezone.utc).date())
+    if month in _request_months_ready:
+        return
+    with _request_months_lock:
+        if month in _request_months_ready:
+            return
+        ensure_request_partitions(since=month, until=month)
+        _request_months_ready.add(month)
+
+# =========================
+# requests 変更通知（LISTEN/NOTIFY）
+# =========================
+REQUEST_EVENTS_CHANNEL = "requests_events"
+
+def notify_request_event(session, request_id: int, event: str, status: Optional[str] = None, user_id: Optional[str] = None) -> None:
+    """
+    pg_notify で requests の変更を通知する。呼び出し元のトランザクションが commit された時だけ配信される。
+    event: created / updated / status
+    """
+    payload = json.dumps({"id": request_id, "event": event, "status": status, "user_id": user_id}, ensure_ascii=False)
+    session.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": REQUEST_EVENTS_CHANNEL, "payload": payload})
+
+def notify_request_events(session, events: List[Dict]) -> None:
+    """
+    notify_request_event の複数件版（pg_notify を1文でまとめて発行）。
+    events: [{"id", "event", "status", "user_id"}, ...]
+    """
+    if not events:
+        return
+    payloads = [
+        json.dumps({"id": e["id"], "event": e["event"], "status": e.get("status"), "user_id": e.get("user_id")}, ensure_ascii=False)
+        for e in events
+    ]
+    session.execute(
+        text("SELECT pg_notify(:ch, p) FROM unnest(CAST(:payloads AS text[])) AS p"),
+        {"ch": REQUEST_EVENTS_CHANNEL, "payloads": payloads},
+    )
+
+def get_request_row(request_id: int) -> Optional[Dict]:
+    """/get-unreplied と同じ形で1件返す（ユーザー名を同梱）"""
+    session = SessionLocal()
+    try:
+        row = session.execute(text("""
+            SELECT r.id, r.user_id, COALESCE(u.name, '') AS user_name, r.message,
+                   r.request_type, r.timestamp, r.advice_text, r.status
+            FROM requests r
+            LEFT JOIN user_profile u ON u.user_id = r.user_id
+            WHERE r.id = :id
+        """), {"id": request_id}).first()
+        if not row:
+            return None
+        return {
+            "id": row.id,
+            "user_id": row.user_id,
+            "user_name": row.user_name or "",
+            "message": row.message,
+            "request_type": row.request_type,
+            "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+            "advice_text": row.advice_text,
+            "status": row.status,
+        }
+    finally:
+        session.close()
 
 # =========================
 # requests 関連関数
 # =========================
 def save_request(data: dict) -> int:
+    ts = to_request_ts(data.get("timestamp")) or datetime.now(timezone.utc)
+    ensure_request_partition_for(ts)
     session = SessionLocal()
     try:
         request = Request(
             user_id=data.get("user_id"),
             message=data.get("message"),
-            timestamp=data.get("timestamp"),
+            timestamp=ts,
             request_type=data.get("request_type"),
             status=data.get("status", "pending"),
         )
         session.add(request)
+        session.flush()
+        new_id = request.id
+        notify_request_event(session, new_id, "created", status=request.status, user_id=request.user_id)
         session.commit()
-        session.refresh(request)
-        return request.id
+        return new_id
     finally:
         session.close()
 
-def get_unreplied_requests():
+def get_unreplied_requests(since_days: Optional[int] = None):
+    """since_days を指定すると直近のパーティションだけを走査する"""
     session = SessionLocal()
     try:
-        return (
+        qry = (
             session.query(Request)
             .filter(Request.status == "pending")
             .filter(Request.advice_text == None)
-            .all()
         )
+        if since_days:
+            qry = qry.filter(Request.timestamp >= datetime.now(timezone.utc) - timedelta(days=since_days))
+        return qry.all()
     finally:
         session.close()
 
-def update_advice_text(user_id: str, timestamp: str, advice_text: str):
+def update_advice_text(user_id: str, timestamp: Union[str, datetime], advice_text: str):
+    """timestamp は旧来の ISO 文字列でも datetime でも可"""
     session = SessionLocal()
     try:
         request = (
             session.query(Request)
             .filter(Request.user_id == user_id)
-            .filter(Request.timestamp == timestamp)
+            .filter(Request.timestamp == to_request_ts(timestamp))
             .first()
         )
         if request:
             request.advice_text = advice_text
+            notify_request_event(session, request.id, "updated", status=request.status, user_id=request.user_id)
             session.commit()
-            print(f"✅ advice_text 更新完了: {user_id} @ {timestamp}")
+            logger.info("advice_text updated", extra={"user_id": user_id, "timestamp": str(timestamp)})
         else:
-            print("⚠️ 該当レコードが見つかりませんでした")
+            logger.warning("advice_text target not found", extra={"user_id": user_id, "timestamp": str(timestamp)})
     finally:
         session.close()
 
@@ -167,10 +504,11 @@ def update_request_with_advice(request_id: int, advice_text: str, status: str =
         if request:
             request.advice_text = advice_text
             request.status = status
+            notify_request_event(session, request.id, "updated", status=status, user_id=request.user_id)
             session.commit()
-            print(f"✅ Request更新完了: id={request_id}, status={status}")
+            logger.info("request updated", extra={"request_db_id": request_id, "status": status})
         else:
-            print(f"⚠️ 該当リクエストが見つかりませんでした: id={request_id}")
+            logger.warning("request not found", extra={"request_db_id": request_id})
     finally:
         session.close()
 
@@ -184,6 +522,14 @@ def get_tokens(user_id: str):
     finally:
         session.close()
 
+def list_token_user_ids() -> List[str]:
+    """Calomeal 連携済み（tokens に行がある）ユーザーID一覧"""
+    session = SessionLocal()
+    try:
+        return [r[0] for r in session.query(Token.user_id).order_by(Token.user_id.asc()).all()]
+    finally:
+        session.close()
+
 def save_tokens(user_id: str, access_token: str, refresh_token: str, expires_at: datetime):
     session = SessionLocal()
     try:
@@ -279,25 +625,42 @@ def set_user_goals_json(user_id: str, goals: dict) -> None:
 
 # =========================
 # 内部：UPSERTステートメント実行ヘルパ
+#   値が同じなら UPDATE しない（ON CONFLICT ... WHERE IS DISTINCT FROM）→ updated_at は実際の変更時だけ動く
+#   戻り値は "inserted" / "updated" / "unchanged"（RETURNING (xmax = 0) で判定）
 # =========================
-def _exec_upsert_metrics_daily(session, user_id: str, d: date, weight_kg: Optional[float], body_fat_pc: Optional[float]):
+UPSERT_OUTCOMES = ("inserted", "updated", "unchanged")
+
+def _upsert_outcome(result) -> str:
+    row = result.first()
+    if row is None:
+        return "unchanged"  # 衝突したが WHERE で更新が抑止された
+    return "inserted" if row.inserted else "updated"
+
+def new_upsert_counts() -> Dict[str, int]:
+    return {k: 0 for k in UPSERT_OUTCOMES}
+
+def _exec_upsert_metrics_daily(session, user_id: str, d: date, weight_kg: Optional[float], body_fat_pc: Optional[float]) -> str:
     now = datetime.now(timezone.utc)
-    stmt = pg_insert(UserMetricsDaily).values(
+    ins = pg_insert(UserMetricsDaily).values(
         user_id=user_id, date=d,
         weight_kg=weight_kg, body_fat_pc=body_fat_pc,
         created_at=now, updated_at=now
-    ).on_conflict_do_update(
-        index_elements=[UserMetricsDaily.user_id, UserMetricsDaily.date],
-        set_={"weight_kg": weight_kg, "body_fat_pc": body_fat_pc, "updated_at": now}
     )
-    session.execute(stmt)
+    stmt = ins.on_conflict_do_update(
+        index_elements=[UserMetricsDaily.user_id, UserMetricsDaily.date],
+        set_={"weight_kg": ins.excluded.weight_kg, "body_fat_pc": ins.excluded.body_fat_pc, "updated_at": now},
+        where=tuple_(UserMetricsDaily.weight_kg, UserMetricsDaily.body_fat_pc).is_distinct_from(
+            tuple_(ins.excluded.weight_kg, ins.excluded.body_fat_pc)
+        ),
+    ).returning(literal_column("xmax = 0").label("inserted"))
+    return _upsert_outcome(session.execute(stmt))
 
 def _exec_upsert_nutrition_daily(
     session, user_id: str, d: date,
     calorie_kcal: Optional[float], protein_g: Optional[float],
     fat_g: Optional[float], carb_g: Optional[float],
     meals_breakdown: Optional[dict] = None
-):
+) -> str:
     now = datetime.now(timezone.utc)
 
     values = {
@@ -325,11 +688,16 @@ def _exec_upsert_nutrition_daily(
     if "meals_breakdown" in values:
         update_set["meals_breakdown"] = ins.excluded.meals_breakdown
 
+    # 比較対象は更新する列だけ（meals_breakdown は渡された時のみ。jsonb は意味的に比較される）
+    cmp_cols = [c for c in update_set if c != "updated_at"]
     stmt = ins.on_conflict_do_update(
         index_elements=[UserNutritionDaily.user_id, UserNutritionDaily.date],
-        set_=update_set
-    )
-    session.execute(stmt)
+        set_=update_set,
+        where=tuple_(*[getattr(UserNutritionDaily, c) for c in cmp_cols]).is_distinct_from(
+            tuple_(*[getattr(ins.excluded, c) for c in cmp_cols])
+        ),
+    ).returning(literal_column("xmax = 0").label("inserted"))
+    return _upsert_outcome(session.execute(stmt))
 
 # -------------------------
 # 日次体組成 UPSERT（互換＋高速化対応）
@@ -338,20 +706,21 @@ def upsert_metrics_daily(
     user_id: str, d: date,
     weight_kg: Optional[float], body_fat_pc: Optional[float],
     session=None
-) -> None:
+) -> str:
     """
     - 既存互換: session を渡さない場合は内部でopen/commit。
     - 高速化: session を外から渡すとバルク処理で一括commit可能。
+    - 戻り値: "inserted" / "updated" / "unchanged"
     """
     if session is None:
         s = SessionLocal()
         try:
-            _exec_upsert_metrics_daily(s, user_id, d, weight_kg, body_fat_pc)
+            outcome = _exec_upsert_metrics_daily(s, user_id, d, weight_kg, body_fat_pc)
             s.commit()
+            return outcome
         finally:
             s.close()
-    else:
-        _exec_upsert_metrics_daily(session, user_id, d, weight_kg, body_fat_pc)
+    return _exec_upsert_metrics_daily(session, user_id, d, weight_kg, body_fat_pc)
 
 # -------------------------
 # 日次栄養 UPSERT（互換＋高速化対応）
@@ -362,48 +731,113 @@ def upsert_nutrition_daily(
     fat_g: Optional[float], carb_g: Optional[float],
     meals_breakdown: Optional[dict] = None,
     session=None
-) -> None:
+) -> str:
+    """戻り値: "inserted" / "updated" / "unchanged"（upsert_metrics_daily と同じ）"""
     if session is None:
         s = SessionLocal()
         try:
-            _exec_upsert_nutrition_daily(
+            outcome = _exec_upsert_nutrition_daily(
                 s, user_id, d, calorie_kcal, protein_g, fat_g, carb_g,
                 meals_breakdown=meals_breakdown
             )
             s.commit()
+            return outcome
         finally:
             s.close()
-    else:
-        _exec_upsert_nutrition_daily(
-            session, user_id, d, calorie_kcal, protein_g, fat_g, carb_g,
-            meals_breakdown=meals_breakdown
-        )
+    return _exec_upsert_nutrition_daily(
+        session, user_id, d, calorie_kcal, protein_g, fat_g, carb_g,
+        meals_breakdown=meals_breakdown
+    )
 
 # -------------------------
-# /users 用 検索（部分一致・小文字無視）
+# ユーザー検索（pg_trgm：部分一致＋類似度ランキング）
 # -------------------------
-def search_users(q: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+DEFAULT_MIN_SIMILARITY = 0.3
+
+def _escape_like(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _user_search_terms(session, q: str, min_similarity: Optional[float]):
+    """
+    (filter, score) を返す。
+    - filter: name / user_id の部分一致（LIKE）または word_similarity >= min_similarity
+      どちらも GIN(gin_trgm_ops) インデックス（ix_user_profile_*_trgm）で引ける
+    - score : 0..1 の類似度（並び順用）
+    """
+    qn = q.lower()
+    ms = DEFAULT_MIN_SIMILARITY if min_similarity is None else max(0.0, min(float(min_similarity), 1.0))
+    # <% 演算子の閾値はトランザクション内だけで変更
+    session.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :t, true)"), {"t": str(ms)})
+
+    like = f"%{_escape_like(qn)}%"
+    lname = func.lower(UserProfile.name)
+    luid = func.lower(UserProfile.user_id)
+    qlit = literal(qn)
+    flt = or_(
+        lname.like(like, escape="\\"),
+        luid.like(like, escape="\\"),
+        qlit.op("<%")(lname),
+    )
+    # 小数4桁に丸めた値で並べる（返却値とカーソルのキーを一致させるため）
+    score = func.round(cast(func.greatest(
+        func.word_similarity(qlit, lname),
+        func.similarity(qlit, luid),
+    ), Numeric), 4)
+    return flt, score
+
+def _after_name_uid(after: Dict):
+    """(name, user_id) 昇順で after より後ろ"""
+    return tuple_(UserProfile.name, UserProfile.user_id) > tuple_(literal(after["name"]), literal(after["user_id"]))
+
+def _after_score(score, after: Dict, tail):
+    """score 降順 → tail で after より後ろ"""
+    sv = Decimal(str(after.get("score") or 0))
+    return or_(score < sv, and_(score == sv, tail))
+
+# -------------------------
+# /users 用 検索（部分一致＋類似度順）
+# -------------------------
+USERS_CURSOR_KEYS = ("name", "user_id")
+USERS_SEARCH_CURSOR_KEYS = ("score", "name", "user_id")
+
+def search_users(
+    q: str, limit: int = 20, offset: int = 0,
+    min_similarity: Optional[float] = None,
+    after: Optional[Dict] = None,
+) -> List[Dict]:
+    """
+    after（デコード済みカーソル）指定時はキーセットで続きを返す（offset は無視）。
+    並び: q なし (name, user_id) / q あり (score desc, name, user_id)
+    """
     session = SessionLocal()
     try:
         _q = (q or "").strip()
         qry = session.query(UserProfile.user_id, UserProfile.name, UserProfile.photo_url, UserProfile.last_contact)
         if _q:
-            like = f"%{_q}%"
-            qry = qry.filter(
-                or_(
-                    func.lower(UserProfile.name).like(func.lower(like)),
-                    func.lower(UserProfile.user_id).like(func.lower(like)),
-                )
-            )
-        rows = qry.order_by(UserProfile.name.asc()).limit(limit).offset(offset).all()
-        return [
-            {
+            flt, score = _user_search_terms(session, _q, min_similarity)
+            qry = qry.add_columns(score.label("score")).filter(flt)
+            if after:
+                qry = qry.filter(_after_score(score, after, _after_name_uid(after)))
+            qry = qry.order_by(score.desc(), UserProfile.name.asc(), UserProfile.user_id.asc())
+        else:
+            if after:
+                qry = qry.filter(_after_name_uid(after))
+            qry = qry.order_by(UserProfile.name.asc(), UserProfile.user_id.asc())
+        if after:
+            offset = 0
+        rows = qry.limit(limit).offset(offset).all()
+        out = []
+        for r in rows:
+            item = {
                 "user_id": r.user_id,
                 "name": r.name,
                 "photo_url": r.photo_url,
                 "last_contact": r.last_contact.isoformat() if r.last_contact else None
-            } for r in rows
-        ]
+            }
+            if _q:
+                item["score"] = float(r.score or 0)
+            out.append(item)
+        return out
     finally:
         session.close()
 
@@ -441,17 +875,21 @@ def get_user_weights(user_id: str, start: date, end: date) -> List[Dict]:
             .order_by(UserMetricsDaily.date.asc())
             .all()
         )
-        return [
-            {
-                "date": r.date.isoformat(),
-                "weight_kg": float(r.weight_kg) if r.weight_kg is not None else None,
-                "body_fat_pc": float(r.body_fat_pc) if r.body_fat_pc is not None else None,
-            }
-            for r in rows
-        ]
+        return [_weight_row(r) for r in rows]
     finally:
         session.close()
 
+def iter_user_weights(user_id: str, start: date, end: date, batch: int = 500) -> Iterator[Dict]:
+    """get_user_weights のストリーミング版（サーバーサイドカーソルで batch 行ずつ読む）"""
+    return _iter_range(UserMetricsDaily, _weight_row, user_id, start, end, batch)
+
+def _weight_row(r) -> Dict:
+    return {
+        "date": r.date.isoformat(),
+        "weight_kg": float(r.weight_kg) if r.weight_kg is not None else None,
+        "body_fat_pc": float(r.body_fat_pc) if r.body_fat_pc is not None else None,
+    }
+
 # -------------------------
 # 期間取得（栄養）
 # -------------------------
@@ -466,97 +904,393 @@ def get_user_intake(user_id: str, start: date, end: date) -> List[Dict]:
             .order_by(UserNutritionDaily.date.asc())
             .all()
         )
-        to_float = lambda x: float(x) if x is not None else None
-        return [
-            {
-                "date": r.date.isoformat(),
-                "calorie_kcal": to_float(r.calorie_kcal),
-                "protein_g": to_float(r.protein_g),
-                "fat_g": to_float(r.fat_g),
-                "carb_g": to_float(r.carb_g),
-                "meals_breakdown": r.meals_breakdown if r.meals_breakdown is not None else None,
-            }
-            for r in rows
-        ]
+        return [_intake_row(r) for r in rows]
     finally:
         session.close()
 
+def iter_user_intake(user_id: str, start: date, end: date, batch: int = 500) -> Iterator[Dict]:
+    """get_user_intake のストリーミング版（meals_breakdown を含めてもメモリは batch 行分）"""
+    return _iter_range(UserNutritionDaily, _intake_row, user_id, start, end, batch)
+
+def _intake_row(r) -> Dict:
+    to_float = lambda x: float(x) if x is not None else None
+    return {
+        "date": r.date.isoformat(),
+        "calorie_kcal": to_float(r.calorie_kcal),
+        "protein_g": to_float(r.protein_g),
+        "fat_g": to_float(r.fat_g),
+        "carb_g": to_float(r.carb_g),
+        "meals_breakdown": r.meals_breakdown if r.meals_breakdown is not None else None,
+    }
+
 # -------------------------
-# 目標スナップショット：UPSERT（バルク）
+# 期間取得（ストリーミング共通）
+#   yield_per → stream_results（psycopg2 の名前付きカーソル）で全件をメモリに載せない
 # -------------------------
-def upsert_goals_daily_bulk(user_id: str, rows: List[Dict]) -> Dict[str, int]:
+def _iter_range(model, row_fn, user_id: str, start: date, end: date, batch: int = 500) -> Iterator[Dict]:
+    session = SessionLocal()
+    try:
+        q = (
+            session.query(model)
+            .filter(model.user_id == user_id)
+            .filter(model.date >= start)
+            .filter(model.date <= end)
+            .order_by(model.date.asc())
+            .yield_per(batch)
+        )
+        for r in q:
+            yield row_fn(r)
+    finally:
+        session.close()
+
+# -------------------------
+# 期間取得（複数ユーザー一括）
+#   user_id = ANY(:ids) の1クエリでまとめて取り、ユーザー別に振り分ける
+# -------------------------
+def _range_batch(model, row_fn, user_ids: List[str], start: date, end: date) -> Dict[str, List[Dict]]:
+    ids = list(dict.fromkeys(u for u in user_ids if u))
+    out: Dict[str, List[Dict]] = {u: [] for u in ids}
+    if not ids:
+        return out
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(model)
+            .filter(model.user_id == func.any(cast(ids, ARRAY(String))))
+            .filter(model.date >= start)
+            .filter(model.date <= end)
+            .order_by(model.user_id.asc(), model.date.asc())
+            .all()
+        )
+        for r in rows:
+            out[r.user_id].append(row_fn(r))
+        return out
+    finally:
+        session.close()
+
+def get_users_weights_batch(user_ids: List[str], start: date, end: date) -> Dict[str, List[Dict]]:
+    return _range_batch(UserMetricsDaily, _weight_row, user_ids, start, end)
+
+def get_users_intake_batch(user_ids: List[str], start: date, end: date) -> Dict[str, List[Dict]]:
+    return _range_batch(UserNutritionDaily, _intake_row, user_ids, start, end)
+
+# -------------------------
+# 目標：有効期間の書き込み
+# -------------------------
+GOAL_KEYS = ("kcal", "p", "f", "c")
+
+def _goal_values(src) -> Tuple:
+    """dict / ORM 行から比較用の (kcal, p, f, c)（小数1桁に丸め）を作る"""
+    get = src.get if isinstance(src, dict) else (lambda k: getattr(src, k))
+    out = []
+    for k in GOAL_KEYS:
+        v = get(k)
+        out.append(None if v is None else round(float(v), 1))
+    return tuple(out)
+
+def _set_goal_interval(session, user_id: str, start: date, end_excl: Optional[date], values: Tuple, now: datetime) -> Dict[str, int]:
     """
-    rows: [{"date": date, "kcal": float|None, "p": float|None, "f": float|None, "c": float|None}, ...]
+    [start, end_excl) を values にする。重なる既存区間は切り詰め/分割し、同値で隣接する区間は結合する。
+    差分だけを DELETE / INSERT する（同じ値の再同期では何も書かない）。
     """
-    if not rows:
-        return {"written": 0, "empty": 0}
+    # 同一ユーザーの区間操作を直列化（行が無い時の同時挿入も防ぐ）
+    session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:k))"), {"k": f"goal_intervals:{user_id}"})
 
-    now = datetime.now(timezone.utc)
+    q = session.query(UserGoalInterval).filter(UserGoalInterval.user_id == user_id)
+    q = q.filter(or_(UserGoalInterval.valid_to.is_(None), UserGoalInterval.valid_to >= start))
+    if end_excl is not None:
+        q = q.filter(UserGoalInterval.valid_from <= end_excl)
+    old_rows = q.all()
+    old = {(r.valid_from, r.valid_to, _goal_values(r)) for r in old_rows}
 
-    ins = pg_insert(UserGoalsDaily)
-    values = [
-        {
-            "user_id": user_id,
-            "date": r["date"],
-            "kcal": r.get("kcal"),
-            "p": r.get("p"),
-            "f": r.get("f"),
-            "c": r.get("c"),
-            "created_at": now,
-            "updated_at": now,
-        } for r in rows if r.get("date") is not None
-    ]
-    stmt = ins.values(values).on_conflict_do_update(
-        index_elements=[UserGoalsDaily.user_id, UserGoalsDaily.date],
-        set_={
-            "kcal": ins.excluded.kcal,
-            "p": ins.excluded.p,
-            "f": ins.excluded.f,
-            "c": ins.excluded.c,
-            "updated_at": now,
-        }
-    )
+    # 接している/重なっている区間を [start, end_excl) の外側だけ残す
+    segs = []
+    for f_, t_, v in old:
+        if f_ < start:
+            segs.append((f_, start if (t_ is None or t_ > start) else t_, v))
+        if end_excl is not None and (t_ is None or t_ > end_excl):
+            segs.append((max(f_, end_excl), t_, v))
+    segs.append((start, end_excl, values))
+    segs.sort(key=lambda x: x[0])
 
-    empty = sum(1 for r in rows if all(r.get(k) is None for k in ("kcal", "p", "f", "c")))
+    merged = []
+    for seg in segs:
+        if merged and merged[-1][1] == seg[0] and merged[-1][2] == seg[2]:
+            merged[-1] = (merged[-1][0], seg[1], seg[2])
+        else:
+            merged.append(seg)
+    new = set(merged)
+
+    to_delete = [r for r in old_rows if (r.valid_from, r.valid_to, _goal_values(r)) not in new]
+    to_insert = [seg for seg in merged if seg not in old]
+    for r in to_delete:
+        session.delete(r)
+    session.flush()
+    for f_, t_, v in to_insert:
+        session.add(UserGoalInterval(
+            user_id=user_id, valid_from=f_, valid_to=t_,
+            **dict(zip(GOAL_KEYS, v)), created_at=now, updated_at=now,
+        ))
+    return {"inserted": len(to_insert), "deleted": len(to_delete), "unchanged": int(not to_insert and not to_delete)}
 
+def set_goal_interval(user_id: str, start: date, end: Optional[date], goal: Dict) -> Dict[str, int]:
+    """
+    start〜end（両端含む。end=None は無期限）の目標を goal {"kcal","p","f","c"} にする。
+    戻り値: {"inserted": 追加区間数, "deleted": 削除区間数, "unchanged": 1|0}
+    """
+    end_excl = end + timedelta(days=1) if end is not None else None
     session = SessionLocal()
     try:
-        session.execute(stmt)
+        stat = _set_goal_interval(session, user_id, start, end_excl, _goal_values(goal), datetime.now(timezone.utc))
         session.commit()
+        return stat
+    except Exception:
+        session.rollback()
+        raise
     finally:
         session.close()
 
-    written = len([r for r in rows if r.get("date") is not None])
-    return {"written": written, "empty": empty}
+def upsert_goals_daily_bulk(user_id: str, rows: List[Dict]) -> Dict[str, int]:
+    """
+    互換ラッパ。rows: [{"date": date, "kcal": float|None, "p": ..., "f": ..., "c": ...}, ...]
+    連続して同じ値の日をまとめて区間として書く（1トランザクション）。
+    """
+    days = sorted((r for r in rows if r.get("date") is not None), key=lambda r: r["date"])
+    if not days:
+        return {"written": 0, "empty": 0, "intervals_inserted": 0, "intervals_deleted": 0, "unchanged_runs": 0}
+
+    runs = []  # [start, end_excl, values]
+    for r in days:
+        v = _goal_values(r)
+        if runs and runs[-1][1] == r["date"] and runs[-1][2] == v:
+            runs[-1][1] = r["date"] + timedelta(days=1)
+        else:
+            runs.append([r["date"], r["date"] + timedelta(days=1), v])
+
+    now = datetime.now(timezone.utc)
+    totals = {"inserted": 0, "deleted": 0, "unchanged": 0}
+    session = SessionLocal()
+    try:
+        for a, b, v in runs:
+            for k, n in _set_goal_interval(session, user_id, a, b, v, now).items():
+                totals[k] += n
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    empty = sum(1 for r in days if all(r.get(k) is None for k in GOAL_KEYS))
+    return {
+        "written": len(days),
+        "empty": empty,
+        "intervals_inserted": totals["inserted"],
+        "intervals_deleted": totals["deleted"],
+        "unchanged_runs": totals["unchanged"],
+    }
 
 # -------------------------
-# 目標スナップショット：取得
+# 目標：取得（区間を日次に展開。API の形は従来の1日1行のまま）
 # -------------------------
+def _goal_row(d: date, r) -> Dict:
+    to_float = lambda x: float(x) if x is not None else None
+    return {
+        "date": d.isoformat(),
+        "kcal": to_float(r.kcal),
+        "p": to_float(r.p),
+        "f": to_float(r.f),
+        "c": to_float(r.c),
+    }
+
+def iter_goals_range(user_id: str, start_d: date, end_d: date, batch: int = 500) -> Iterator[Dict]:
+    """範囲に掛かる区間だけを読み、1日ずつ展開して返す（区間数は少ないので batch は互換のため）"""
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(UserGoalInterval)
+            .filter(UserGoalInterval.user_id == user_id)
+            .filter(UserGoalInterval.valid_from <= end_d)
+            .filter(or_(UserGoalInterval.valid_to.is_(None), UserGoalInterval.valid_to > start_d))
+            .order_by(UserGoalInterval.valid_from.asc())
+            .all()
+        )
+    finally:
+        session.close()
+    for r in rows:
+        d = max(r.valid_from, start_d)
+        last = end_d if r.valid_to is None else min(end_d, r.valid_to - timedelta(days=1))
+        while d <= last:
+            yield _goal_row(d, r)
+            d += timedelta(days=1)
+
 def fetch_goals_range(user_id: str, start_d: date, end_d: date) -> List[Dict]:
+    return list(iter_goals_range(user_id, start_d, end_d))
+
+# -------------------------
+# タイムライン（体重・栄養・目標を日付で結合した密な日次行）
+# -------------------------
+def get_user_timeline(user_id: str, start: date, end: date) -> List[Dict]:
+    """
+    generate_series で日付を作り、3テーブルを LEFT JOIN する（1クエリ）。
+    記録の無い日も行を返し、値は None になる。meals_breakdown は重いので含めない。
+    """
+    session = SessionLocal()
+    try:
+        rows = session.execute(text("""
+            SELECT d::date AS date,
+                   m.weight_kg, m.body_fat_pc,
+                   n.calorie_kcal, n.protein_g, n.fat_g, n.carb_g,
+                   g.kcal AS goal_kcal, g.p AS goal_p, g.f AS goal_f, g.c AS goal_c
+            FROM generate_series(CAST(:s AS date), CAST(:e AS date), interval '1 day') AS d
+            LEFT JOIN user_metrics_daily   m ON m.user_id = :uid AND m.date = d::date
+            LEFT JOIN user_nutrition_daily n ON n.user_id = :uid AND n.date = d::date
+            LEFT JOIN user_goal_intervals  g ON g.user_id = :uid AND g.valid_from <= d::date
+                                             AND (g.valid_to IS NULL OR g.valid_to > d::date)
+            ORDER BY d
+        """), {"uid": user_id, "s": start, "e": end}).mappings().all()
+        to_float = lambda x: float(x) if x is not None else None
+        return [
+            {"date": r["date"].isoformat(), **{k: to_float(v) for k, v in r.items() if k != "date"}}
+            for r in rows
+        ]
+    finally:
+        session.close()
+
+# -------------------------
+# ロールアップ取得
+# -------------------------
+ROLLUP_PERIOD_TYPES = ("week", "month")
+
+def get_user_rollups(user_id: str, period_type: str, start: date, end: date) -> List[Dict]:
+    """start〜end に period_start が入る期間を古い順に返す（start は期間途中でも可）"""
+    if period_type not in ROLLUP_PERIOD_TYPES:
+        raise ValueError(f"unsupported period_type: {period_type}")
+    first = start - timedelta(days=start.weekday()) if period_type == "week" else _month_start(start)
     session = SessionLocal()
     try:
         rows = (
-            session.query(UserGoalsDaily)
-            .filter(UserGoalsDaily.user_id == user_id)
-            .filter(UserGoalsDaily.date >= start_d)
-            .filter(UserGoalsDaily.date <= end_d)
-            .order_by(UserGoalsDaily.date.asc())
+            session.query(UserRollup)
+            .filter(UserRollup.user_id == user_id)
+            .filter(UserRollup.period_type == period_type)
+            .filter(UserRollup.period_start >= first)
+            .filter(UserRollup.period_start <= end)
+            .order_by(UserRollup.period_start.asc())
             .all()
         )
         to_float = lambda x: float(x) if x is not None else None
         return [
             {
-                "date": r.date.isoformat(),
-                "kcal": to_float(r.kcal),
-                "p": to_float(r.p),
-                "f": to_float(r.f),
-                "c": to_float(r.c),
+                "period_start": r.period_start.isoformat(),
+                "days_logged": r.days_logged,
+                "avg_kcal": to_float(r.avg_kcal),
+                "avg_p": to_float(r.avg_p),
+                "avg_f": to_float(r.avg_f),
+                "avg_c": to_float(r.avg_c),
+                "weight_days": r.weight_days,
+                "avg_weight": to_float(r.avg_weight),
+                "weight_delta": to_float(r.weight_delta),
+                "goal_days": r.goal_days,
+                "pct_in_goal": to_float(r.pct_in_goal),
             }
             for r in rows
         ]
     finally:
         session.close()
 
+# -------------------------
+# 欠損区間の検出（全連携ユーザー × 栄養 / 体組成）
+# -------------------------
+DATA_GAP_KINDS = ("intake", "metrics")
+
+def find_data_gaps(
+    start: date, end: date,
+    user_ids: Optional[List[str]] = None,
+    kinds=DATA_GAP_KINDS,
+) -> List[Dict]:
+    """
+    tokens に連携のあるユーザーについて、start〜end の欠損日を SQL だけで求め、
+    (kind, user_id) ごとの連続区間にまとめて返す。
+      intake : 行が無い（未取得）。食事記録なしの日は save_intake_breakdown が NULL 行として保存するので欠損扱いしない
+               （NULL・空の日も取り直す厳しい基準は /backfill-intake-missing 側だけ）
+      metrics: 行が無い（未取得）。計測なしの日は NULL 行として保存済みなので欠損扱いしない
+    戻り値: [{"kind", "user_id", "start": date, "end": date, "days": int}, ...]
+    """
+    kinds = [k for k in kinds if k in DATA_GAP_KINDS]
+    if not kinds or end < start:
+        return []
+    parts = []
+    if "intake" in kinds:
+        parts.append("""
+            SELECT 'intake' AS kind, x.user_id, x.date FROM days x
+            WHERE NOT EXISTS (
+                SELECT 1 FROM user_nutrition_daily n WHERE n.user_id = x.user_id AND n.date = x.date
+            )
+        """)
+    if "metrics" in kinds:
+        parts.append("""
+            SELECT 'metrics' AS kind, x.user_id, x.date FROM days x
+            WHERE NOT EXISTS (
+                SELECT 1 FROM user_metrics_daily m WHERE m.user_id = x.user_id AND m.date = x.date
+            )
+        """)
+    user_filter = "WHERE t.user_id = ANY(:ids)" if user_ids else ""
+    sql = text(f"""
+        WITH days AS (
+            SELECT t.user_id, d::date AS date
+            FROM tokens t
+            CROSS JOIN generate_series(CAST(:s AS date), CAST(:e AS date), interval '1 day') AS d
+            {user_filter}
+        ),
+        missing AS ({" UNION ALL ".join(parts)})
+        SELECT kind, user_id, min(date) AS gap_start, max(date) AS gap_end, count(*) AS days
+        FROM (
+            -- 連続する日は date - 行番号 が同じ値になる
+            SELECT kind, user_id, date,
+                   date - CAST(row_number() OVER (PARTITION BY kind, user_id ORDER BY date) AS integer) AS grp
+            FROM missing
+        ) g
+        GROUP BY kind, user_id, grp
+        ORDER BY user_id, kind, gap_start
+    """)
+    params = {"s": start, "e": end}
+    if user_ids:
+        params["ids"] = list(user_ids)
+    session = SessionLocal()
+    try:
+        return [
+            {"kind": r.kind, "user_id": r.user_id, "start": r.gap_start, "end": r.gap_end, "days": int(r.days)}
+            for r in session.execute(sql, params)
+        ]
+    finally:
+        session.close()
+
+# -------------------------
+# 期間データのバージョン（条件付きGET用）
+# -------------------------
+RANGE_VERSION_SOURCES = {
+    "weights": ("user_metrics_daily", "date BETWEEN :s AND :e"),
+    "intake": ("user_nutrition_daily", "date BETWEEN :s AND :e"),
+    "goals": ("user_goal_intervals", "valid_from <= :e AND (valid_to IS NULL OR valid_to > :s)"),
+}
+
+def get_range_version(kind: str, user_id: str, start: date, end: date) -> Tuple[int, Optional[datetime]]:
+    """
+    (行数, max(updated_at)) を返す。どちらかが変われば内容が変わったとみなす。
+    主キー (user_id, date / valid_from) の範囲走査だけで済むので、本体取得より十分軽い。
+    """
+    table, cond = RANGE_VERSION_SOURCES[kind]
+    session = SessionLocal()
+    try:
+        row = session.execute(text(f"""
+            SELECT count(*) AS cnt, max(updated_at) AS last_updated
+            FROM {table}
+            WHERE user_id = :uid AND {cond}
+        """), {"uid": user_id, "s": start, "e": end}).first()
+        return int(row.cnt or 0), row.last_updated
+    finally:
+        session.close()
+
 # =========================
 # ★ coaching 情報の保存/取得
 # =========================
@@ -629,12 +1363,17 @@ def get_user_coaching(user_id: str) -> Optional[Dict]:
 # =========================
 # ★ 有料会員検索（厳密版）
 # =========================
+PAID_USERS_CURSOR_KEYS = ("last_intake_date", "name", "user_id")
+PAID_USERS_SEARCH_CURSOR_KEYS = ("score", "last_intake_date", "name", "user_id")
+
 def search_paid_users(
     q: str = "",
     limit: int = 50,
     offset: int = 0,
     active_days: int = 0,
-    valid_only: bool = True
+    valid_only: bool = True,
+    min_similarity: Optional[float] = None,
+    after: Optional[Dict] = None,
 ) -> List[Dict]:
     """
     定義（厳密）:
@@ -645,67 +1384,70 @@ def search_paid_users(
           b) user_nutrition_daily に1件以上の保存あり
     返却: user_id, name, photo_url, last_contact, expires_at, last_intake_date, days_30
     active_days>0 の場合、直近30日の記録日数(days_30) がその閾値以上のものに絞る
+    q 指定時は pg_trgm の類似度（min_similarity 以上 or 部分一致）で絞り、score 順に並べる
+    after（デコード済みカーソル）指定時はキーセットで続きを返す（offset は無視）
+    集計はトリガで差分更新される user_activity_summary を参照する（全件集計はしない）
     """
     session = SessionLocal()
     try:
         # 現在時刻（Token.expires_at は naive 運用なので UTC naive を使用）
         now_utc_naive = datetime.utcnow()
-        d30 = date.today() - timedelta(days=30)
-
-        # meal_feedback の実績があるか（EXISTS）
-        meal_req_exists = session.query(
-            exists().where(
-                and_(Request.user_id == UserProfile.user_id,
-                     Request.request_type == "meal_feedback")
-            )
-        ).scalar_subquery()
+        S = UserActivitySummary
 
-        # ベースクエリ：Token で連携済みユーザーのみ（JOIN）
-        # Intake は集計のため LEFT JOIN
         qry = (
             session.query(
                 UserProfile.user_id,
                 UserProfile.name,
                 UserProfile.photo_url,
                 UserProfile.last_contact,
-                Token.expires_at.label("expires_at"),
-                func.max(UserNutritionDaily.date).label("last_intake_date"),
-                func.count().filter(UserNutritionDaily.date >= d30).label("days_30")
+                S.token_expires_at.label("expires_at"),
+                S.last_intake_date.label("last_intake_date"),
+                S.days_30.label("days_30"),
             )
-            .join(Token, Token.user_id == UserProfile.user_id)  # 連携済み必須
-            .outerjoin(UserNutritionDaily, UserNutritionDaily.user_id == UserProfile.user_id)
+            .join(UserProfile, UserProfile.user_id == S.user_id)
+            .filter(S.token_expires_at.isnot(None))  # 連携済み必須
+            # 利用実績（食事分析 or intake保存）
+            .filter(or_(S.has_meal_feedback.is_(True), S.last_intake_date.isnot(None)))
         )
 
         # トークン有効性フィルタ
         if valid_only:
-            qry = qry.filter(Token.expires_at > (now_utc_naive - timedelta(minutes=5)))
+            qry = qry.filter(S.token_expires_at > (now_utc_naive - timedelta(minutes=5)))
 
-        # 利用実績（食事分析 or intake保存）フィルタ
-        qry = qry.filter(or_(meal_req_exists, UserNutritionDaily.user_id.isnot(None)))
+        # アクティブ閾値（直近30日の記録日数）
+        if isinstance(active_days, int) and active_days > 0:
+            qry = qry.filter(S.days_30 >= active_days)
 
-        # 検索
+        # 検索（pg_trgm）
         _q = (q or "").strip()
+        score = None
         if _q:
-            like = f"%{_q}%"
-            qry = qry.filter(or_(
-                func.lower(UserProfile.name).like(func.lower(like)),
-                func.lower(UserProfile.user_id).like(func.lower(like)),
-            ))
-
-        # 集計
-        qry = qry.group_by(
-            UserProfile.user_id, UserProfile.name, UserProfile.photo_url, UserProfile.last_contact, Token.expires_at
-        )
+            flt, score = _user_search_terms(session, _q, min_similarity)
+            qry = qry.add_columns(score.label("score")).filter(flt)
 
-        # アクティブ閾値（直近30日の記録日数）
-        if isinstance(active_days, int) and active_days > 0:
-            qry = qry.having(func.count().filter(UserNutritionDaily.date >= d30) >= active_days)
+        # キーセット：（score desc）→ last_intake_date desc nulls last → (name, user_id)
+        last_date = S.last_intake_date
+        if after:
+            offset = 0
+            tail = _after_name_uid(after)
+            c_date = date.fromisoformat(after["last_intake_date"]) if after.get("last_intake_date") else None
+            if c_date is None:
+                cond = and_(last_date.is_(None), tail)
+            else:
+                cond = or_(last_date < c_date, last_date.is_(None), and_(last_date == c_date, tail))
+            if score is not None:
+                cond = _after_score(score, after, cond)
+            qry = qry.filter(cond)
 
-        # 並び順：最終摂取日 desc, 名前 asc
-        qry = qry.order_by(
-            func.max(UserNutritionDaily.date).desc().nullslast(),
-            UserProfile.name.asc()
-        ).limit(limit).offset(offset)
+        # 並び順：（検索時は類似度 desc）→ 最終摂取日 desc, 名前 asc
+        order = [
+            last_date.desc().nullslast(),
+            UserProfile.name.asc(),
+            UserProfile.user_id.asc(),
+        ]
+        if score is not None:
+            order.insert(0, score.desc())
+        qry = qry.order_by(*order).limit(limit).offset(offset)
 
         rows = qry.all()
         out: List[Dict] = []
@@ -723,10 +1465,30 @@ def search_paid_users(
                 "last_intake_date": last_intake_date,
                 "days_30": int(r.days_30 or 0),
             })
+            if score is not None:
+                out[-1]["score"] = float(r.score or 0)
         return out
     finally:
         session.close()
 
+# =========================
+# ★ 活動サマリ：夜間ロールオーバー
+# =========================
+def rollover_activity_summary() -> int:
+    """
+    days_30（直近30日の記録日数）は日付が進むと古い日が窓から外れるため、
+    1日1回 user_nutrition_daily から再計算する。更新した行数を返す。
+    """
+    session = SessionLocal()
+    try:
+        res = session.execute(text("SELECT refresh_user_activity_summary()"))
+        n = int(res.scalar() or 0)
+        session.commit()
+        logger.info("activity summary rollover", extra={"rows": n})
+        return n
+    finally:
+        session.close()
+
 # =========================
 # ★ 有料会員一覧（互換ラッパ：従来呼び出し）
 # =========================
@@ -736,3 +1498,335 @@ def list_paid_users(q: str = "", limit: int = 50, offset: int = 0) -> List[Dict]
     厳密版 search_paid_users のデフォルト設定をそのまま適用。
     """
     return search_paid_users(q=q, limit=limit, offset=offset, active_days=0, valid_only=True)
+
+# =========================
+# ★ LLM 使用量台帳（書き込み・集計）
+# =========================
+def insert_llm_usage_batch(rows: List[Dict]) -> int:
+    """utils.llm_usage のバックグラウンドライタから呼ばれるバルクINSERT"""
+    if not rows:
+        return 0
+    session = SessionLocal()
+    try:
+        session.execute(insert(LlmUsage), rows)
+        session.commit()
+        return len(rows)
+    finally:
+        session.close()
+
+LLM_USAGE_GROUP_COLUMNS = {
+    "day": lambda: func.date(func.timezone("UTC", LlmUsage.created_at)),
+    "user_id": lambda: LlmUsage.user_id,
+    "call_site": lambda: LlmUsage.call_site,
+    "model": lambda: LlmUsage.model,
+}
+
+def summarize_llm_usage(
+    group_by: List[str],
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    user_id: Optional[str] = None,
+    limit: int = 200,
+) -> List[Dict]:
+    """
+    llm_usage を group_by（day / user_id / call_site / model の組み合わせ）で集計する。
+    start / end は UTC 日付（両端含む）。コストの高い順に返す。
+    """
+    dims = [g for g in group_by if g in LLM_USAGE_GROUP_COLUMNS] or ["day"]
+    session = SessionLocal()
+    try:
+        cols = [LLM_USAGE_GROUP_COLUMNS[g]().label(g) for g in dims]
+        cost = func.coalesce(func.sum(LlmUsage.cost_usd), 0)
+        qry = session.query(
+            *cols,
+            func.count().label("calls"),
+            func.count().filter(LlmUsage.status != "ok").label("errors"),
+            func.count().filter(LlmUsage.cache_hit.is_(True)).label("cache_hits"),
+            func.coalesce(func.sum(LlmUsage.prompt_tokens), 0).label("prompt_tokens"),
+            func.coalesce(func.sum(LlmUsage.completion_tokens), 0).label("completion_tokens"),
+            func.coalesce(func.sum(LlmUsage.cached_tokens), 0).label("cached_tokens"),
+            func.avg(LlmUsage.latency_ms).label("avg_latency_ms"),
+            func.percentile_cont(0.95).within_group(LlmUsage.latency_ms).label("p95_latency_ms"),
+            cost.label("cost_usd"),
+        )
+        if start is not None:
+            qry = qry.filter(LlmUsage.created_at >= datetime.combine(start, datetime.min.time(), tzinfo=timezone.utc))
+        if end is not None:
+            qry = qry.filter(LlmUsage.created_at < datetime.combine(end + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc))
+        if user_id:
+            qry = qry.filter(LlmUsage.user_id == user_id)
+
+        rows = qry.group_by(*cols).order_by(cost.desc()).limit(limit).all()
+        out: List[Dict] = []
+        for r in rows:
+            item = {}
+            for g in dims:
+                v = getattr(r, g)
+                item[g] = v.isoformat() if isinstance(v, date) else v
+            item.update({
+                "calls": int(r.calls or 0),
+                "errors": int(r.errors or 0),
+                "cache_hits": int(r.cache_hits or 0),
+                "prompt_tokens": int(r.prompt_tokens or 0),
+                "completion_tokens": int(r.completion_tokens or 0),
+                "cached_tokens": int(r.cached_tokens or 0),
+                "avg_latency_ms": round(float(r.avg_latency_ms), 1) if r.avg_latency_ms is not None else None,
+                "p95_latency_ms": round(float(r.p95_latency_ms), 1) if r.p95_latency_ms is not None else None,
+                "cost_usd": round(float(r.cost_usd or 0), 6),
+            })
+            out.append(item)
+        return out
+    finally:
+        session.close()
+
+# =========================
+# バッチ実行履歴
+# =========================
+def start_sync_run(job: str) -> int:
+    session = SessionLocal()
+    try:
+        run = SyncRun(job=job, status="running", started_at=datetime.now(timezone.utc))
+        session.add(run)
+        session.commit()
+        return run.id
+    finally:
+        session.close()
+
+def finish_sync_run(run_id: int, status: str, stats: Optional[Dict] = None) -> None:
+    session = SessionLocal()
+    try:
+        run = session.get(SyncRun, run_id)
+        if run is None:
+            return
+        now = datetime.now(timezone.utc)
+        run.finished_at = now
+        run.duration_ms = int((now - run.started_at).total_seconds() * 1000)
+        run.status = status
+        run.stats = json.loads(json.dumps(stats or {}, default=str))
+        session.commit()
+    finally:
+        session.close()
+
+def last_sync_run_started(job: str) -> Optional[datetime]:
+    session = SessionLocal()
+    try:
+        return session.query(func.max(SyncRun.started_at)).filter(SyncRun.job == job).scalar()
+    finally:
+        session.close()
+
+def list_sync_runs(job: Optional[str] = None, limit: int = 50) -> List[Dict]:
+    session = SessionLocal()
+    try:
+        q = session.query(SyncRun)
+        if job:
+            q = q.filter(SyncRun.job == job)
+        rows = q.order_by(SyncRun.started_at.desc()).limit(max(1, min(limit, 500))).all()
+        return [
+            {
+                "id": r.id,
+                "job": r.job,
+                "started_at": r.started_at.isoformat() if r.started_at else None,
+                "finished_at": r.finished_at.isoformat() if r.finished_at else None,
+                "duration_ms": r.duration_ms,
+                "status": r.status,
+                "stats": r.stats,
+            }
+            for r in rows
+        ]
+    finally:
+        session.close()
+
+# =========================
+# 同期ウォーターマーク
+# =========================
+def get_sync_watermarks(user_id: str) -> Dict[str, date]:
+    """{kind: synced_through}（未同期の kind は含まない）"""
+    session = SessionLocal()
+    try:
+        rows = session.query(UserSyncWatermark).filter(UserSyncWatermark.user_id == user_id).all()
+        return {r.kind: r.synced_through for r in rows}
+    finally:
+        session.close()
+
+def advance_sync_watermark(user_id: str, kind: str, through: date, error: Optional[str] = None) -> None:
+    """
+    成功時は synced_through を through まで進める（後退はしない）。
+    失敗時（error あり）は既存の synced_through を据え置いて状態だけ記録する
+    （行が無ければ through で作るので、呼び出し側は「確実に取得済みの日」を渡す）。
+    """
+    now = datetime.now(timezone.utc)
+    status = "error" if error else "ok"
+    ins = pg_insert(UserSyncWatermark).values(
+        user_id=user_id, kind=kind, synced_through=through,
+        last_synced_at=now, last_status=status, last_error=error,
+    )
+    set_ = {"last_synced_at": now, "last_status": status, "last_error": error}
+    if not error:
+        set_["synced_through"] = func.greatest(UserSyncWatermark.synced_through, ins.excluded.synced_through)
+    stmt = ins.on_conflict_do_update(
+        index_elements=[UserSyncWatermark.user_id, UserSyncWatermark.kind],
+        set_=set_,
+    )
+    session = SessionLocal()
+    try:
+        session.execute(stmt)
+        session.commit()
+    finally:
+        session.close()
+
+
+# =========================
+# 共有トークンバケット
+# =========================
+_TAKE_RATE_TOKENS_SQL = text("""
+    INSERT INTO rate_limit_buckets AS b (name, tokens, updated_at)
+    VALUES (:name, :burst - :n, clock_timestamp())
+    ON CONFLICT (name) DO UPDATE
+       SET tokens = LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * :rate) - :n,
+           updated_at = clock_timestamp()
+     WHERE LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * :rate) >= :n + :reserve
+    RETURNING tokens
+""")
+
+_PEEK_RATE_TOKENS_SQL = text("""
+    SELECT LEAST(:burst, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * :rate)
+    FROM rate_limit_buckets WHERE name = :name
+""")
+
+
+def take_rate_limit_tokens(name: str, rate_per_sec: float, burst: float,
+                           tokens: float = 1.0, reserve: float = 0.0) -> float:
+    """
+    rate_limit_buckets から tokens 個取る（補充計算と減算を UPDATE 1本で行うので全ワーカーで整合）。
+    残量が reserve を割る場合は取らない。取れたら 0.0、取れなければ取れるまでの概算待ち秒数を返す。
+    """
+    params = {"name": name, "rate": rate_per_sec, "burst": burst, "n": tokens, "reserve": reserve}
+    with get_engine().begin() as conn:
+        if conn.execute(_TAKE_RATE_TOKENS_SQL, params).first() is not None:
+            return 0.0
+        current = conn.execute(_PEEK_RATE_TOKENS_SQL, params).scalar() or 0.0
+    return max(0.0, (tokens + reserve - float(current)) / rate_per_sec)
+
+
+# =========================
+# LINE アウトボックス
+# =========================
+LINE_OUTBOX_CHANNEL = "line_outbox"
+
+
+def enqueue_line_push(session, to_user_id: str, messages: List[Dict], request_id: Optional[int] = None) -> int:
+    """
+    呼び出し元のセッションに送信予約を積む（commit は呼び出し元。状態変更と同じトランザクションにする）。
+    commit 時に pg_notify でディスパッチャを起こす。
+    """
+    row = LineOutbox(
+        to_user_id=to_user_id,
+        messages=messages,
+        retry_key=str(uuid.uuid4()),
+        request_id=request_id,
+        status="pending",
+        next_attempt_at=datetime.now(timezone.utc),
+    )
+    session.add(row)
+    session.flush()
+    session.execute(text("SELECT pg_notify(:ch, '')"), {"ch": LINE_OUTBOX_CHANNEL})
+    return row.id
+
+
+def enqueue_line_multicast(session, to_user_ids: List[str], messages: List[Dict],
+                           request_ids: Optional[List[int]] = None) -> int:
+    """enqueue_line_push の multicast 版（宛先は最大500。分割は呼び出し側）"""
+    row = LineOutbox(
+        to_user_ids=list(to_user_ids),
+        messages=messages,
+        retry_key=str(uuid.uuid4()),
+        request_ids=list(request_ids) if request_ids else None,
+        status="pending",
+        next_attempt_at=datetime.now(timezone.utc),
+    )
+    session.add(row)
+    session.flush()
+    session.execute(text("SELECT pg_notify(:ch, '')"), {"ch": LINE_OUTBOX_CHANNEL})
+    return row.id
+
+
+def claim_line_outbox(limit: int, lease_sec: int) -> List[Dict]:
+    """
+    送信待ち（または sending のまま期限切れ）を最大 limit 件取り、sending にして返す。
+    FOR UPDATE SKIP LOCKED なので複数ワーカー / 複数インスタンスで同時に回しても取り合わない。
+    """
+    with get_engine().begin() as conn:
+        rows = conn.execute(text("""
+            UPDATE line_outbox o
+               SET status = 'sending',
+                   attempts = o.attempts + 1,
+                   locked_until = now() + make_interval(secs => :lease)
+             WHERE o.id IN (
+                   SELECT id FROM line_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= now())
+                       OR (status = 'sending' AND locked_until < now())
+                    ORDER BY next_attempt_at, id
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+             )
+            RETURNING o.id, o.to_user_id, o.to_user_ids, o.messages, o.retry_key, o.request_id, o.attempts
+        """), {"limit": limit, "lease": lease_sec}).mappings().all()
+    return [dict(r) for r in rows]
+
+
+def mark_line_outbox_sent(outbox_id: int) -> None:
+    with get_engine().begin() as conn:
+        conn.execute(text("""
+            UPDATE line_outbox
+               SET status = 'sent', sent_at = now(), locked_until = NULL, last_error = NULL
+             WHERE id = :id
+        """), {"id": outbox_id})
+
+
+def mark_line_outbox_failed(outbox_id: int, error: str, retry_in_sec: Optional[float] = None) -> None:
+    """
+    retry_in_sec があれば pending に戻して再送予約、無ければ failed で確定。
+    確定失敗で返信元の request（multicast は request_ids 全件）があれば pending に戻す
+    （未返信一覧に再び出して手動で再送できるように）。
+    """
+    with get_engine().begin() as conn:
+        if retry_in_sec is not None:
+            conn.execute(text("""
+                UPDATE line_outbox
+                   SET status = 'pending', locked_until = NULL, last_error = :err,
+                       next_attempt_at = now() + make_interval(secs => :sec)
+                 WHERE id = :id
+            """), {"id": outbox_id, "err": error[:1000], "sec": float(retry_in_sec)})
+            return
+        row = conn.execute(text("""
+            UPDATE line_outbox
+               SET status = 'failed', locked_until = NULL, last_error = :err
+             WHERE id = :id
+            RETURNING request_id, request_ids
+        """), {"id": outbox_id, "err": error[:1000]}).first()
+        if row is None:
+            return
+        rids = list(row.request_ids or []) + ([row.request_id] if row.request_id is not None else [])
+        if not rids:
+            return
+        reverted = conn.execute(text("""
+            UPDATE requests SET status = 'pending'
+             WHERE id = ANY(:rids) AND status = 'replied'
+            RETURNING id, user_id
+        """), {"rids": rids}).all()
+        for req in reverted:
+            payload = json.dumps({"id": req.id, "event": "status", "status": "pending", "user_id": req.user_id}, ensure_ascii=False)
+            conn.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": REQUEST_EVENTS_CHANNEL, "payload": payload})
+
+
+def line_outbox_stats() -> Dict:
+    """status ごとの件数と、最も古い送信待ちの経過秒"""
+    with get_engine().connect() as conn:
+        counts = {r.status: r.n for r in conn.execute(text(
+            "SELECT status, count(*) AS n FROM line_outbox GROUP BY status"
+        ))}
+        oldest = conn.execute(text("""
+            SELECT EXTRACT(EPOCH FROM now() - min(created_at))
+            FROM line_outbox WHERE status IN ('pending', 'sending')
+        """)).scalar()
+    return {"counts": counts, "oldest_pending_sec": round(float(oldest), 1) if oldest is not None else None}
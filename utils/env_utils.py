@@ -11,9 +11,12 @@ CALOMEAL_CLIENT_ID = os.getenv("CALOMEAL_CLIENT_ID")
 CALOMEAL_CLIENT_SECRET = os.getenv("CALOMEAL_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 
-# ✅ PostgreSQL URLの存在確認
-if POSTGRES_URL is None:
-    raise ValueError("❌ POSTGRES_URL が環境変数に設定されていません。")
+# ✅ PostgreSQL URLの存在確認（import時ではなく、エンジン生成時に検証する）
+def require_postgres_url() -> str:
+    url = os.getenv("POSTGRES_URL") or POSTGRES_URL
+    if url is None:
+        raise ValueError("❌ POSTGRES_URL が環境変数に設定されていません。")
+    return url
 
 # ✅ 別ファイル用の書き換え関数（必要なら）
 def update_env_variable(file_path: str, key: str, new_value: str):
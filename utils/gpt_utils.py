@@ -1,36 +1,77 @@
 # utils/gpt_utils.py
+import logging
 import os
-import traceback
-from openai import OpenAI
-from openai._base_client import SyncHttpxClientWrapper
+import threading
+import time
+from utils.circuit_breaker import UPSTREAM_OPENAI, CircuitOpenError, get_breaker
 from utils.formatting import format_daily_report  # 整形関数
+from utils.llm_usage import record_completion  # 使用量台帳
+from utils.logging_utils import should_dump
+
+logger = logging.getLogger(__name__)
+
+_breaker = get_breaker(UPSTREAM_OPENAI)
+
+# ✅ OpenAI クライアントは初回利用時に生成（import 時の副作用なし）
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """
+    OpenAI クライアントを遅延生成して使い回す。
+    proxy 環境変数は trust_env=False で無視する（os.environ は書き換えない）。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                from openai._base_client import SyncHttpxClientWrapper
+
+                api_key = os.getenv("OPENAI_API_KEY")
+                http_client = SyncHttpxClientWrapper(
+                    base_url="https://api.openai.com/v1",
+                    headers={"Authorization": f"Bearer {api_key}"},
+                    timeout=600,
+                    follow_redirects=True,
+                    trust_env=False,  # ✅ proxies 対策
+                )
+                _client = OpenAI(api_key=api_key, http_client=http_client)
+    return _client
+
+
+# =====================================================
+# chat.completions 共通実行（使用量台帳へ記録）
+# =====================================================
+def _chat_completion(call_site: str, **kwargs):
+    """
+    chat.completions.create を実行し、トークン・レイテンシ・コストを llm_usage に記録する。
+    例外は呼び出し元へそのまま送出（失敗も status=error で記録）。
+    OpenAI が落ちている間はブレーカが CircuitOpenError を即座に送出する（status=circuit_open で記録）。
+    """
+    client = get_openai_client()
+    started = time.perf_counter()
+    try:
+        with _breaker.guard():
+            response = client.chat.completions.create(**kwargs)
+    except CircuitOpenError:
+        record_completion(call_site, kwargs.get("model"), latency_ms=0, status="circuit_open")
+        raise
+    except Exception:
+        record_completion(
+            call_site, kwargs.get("model"),
+            latency_ms=(time.perf_counter() - started) * 1000,
+            status="error",
+        )
+        raise
+    record_completion(
+        call_site, getattr(response, "model", None) or kwargs.get("model"),
+        latency_ms=(time.perf_counter() - started) * 1000,
+        usage=getattr(response, "usage", None),
+    )
+    return response
 
-# 🔍 デバッグ用：コード内容表示（Render検証用）
-print("🔍 DEBUG: gpt_utils.py 現在のコード内容表示開始")
-try:
-    with open(__file__, "r") as f:
-        lines = f.readlines()
-        for i, line in enumerate(lines[:30]):
-            print(f"{i+1:02d}: {line.rstrip()}")
-except Exception as _e:
-    # 実行環境によっては __file__ を開けない場合があるため無視
-    pass
-print("🔍 DEBUG: gpt_utils.py 現在のコード内容表示終了")
-
-# ✅ proxy変数を削除（OpenAIエラー対策）
-for proxy_key in ["HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY"]:
-    os.environ.pop(proxy_key, None)
-
-# ✅ OpenAI APIキー取得
-api_key = os.getenv("OPENAI_API_KEY")
-
-# ✅ 明示的なクライアント指定（proxies対策）
-http_client = SyncHttpxClientWrapper(
-    base_url="https://api.openai.com/v1",
-    headers={"Authorization": f"Bearer {api_key}"},
-    timeout=600,
-    follow_redirects=True,
-)
 
 # =====================================================
 # 分類関数
@@ -46,8 +87,7 @@ def classify_request_type(message_text: str) -> str:
         - other（上記に該当しないもの）
     """
     try:
-        print("✅ gpt_utils.py: classify_request_type 開始")
-        print("📨 message_text:", message_text)
+        logger.debug("classify_request_type start", extra={"message_len": len(message_text or "")})
 
         # 固定分類（キーワードマッチ）
         if "食事分析" in message_text:
@@ -58,8 +98,8 @@ def classify_request_type(message_text: str) -> str:
             return "workout_question"
 
         # GPTによる分類
-        client = OpenAI(http_client=http_client)
-        response = client.chat.completions.create(
+        response = _chat_completion(
+            "classify_request_type",
             model="gpt-4o",
             messages=[
                 {
@@ -78,26 +118,26 @@ def classify_request_type(message_text: str) -> str:
         )
 
         category = response.choices[0].message.content.strip()
-        print("✅ 分類結果:", category)
+        logger.info("classified", extra={"request_type": category})
         return category
 
-    except Exception as e:
-        print("❌ classify_request_type error:", e)
-        traceback.print_exc()
+    except Exception:
+        logger.exception("classify_request_type error")
         return "other"
 
 
 # =====================================================
 # 共通プロンプト実行関数
 # =====================================================
-def generate_advice_by_prompt(prompt: str) -> str:
+def generate_advice_by_prompt(prompt: str, call_site: str = "generate_advice_by_prompt") -> str:
     """
     プロンプトを元に、GPTからアドバイス文を生成
+    call_site は使用量台帳での呼び出し元名
     """
     try:
-        print("🧠 generate_advice_by_prompt 開始")
-        client = OpenAI(http_client=http_client)
-        response = client.chat.completions.create(
+        logger.debug("generate_advice_by_prompt start", extra={"call_site": call_site})
+        response = _chat_completion(
+            call_site,
             model="gpt-4o",
             messages=[
                 {
@@ -114,81 +154,92 @@ def generate_advice_by_prompt(prompt: str) -> str:
             max_tokens=500,
         )
         advice = response.choices[0].message.content.strip()
-        print("✅ アドバイス生成成功")
+        logger.info("advice generated", extra={"call_site": call_site, "advice_len": len(advice)})
         return advice
 
-    except Exception as e:
-        print("❌ アドバイス生成エラー:", e)
-        traceback.print_exc()
+    except CircuitOpenError:
+        # 障害中は定型文で埋めずに呼び出し元へ（receive_request は pending のまま残す）
+        raise
+    except Exception:
+        logger.exception("advice generation error", extra={"call_site": call_site})
         return "アドバイスの生成に失敗しました。"
 
 
 # =====================================================
 # タイプ別アドバイス生成関数（キーdump＋失敗時のフォールバック出力あり）
 # =====================================================
-def generate_meal_advice(meal_data: dict, body_data: dict, date_str: str) -> str:
-    """
-    食事データ（meal_with_basis）と体組成データ（anthropometric）から食事アドバイスを生成
-    - meal_data, body_data はAPIの生JSON
-    - date_str は 'YYYY-MM-DD' or 'YYYY/MM/DD'（/receive-request の timestamp から）
-    """
-    # --- 形状ダンプ ---
+def _payload_shapes(meal_data, body_data) -> dict:
+    """meal_with_basis / anthropometric の形状（キー一覧など）をまとめる（デバッグ用）"""
+    shapes = {}
     try:
         md0 = meal_data[0] if isinstance(meal_data, list) and meal_data else meal_data
         if isinstance(md0, dict):
-            print("🔑 meal_with_basis keys:", list(md0.keys())[:50])
-            print("🗓 meal_with_basis.date:", md0.get("date") or md0.get("target_date"))
+            shapes["meal_keys"] = list(md0.keys())[:50]
+            shapes["meal_date"] = md0.get("date") or md0.get("target_date")
             for k in ("meal_histories", "meals", "records", "foods"):
                 if k in md0 and isinstance(md0[k], list):
-                    print(f"🍽 meals candidate '{k}' length:", len(md0[k]))
+                    shapes[f"meal_{k}_len"] = len(md0[k])
                     if md0[k]:
-                        print(f"🍽 {k}[0] keys:", list(md0[k][0].keys())[:50])
+                        shapes[f"meal_{k}0_keys"] = list(md0[k][0].keys())[:50]
                     break
             if "basis" in md0:
-                print("🎯 basis keys:", list(md0["basis"].keys()))
+                shapes["basis_keys"] = list(md0["basis"].keys())
                 if isinstance(md0["basis"].get("all"), dict):
-                    print("🎯 basis.all keys:", list(md0["basis"]["all"].keys()))
+                    shapes["basis_all_keys"] = list(md0["basis"]["all"].keys())
             for k in ("goal", "targets", "summary", "totals", "meal_histories_summary"):
                 if k in md0:
                     v = md0[k]
-                    print(f"🧭 '{k}' type:", type(v).__name__)
+                    shapes[f"{k}_type"] = type(v).__name__
                     if isinstance(v, dict):
-                        print(f"🧭 {k} keys:", list(v.keys())[:50])
+                        shapes[f"{k}_keys"] = list(v.keys())[:50]
                         if k == "meal_histories_summary" and isinstance(v.get("all"), dict):
-                            print("🧭 meal_histories_summary.all keys:", list(v["all"].keys())[:50])
+                            shapes["meal_histories_summary_all_keys"] = list(v["all"].keys())[:50]
         else:
-            print("⚠️ meal_with_basis is not dict-like:", type(md0).__name__)
+            shapes["meal_type"] = type(md0).__name__
     except Exception as e:
-        print("⚠️ meal_with_basis keys dump失敗:", e)
+        shapes["meal_error"] = str(e)
 
     try:
         if isinstance(body_data, dict):
-            print("🔑 anthropometric wrapper keys:", list(body_data.keys())[:50])
+            shapes["anthro_keys"] = list(body_data.keys())[:50]
             if isinstance(body_data.get("data"), list) and body_data["data"]:
-                print("🔑 anthropometric[data][0] keys:", list(body_data["data"][0].keys())[:50])
+                shapes["anthro_data0_keys"] = list(body_data["data"][0].keys())[:50]
         elif isinstance(body_data, list):
-            print("🔑 anthropometric is list, length:", len(body_data))
+            shapes["anthro_len"] = len(body_data)
             if body_data:
-                print("🔑 anthropometric[0] keys:", list(body_data[0].keys())[:50])
+                shapes["anthro0_keys"] = list(body_data[0].keys())[:50]
         else:
-            print("⚠️ anthropometric unexpected type:", type(body_data).__name__)
+            shapes["anthro_type"] = type(body_data).__name__
     except Exception as e:
-        print("⚠️ anthropometric keys dump失敗:", e)
-    # --- ここまでダンプ ---
+        shapes["anthro_error"] = str(e)
+    return shapes
+
+
+def generate_meal_advice(meal_data: dict, body_data: dict, date_str: str) -> str:
+    """
+    食事データ（meal_with_basis）と体組成データ（anthropometric）から食事アドバイスを生成
+    - meal_data, body_data はAPIの生JSON
+    - date_str は 'YYYY-MM-DD' or 'YYYY/MM/DD'（/receive-request の timestamp から）
+    """
+    # --- 形状ダンプ（DEBUG 時のみ・サンプリング） ---
+    if should_dump(logger):
+        logger.debug("meal advice payload shapes", extra={"shapes": _payload_shapes(meal_data, body_data)})
 
     # 整形テキストを作成（失敗時はフォールバックでJSON文字列を渡す）
     try:
         formatted = format_daily_report(meal_data, body_data, date_str)
-        print("📄 整形済みデータ:\n", formatted)
+        if should_dump(logger):
+            logger.debug("formatted daily report", extra={"report": formatted})
     except Exception as e:
-        print("⚠️ format_daily_report 失敗:", e)
+        logger.warning("format_daily_report failed: %s", e)
         formatted = (
             "【注意】整形に失敗したためJSONを直接使用します。\n\n"
             f"【食事データ(JSON)】\n{meal_data}\n\n"
             f"【体重・体脂肪データ(JSON)】\n{body_data}\n"
         )
-        # ★ 失敗時のフォールバックもログ出力
-        print("📄 整形フォールバック(JSONダンプ):\n", formatted)
+        # ★ 失敗時のフォールバックもログ出力（サンプリング）
+        if should_dump(logger):
+            logger.debug("formatted daily report (fallback json)", extra={"report": formatted})
 
     prompt = (
         "以下はクライアントの1日のデータです。"
@@ -196,7 +247,7 @@ def generate_meal_advice(meal_data: dict, body_data: dict, date_str: str) -> str
         "簡潔かつ前向きにアドバイスしてください。\n\n"
         f"{formatted}\n"
     )
-    return generate_advice_by_prompt(prompt)
+    return generate_advice_by_prompt(prompt, call_site="generate_meal_advice")
 
 
 def generate_workout_advice(message_text: str) -> str:
@@ -209,7 +260,7 @@ def generate_workout_advice(message_text: str) -> str:
         "優しく、かつ根拠のあるアドバイスを返してください。\n\n"
         f"【質問】\n{message_text}\n"
     )
-    return generate_advice_by_prompt(prompt)
+    return generate_advice_by_prompt(prompt, call_site="generate_workout_advice")
 
 
 def generate_operation_advice(message_text: str) -> str:
@@ -221,7 +272,7 @@ def generate_operation_advice(message_text: str) -> str:
         "あなたはシンプルでわかりやすい回答を返してください。\n\n"
         f"【質問】\n{message_text}\n"
     )
-    return generate_advice_by_prompt(prompt)
+    return generate_advice_by_prompt(prompt, call_site="generate_operation_advice")
 
 
 def generate_other_reply(message_text: str) -> str:
@@ -233,4 +284,4 @@ def generate_other_reply(message_text: str) -> str:
         "あなたはナディとして、丁寧かつ親しみのある口調で返信してください。\n\n"
         f"【メッセージ】\n{message_text}\n"
     )
-    return generate_advice_by_prompt(prompt)
+    return generate_advice_by_prompt(prompt, call_site="generate_other_reply")
@@ -1,15 +1,47 @@
 # utils/line.py
+import logging
 import os
+import random
+import threading
+import time
+import uuid
 import requests
-from typing import Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, List, Optional
+
+from utils.circuit_breaker import UPSTREAM_LINE, CircuitOpenError, get_breaker, is_failure_status
+
+logger = logging.getLogger(__name__)
 
 LINE_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+LINE_MULTICAST_URL = "https://api.line.me/v2/bot/message/multicast"
 LINE_PROFILE_URL_TMPL = "https://api.line.me/v2/bot/profile/{user_id}"
 
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "10"))
+LINE_MAX_RETRIES = int(os.getenv("LINE_MAX_RETRIES", "3"))         # 初回を除く再試行回数
+LINE_RETRY_BACKOFF_SEC = float(os.getenv("LINE_RETRY_BACKOFF_SEC", "0.5"))
+LINE_TEXT_MAX_CHARS = 5000                                          # テキストメッセージ1件の上限
+LINE_MAX_MESSAGES = 5                                               # 1回の push / multicast で送れるメッセージ数
+LINE_MULTICAST_MAX_TO = 500                                         # multicast 1回の宛先数上限
+
+# ✅ LINE 用 HTTP クライアント（初回利用時に生成し、接続を使い回す）
+_http = None
+_http_lock = threading.Lock()
+
+_breaker = get_breaker(UPSTREAM_LINE)
+
 
 class LineSendError(Exception):
-    """LINE送信に失敗した時の例外"""
-    pass
+    """
+    LINE送信に失敗した時の例外。
+    status_code は LINE の応答（ネットワークエラー等で応答が無ければ None）、
+    retryable は時間をおけば通る見込みがあるか（5xx / 429 / ネットワーク / ブレーカ open）。
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
 
 
 class LineProfileError(Exception):
@@ -17,6 +49,19 @@ class LineProfileError(Exception):
     pass
 
 
+def get_http() -> requests.Session:
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                s = requests.Session()
+                # 再試行は自前で行う（push は X-Line-Retry-Key を付けた時だけ再送してよいため）
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LINE_HTTP_POOL_SIZE, max_retries=0)
+                s.mount("https://", adapter)
+                _http = s
+    return _http
+
+
 def _get_token() -> str:
     """
     毎回環境変数から取得（プロセス内でトークンが更新されても拾えるように）
@@ -27,37 +72,104 @@ def _get_token() -> str:
     return token
 
 
-def send_line_message(user_id: str, text: str) -> None:
+def _backoff(attempt: int, resp: Optional[requests.Response] = None) -> float:
+    """指数バックオフ＋ジッタ。429 で Retry-After があればそれに従う"""
+    if resp is not None:
+        try:
+            return min(30.0, float(resp.headers.get("Retry-After")))
+        except (TypeError, ValueError):
+            pass
+    return LINE_RETRY_BACKOFF_SEC * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+
+def text_messages(text: str) -> List[Dict[str, Any]]:
     """
-    LINEのPush APIでテキストメッセージを送信する。
-    環境変数 LINE_CHANNEL_ACCESS_TOKEN が必要。
+    テキストを LINE の text メッセージに分割する（1件 5000 字 × 最大5件。それを超える分は切り捨て）。
+    なるべく改行位置で区切る。
     """
-    if not user_id:
-        raise LineSendError("user_id が空です。")
+    text = text or ""
+    chunks: List[str] = []
+    while text and len(chunks) < LINE_MAX_MESSAGES:
+        if len(text) <= LINE_TEXT_MAX_CHARS:
+            chunks.append(text)
+            break
+        cut = text.rfind("\n", 0, LINE_TEXT_MAX_CHARS)
+        if cut < LINE_TEXT_MAX_CHARS // 2:
+            cut = LINE_TEXT_MAX_CHARS
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    return [{"type": "text", "text": c} for c in chunks or [""]]
+
+
+def _send_with_retry(url: str, payload: Dict[str, Any], retry_key: Optional[str]) -> None:
+    """
+    push / multicast 共通の送信。
+    同じ retry_key（UUID）で送り直す限り LINE 側で重複配信されないので、
+    ネットワークエラー / 5xx / 429 は同じキーで再試行する。既に受理済み（409）は成功扱い。
+    """
+    if len(payload["messages"]) > LINE_MAX_MESSAGES:
+        raise LineSendError(f"messages は最大 {LINE_MAX_MESSAGES} 件です。")
 
-    token = _get_token()
-    payload = {
-        "to": user_id,
-        "messages": [
-            {
-                "type": "text",
-                "text": text[:5000] if text else ""
-            }
-        ]
-    }
+    retry_key = retry_key or str(uuid.uuid4())
     headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
+        "Authorization": f"Bearer {_get_token()}",
+        "Content-Type": "application/json",
+        "X-Line-Retry-Key": retry_key,
     }
 
-    try:
-        resp = requests.post(LINE_PUSH_URL, json=payload, headers=headers, timeout=15)
-    except requests.RequestException as e:
-        raise LineSendError(f"LINE送信時にネットワークエラーが発生しました: {e}")
-
-    if resp.status_code != 200:
+    for attempt in range(LINE_MAX_RETRIES + 1):
+        last = attempt == LINE_MAX_RETRIES
+        try:
+            _breaker.before_call()
+        except CircuitOpenError as e:
+            # LINE 障害中は15秒のタイムアウトを待たずに失敗させる（呼び出し側は LineSendError として扱える）
+            raise LineSendError(f"LINE送信を中止しました: {e}", retryable=True) from e
+        try:
+            resp = get_http().post(url, json=payload, headers=headers, timeout=15)
+        except requests.RequestException as e:
+            _breaker.record(False)
+            if last:
+                raise LineSendError(f"LINE送信時にネットワークエラーが発生しました: {e}", retryable=True)
+            time.sleep(_backoff(attempt))
+            continue
+        _breaker.record(not is_failure_status(resp.status_code))
+
+        if resp.status_code == 200:
+            return
+        if resp.status_code == 409 and resp.headers.get("x-line-accepted-request-id"):
+            logger.info("line push already accepted", extra={"retry_key": retry_key})
+            return
+        retryable = is_failure_status(resp.status_code)
+        if retryable and not last:
+            time.sleep(_backoff(attempt, resp if resp.status_code == 429 else None))
+            continue
         # LINEのエラーメッセージも含めて例外化
-        raise LineSendError(f"LINE送信失敗: {resp.status_code} - {resp.text}")
+        raise LineSendError(f"LINE送信失敗: {resp.status_code} - {resp.text}", resp.status_code, retryable)
+
+
+def push_messages(to: str, messages: List[Dict[str, Any]], retry_key: Optional[str] = None) -> None:
+    """Push API で1人に messages（最大5件）を送る"""
+    if not to:
+        raise LineSendError("user_id が空です。")
+    _send_with_retry(LINE_PUSH_URL, {"to": to, "messages": messages}, retry_key)
+
+
+def multicast_messages(to: List[str], messages: List[Dict[str, Any]], retry_key: Optional[str] = None) -> None:
+    """Multicast API で最大500人に同じ messages（最大5件）を送る"""
+    to = [u for u in to if u]
+    if not to:
+        raise LineSendError("宛先が空です。")
+    if len(to) > LINE_MULTICAST_MAX_TO:
+        raise LineSendError(f"multicast の宛先は最大 {LINE_MULTICAST_MAX_TO} 件です。")
+    _send_with_retry(LINE_MULTICAST_URL, {"to": to, "messages": messages}, retry_key)
+
+
+def send_line_message(user_id: str, text: str, retry_key: Optional[str] = None) -> None:
+    """
+    LINEのPush APIでテキストメッセージを送信する。
+    環境変数 LINE_CHANNEL_ACCESS_TOKEN が必要。
+    """
+    push_messages(user_id, text_messages(text), retry_key=retry_key)
 
 
 def get_line_profile(user_id: str) -> Dict[str, Any]:
@@ -82,10 +194,26 @@ def get_line_profile(user_id: str) -> Dict[str, Any]:
     url = LINE_PROFILE_URL_TMPL.format(user_id=user_id)
     headers = {"Authorization": f"Bearer {token}"}
 
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
-    except requests.RequestException as e:
-        raise LineProfileError(f"プロフィール取得時にネットワークエラー: {e}")
+    # GET は冪等なのでネットワークエラー / 5xx / 429 はそのまま再試行
+    for attempt in range(LINE_MAX_RETRIES + 1):
+        last = attempt == LINE_MAX_RETRIES
+        try:
+            _breaker.before_call()
+        except CircuitOpenError as e:
+            raise LineProfileError(f"プロフィール取得を中止しました: {e}") from e
+        try:
+            resp = get_http().get(url, headers=headers, timeout=10)
+        except requests.RequestException as e:
+            _breaker.record(False)
+            if last:
+                raise LineProfileError(f"プロフィール取得時にネットワークエラー: {e}")
+            time.sleep(_backoff(attempt))
+            continue
+        _breaker.record(not is_failure_status(resp.status_code))
+        if is_failure_status(resp.status_code) and not last:
+            time.sleep(_backoff(attempt, resp if resp.status_code == 429 else None))
+            continue
+        break
 
     if resp.status_code == 200:
         try:
@@ -0,0 +1,194 @@
+# utils/llm_usage.py
+"""
+LLM 呼び出しの使用量台帳。
+- record_completion() はキューに積むだけ（リクエスト処理をブロックしない）
+- バックグラウンドスレッドが一定件数 / 一定間隔ごとに llm_usage へバルクINSERT
+- user_id / request_id は usage_context() で呼び出し元から紐付ける
+"""
+import atexit
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# モデル別単価（USD / 1M tokens）。未登録モデルは cost_usd=None で記録する。
+MODEL_PRICES_USD_PER_1M = {
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+}
+
+BATCH_SIZE = int(os.getenv("LLM_USAGE_BATCH_SIZE", "50"))
+FLUSH_INTERVAL_SEC = float(os.getenv("LLM_USAGE_FLUSH_INTERVAL", "5"))
+QUEUE_MAX = int(os.getenv("LLM_USAGE_QUEUE_MAX", "10000"))
+
+# 呼び出し元（リクエスト単位）のコンテキスト
+_usage_ctx: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("llm_usage_ctx", default=None)
+
+
+@contextmanager
+def usage_context(**fields):
+    """with usage_context(user_id=..., request_id=...): の範囲で記録に紐付ける"""
+    token = _usage_ctx.set(dict(fields))
+    try:
+        yield
+    finally:
+        _usage_ctx.reset(token)
+
+
+def begin_usage_context(**fields) -> contextvars.Token:
+    """Flask の before_request 用。end_usage_context() と対で使う"""
+    return _usage_ctx.set(dict(fields))
+
+
+def end_usage_context(token: contextvars.Token) -> None:
+    _usage_ctx.reset(token)
+
+
+def update_usage_context(**fields) -> None:
+    """request_id 確定後などに現在のコンテキストへ追記する"""
+    ctx = _usage_ctx.get()
+    if ctx is None:
+        _usage_ctx.set(dict(fields))
+    else:
+        ctx.update(fields)
+
+
+def estimate_cost_usd(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    price = MODEL_PRICES_USD_PER_1M.get(model or "")
+    if not price:
+        # "gpt-4o-2024-08-06" のような日付付きモデル名は接頭辞で照合
+        for name in sorted(MODEL_PRICES_USD_PER_1M, key=len, reverse=True):
+            if (model or "").startswith(name + "-"):
+                price = MODEL_PRICES_USD_PER_1M[name]
+                break
+    if not price:
+        return None
+    uncached = max((prompt_tokens or 0) - (cached_tokens or 0), 0)
+    cost = (
+        uncached * price["input"]
+        + (cached_tokens or 0) * price["cached_input"]
+        + (completion_tokens or 0) * price["output"]
+    ) / 1_000_000
+    return round(cost, 6)
+
+
+# =====================================================
+# 非同期バッチライタ
+# =====================================================
+class _UsageWriter:
+    def __init__(self):
+        self._q: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=QUEUE_MAX)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+        self.written = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="llm-usage-writer", daemon=True)
+            self._thread.start()
+
+    def put(self, row: Dict[str, Any]) -> None:
+        self._ensure_started()
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, first: Optional[Dict[str, Any]] = None) -> list:
+        batch = [first] if first is not None else []
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> None:
+        if not batch:
+            return
+        from utils.db import insert_llm_usage_batch  # 循環import回避
+        try:
+            self.written += insert_llm_usage_batch(batch)
+        except Exception:
+            # 台帳の失敗で本処理を止めない
+            self.dropped += len(batch)
+            logger.exception("llm_usage write failed", extra={"rows": len(batch)})
+
+    def _run(self):
+        while True:
+            try:
+                first = self._q.get(timeout=FLUSH_INTERVAL_SEC)
+            except queue.Empty:
+                continue
+            batch = self._drain(first)
+            # 少量なら少し待って同じバッチにまとめる
+            if len(batch) < BATCH_SIZE:
+                time.sleep(min(FLUSH_INTERVAL_SEC, 1.0))
+                batch.extend(self._drain())
+            self._write(batch)
+
+    def flush(self) -> None:
+        """残っている行を同期的に書き出す（プロセス終了時・スクリプト用）"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write(batch)
+
+
+_writer = _UsageWriter()
+atexit.register(_writer.flush)
+
+
+def record_completion(
+    call_site: str,
+    model: Optional[str],
+    latency_ms: int,
+    usage: Any = None,
+    status: str = "ok",
+) -> None:
+    """
+    chat.completions の1回分を台帳に積む。
+    usage は OpenAI の CompletionUsage（None 可）。キャッシュ命中は cached_tokens>0 で判定。
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", None) if usage is not None else None
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+    details = getattr(usage, "prompt_tokens_details", None) if usage is not None else None
+    cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+
+    ctx = _usage_ctx.get() or {}
+    _writer.put({
+        "created_at": datetime.now(timezone.utc),
+        "call_site": call_site,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "latency_ms": int(latency_ms),
+        "cache_hit": bool(cached_tokens),
+        "cost_usd": estimate_cost_usd(model, prompt_tokens or 0, completion_tokens or 0, cached_tokens or 0)
+        if usage is not None else None,
+        "status": status,
+        "user_id": ctx.get("user_id"),
+        "request_id": ctx.get("request_id"),
+    })
+
+
+def flush_usage() -> None:
+    _writer.flush()
+
+
+def writer_stats() -> Dict[str, int]:
+    return {"queued": _writer._q.qsize(), "written": _writer.written, "dropped": _writer.dropped}
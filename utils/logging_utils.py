@@ -0,0 +1,151 @@
+# utils/logging_utils.py
+"""
+構造化ログ（JSON 1行）＋レベル制御＋デバッグダンプのサンプリング。
+- configure_logging() でルートロガーに QueueHandler を付け、出力は別スレッド（QueueListener）で行う
+- LOG_LEVEL=INFO（既定） / LOG_LEVELS="utils.caromil=DEBUG,utils.gpt_utils=WARNING" でモジュール別に設定
+- 大きなダンプは should_dump(logger) が True の時だけ組み立てる（LOG_DUMP_SAMPLE_RATE、既定 0.01）
+- request_id（X-Request-Id または自動採番）を全レコードに付与して相関できるようにする
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_request_id", default=None)
+
+# LogRecord 標準属性（これ以外は extra として JSON に出す）
+_STD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+_configured = False
+_config_lock = threading.Lock()
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def set_request_id(request_id: Optional[str]) -> contextvars.Token:
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token: contextvars.Token) -> None:
+    _request_id.reset(token)
+
+
+def get_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """QueueHandler に積む前（呼び出しスレッド側）で request_id を確定させる"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        rid = getattr(record, "request_id", None)
+        if rid:
+            out["request_id"] = rid
+        for k, v in record.__dict__.items():
+            if k not in _STD_ATTRS and not k.startswith("_"):
+                out[k] = v
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        name, lv = part.split("=", 1)
+        if name.strip() and lv.strip():
+            levels[name.strip()] = lv.strip().upper()
+    return levels
+
+
+def configure_logging() -> None:
+    """プロセスで1回だけ設定する（create_app / スクリプトから呼ぶ）"""
+    global _configured, _listener
+    if _configured:
+        return
+    with _config_lock:
+        if _configured:
+            return
+
+        stream = logging.StreamHandler(sys.stderr)
+        if os.getenv("LOG_FORMAT", "json").lower() == "json":
+            stream.setFormatter(JsonFormatter())
+        else:
+            stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+
+        q: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_MAX", "10000")))
+        qh = _NonBlockingQueueHandler(q)
+        qh.addFilter(RequestIdFilter())
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(qh)
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+        for name, lv in _parse_levels(os.getenv("LOG_LEVELS", "")).items():
+            logging.getLogger(name).setLevel(lv)
+
+        _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _configured = True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キュー満杯時は待たずに捨てる（リクエスト処理を止めない）"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 引数展開と例外整形だけ呼び出し側で済ませ、JSON 化はリスナースレッドで行う
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _NonBlockingQueueHandler.dropped += 1
+
+
+def should_dump(logger: logging.Logger, rate: Optional[float] = None) -> bool:
+    """
+    重いデバッグダンプ（生JSON・キー一覧・整形レポート全文）を出すかどうか。
+    DEBUG 有効時のみ、かつ rate の確率で True。
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    if rate is None:
+        rate = float(os.getenv("LOG_DUMP_SAMPLE_RATE", "0.01"))
+    return rate >= 1.0 or random.random() < rate
@@ -0,0 +1,635 @@
+# utils/migrations.py
+"""
+バージョン付きスキーママイグレーション。
+- 適用履歴は schema_migrations テーブルに記録
+- transactional=False のマイグレーションは AUTOCOMMIT で1文ずつ実行（CREATE INDEX CONCURRENTLY 用）
+- 同時実行は pg_advisory_lock で防止
+実行: python -m scripts.migrate  /  flask --app app migrate
+"""
+import logging
+import time
+from datetime import timezone
+from typing import Callable, List, Optional, Union
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import text
+
+from utils.db import get_engine, ensure_request_partitions, REQUESTS_LEGACY_TZ
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK_KEY = 7_202_501  # pg_advisory_lock 用の固定キー
+ROLLUP_GOAL_TOLERANCE = 0.10     # user_rollups：目標 kcal の ±10% 以内を「目標内」とする
+
+Step = Union[str, Callable]
+
+
+class Migration:
+    """
+    steps: SQL文字列 または callable(conn, concurrently: bool) のリスト。
+    SQL 中の {concurrently} は concurrently=True の時 "CONCURRENTLY" に置換される。
+    """
+
+    def __init__(self, version: int, name: str, steps: List[Step], transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.steps = steps
+        self.transactional = transactional
+
+
+# =========================
+# ヘルパ
+# =========================
+def create_index(name: str, ddl: str) -> Callable:
+    """
+    CREATE INDEX 用ステップ。CONCURRENTLY 失敗で INVALID のまま残った同名インデックスがあれば作り直す。
+    ddl は "CREATE INDEX {concurrently} IF NOT EXISTS <name> ON ..." 形式。
+    """
+    def _step(conn, concurrently: bool):
+        invalid = conn.execute(text("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND NOT i.indisvalid
+        """), {"name": name}).first()
+        if invalid:
+            logger.warning("dropping invalid index before rebuild", extra={"index": name})
+            conn.execute(text(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {name}"))
+        conn.execute(text(ddl.format(concurrently="CONCURRENTLY" if concurrently else "")))
+    return _step
+
+
+def _partition_requests_by_month(conn, concurrently: bool):
+    """
+    requests を timestamptz の月次 RANGE パーティションテーブルに作り替える。
+    - 旧 String 列（naive ISO）は REQUESTS_LEGACY_TZ のローカル時刻として変換
+    - 旧テーブルは requests_legacy として残す（確認後に手動で DROP）
+    - PK は (id, timestamp)。id の採番シーケンスはそのまま引き継ぐ
+    """
+    kind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'requests' AND relkind IN ('r', 'p')")).scalar()
+    if kind is None or kind == "p":
+        return
+    col_type = conn.execute(text("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'requests' AND column_name = 'timestamp'
+    """)).scalar()
+    if col_type == "timestamp with time zone":
+        ts_expr = "timestamp"
+    elif col_type == "timestamp without time zone":
+        ts_expr = "timestamp AT TIME ZONE :tz"
+    else:
+        ts_expr = "NULLIF(timestamp, '')::timestamp AT TIME ZONE :tz"
+
+    conn.execute(text("LOCK TABLE requests IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text("ALTER TABLE requests RENAME TO requests_legacy"))
+    conn.execute(text("ALTER TABLE requests_legacy RENAME CONSTRAINT requests_pkey TO requests_legacy_pkey"))
+    for ix in ("ix_requests_id", "ix_requests_pending_ts", "ix_requests_user_ts", "ix_requests_user_type"):
+        conn.execute(text(f"DROP INDEX IF EXISTS {ix}"))
+
+    conn.execute(text("""
+        CREATE TABLE requests (
+            id           INTEGER NOT NULL DEFAULT nextval('requests_id_seq'),
+            user_id      VARCHAR,
+            message      TEXT,
+            timestamp    TIMESTAMPTZ NOT NULL,
+            request_type VARCHAR,
+            status       VARCHAR DEFAULT 'pending',
+            advice_text  TEXT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """))
+    conn.execute(text("CREATE TABLE requests_default PARTITION OF requests DEFAULT"))
+
+    oldest = conn.execute(text(f"SELECT min({ts_expr}) FROM requests_legacy"), {"tz": REQUESTS_LEGACY_TZ}).scalar()
+    # セッションの TimeZone に依存しないよう明示的に変換する。パーティション境界は UTC の月初なので、
+    # REQUESTS_LEGACY_TZ での日付と UTC での日付の早い方から作る（月末・月初をまたぐ行も取りこぼさない）
+    since = None
+    if oldest:
+        since = min(oldest.astimezone(ZoneInfo(REQUESTS_LEGACY_TZ)).date(), oldest.astimezone(timezone.utc).date())
+    ensure_request_partitions(conn, since=since)
+
+    conn.execute(text(f"""
+        INSERT INTO requests (id, user_id, message, timestamp, request_type, status, advice_text)
+        SELECT id, user_id, message, COALESCE({ts_expr}, 'epoch'::timestamptz), request_type, status, advice_text
+        FROM requests_legacy
+    """), {"tz": REQUESTS_LEGACY_TZ})
+    conn.execute(text("ALTER SEQUENCE requests_id_seq OWNED BY requests.id"))
+
+    # パーティション親のインデックスは CONCURRENTLY 不可（各パーティションへ自動で作成される）
+    conn.execute(text("CREATE INDEX ix_requests_pending_ts ON requests (timestamp DESC, id DESC) WHERE status = 'pending'"))
+    conn.execute(text("CREATE INDEX ix_requests_user_ts ON requests (user_id, timestamp)"))
+    conn.execute(text("CREATE INDEX ix_requests_user_type ON requests (user_id, request_type)"))
+    conn.execute(text("CREATE INDEX ix_requests_id ON requests (id)"))
+
+
+_ROLLUP_GOAL_JOIN_DAILY = "LEFT JOIN user_goals_daily g ON g.user_id = n.user_id AND g.date = n.date"
+_ROLLUP_GOAL_JOIN_INTERVALS = (
+    "LEFT JOIN user_goal_intervals g ON g.user_id = n.user_id AND g.valid_from <= n.date "
+    "AND (g.valid_to IS NULL OR g.valid_to > n.date)"
+)
+
+
+def _refresh_user_rollups_sql(goal_join: str) -> str:
+    """refresh_user_rollups() の定義。目標テーブルの結合だけ差し替えられるようにしている（migration 5 / 6）"""
+    return f"""
+        CREATE OR REPLACE FUNCTION refresh_user_rollups(p_user_ids text[], p_dates date[]) RETURNS integer AS $$
+        DECLARE n integer;
+        BEGIN
+            WITH agg AS (
+            SELECT p.user_id, p.period_type, p.period_start,
+                   nu.days_logged, nu.avg_kcal, nu.avg_p, nu.avg_f, nu.avg_c,
+                   wt.weight_days, wt.avg_weight, wt.weight_delta,
+                   nu.goal_days,
+                   CASE WHEN nu.goal_eval_days > 0 THEN round(100.0 * nu.goal_days / nu.goal_eval_days, 1) END AS pct_in_goal
+            FROM (
+                SELECT DISTINCT k.user_id, pp.period_type, pp.period_start,
+                       CASE pp.period_type WHEN 'week' THEN pp.period_start + 7
+                                           ELSE (pp.period_start + interval '1 month')::date END AS period_end
+                FROM unnest(p_user_ids, p_dates) AS k(user_id, d)
+                CROSS JOIN LATERAL (VALUES
+                    ('week',  date_trunc('week',  k.d)::date),
+                    ('month', date_trunc('month', k.d)::date)
+                ) AS pp(period_type, period_start)
+                WHERE k.user_id IS NOT NULL AND k.d IS NOT NULL
+            ) p
+            CROSS JOIN LATERAL (
+                SELECT count(*) AS days_logged,
+                       round(avg(n.calorie_kcal), 1) AS avg_kcal,
+                       round(avg(n.protein_g), 1) AS avg_p,
+                       round(avg(n.fat_g), 1) AS avg_f,
+                       round(avg(n.carb_g), 1) AS avg_c,
+                       count(*) FILTER (WHERE g.kcal > 0 AND n.calorie_kcal IS NOT NULL) AS goal_eval_days,
+                       count(*) FILTER (WHERE g.kcal > 0 AND abs(n.calorie_kcal - g.kcal) <= g.kcal * {ROLLUP_GOAL_TOLERANCE}) AS goal_days
+                FROM user_nutrition_daily n
+                {goal_join}
+                WHERE n.user_id = p.user_id AND n.date >= p.period_start AND n.date < p.period_end
+            ) nu
+            CROSS JOIN LATERAL (
+                SELECT count(*) AS weight_days,
+                       round(avg(m.weight_kg), 2) AS avg_weight,
+                       (array_agg(m.weight_kg ORDER BY m.date DESC))[1]
+                         - (array_agg(m.weight_kg ORDER BY m.date ASC))[1] AS weight_delta
+                FROM user_metrics_daily m
+                WHERE m.user_id = p.user_id AND m.date >= p.period_start AND m.date < p.period_end
+                  AND m.weight_kg IS NOT NULL
+            ) wt
+            ),
+            -- データが無くなった期間は削除
+            gone AS (
+                DELETE FROM user_rollups r USING agg a
+                WHERE r.user_id = a.user_id AND r.period_type = a.period_type AND r.period_start = a.period_start
+                  AND a.days_logged = 0 AND a.weight_days = 0
+            )
+            INSERT INTO user_rollups AS r
+                (user_id, period_type, period_start, days_logged, avg_kcal, avg_p, avg_f, avg_c,
+                 weight_days, avg_weight, weight_delta, goal_days, pct_in_goal, updated_at)
+            SELECT a.user_id, a.period_type, a.period_start, a.days_logged, a.avg_kcal, a.avg_p, a.avg_f, a.avg_c,
+                   a.weight_days, a.avg_weight, a.weight_delta, a.goal_days, a.pct_in_goal, now()
+            FROM agg a WHERE a.days_logged > 0 OR a.weight_days > 0
+            ON CONFLICT (user_id, period_type, period_start) DO UPDATE SET
+                days_logged  = excluded.days_logged,
+                avg_kcal     = excluded.avg_kcal,
+                avg_p        = excluded.avg_p,
+                avg_f        = excluded.avg_f,
+                avg_c        = excluded.avg_c,
+                weight_days  = excluded.weight_days,
+                avg_weight   = excluded.avg_weight,
+                weight_delta = excluded.weight_delta,
+                goal_days    = excluded.goal_days,
+                pct_in_goal  = excluded.pct_in_goal,
+                updated_at   = now()
+            WHERE (r.days_logged, r.avg_kcal, r.avg_p, r.avg_f, r.avg_c, r.weight_days, r.avg_weight,
+                   r.weight_delta, r.goal_days, r.pct_in_goal)
+                  IS DISTINCT FROM
+                  (excluded.days_logged, excluded.avg_kcal, excluded.avg_p, excluded.avg_f, excluded.avg_c,
+                   excluded.weight_days, excluded.avg_weight, excluded.weight_delta, excluded.goal_days,
+                   excluded.pct_in_goal);
+            GET DIAGNOSTICS n = ROW_COUNT;
+            RETURN n;
+        END $$ LANGUAGE plpgsql
+"""
+
+
+def _rollup_trigger_steps(table: str, function: str = "trg_user_rollups") -> List[str]:
+    """
+    user_rollups 再集計トリガ（INSERT / UPDATE / DELETE）。
+    遷移テーブルは1トリガ1イベントまでなので3本に分ける（関数は共通）。
+    """
+    steps = []
+    for event, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        name = f"rollups_{event.lower()}"
+        steps.append(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+        steps.append(f"""
+        CREATE TRIGGER {name} AFTER {event} ON {table}
+        REFERENCING {ref} TABLE AS changed_rows FOR EACH STATEMENT
+        EXECUTE FUNCTION {function}()
+        """)
+    return steps
+
+
+# =========================
+# マイグレーション一覧（version 昇順・追記のみ）
+# =========================
+MIGRATIONS: List[Migration] = [
+    Migration(1, "requests_performance_indexes", [
+        # get_unreplied: WHERE status='pending' ORDER BY timestamp DESC
+        create_index("ix_requests_pending_ts", """
+            CREATE INDEX {concurrently} IF NOT EXISTS ix_requests_pending_ts
+            ON requests (timestamp DESC, id DESC) WHERE status = 'pending'
+        """),
+        # update_advice_text: user_id + timestamp
+        create_index("ix_requests_user_ts", """
+            CREATE INDEX {concurrently} IF NOT EXISTS ix_requests_user_ts
+            ON requests (user_id, timestamp)
+        """),
+        # search_paid_users: EXISTS (user_id, request_type='meal_feedback')
+        create_index("ix_requests_user_type", """
+            CREATE INDEX {concurrently} IF NOT EXISTS ix_requests_user_type
+            ON requests (user_id, request_type)
+        """),
+    ], transactional=False),
+    # timestamp を TIMESTAMPTZ にし、月次 RANGE パーティション化（テーブルロックを伴うためメンテ時間に適用）
+    Migration(2, "requests_timestamptz_monthly_partitions", [
+        _partition_requests_by_month,
+    ]),
+    # /users, /users/premium のあいまい検索（LIKE '%q%' と類似度 <% をインデックスで引く）
+    Migration(3, "user_profile_trigram_indexes", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        create_index("ix_user_profile_name_trgm", """
+            CREATE INDEX {concurrently} IF NOT EXISTS ix_user_profile_name_trgm
+            ON user_profile USING gin (lower(name) gin_trgm_ops)
+        """),
+        create_index("ix_user_profile_user_id_trgm", """
+            CREATE INDEX {concurrently} IF NOT EXISTS ix_user_profile_user_id_trgm
+            ON user_profile USING gin (lower(user_id) gin_trgm_ops)
+        """),
+    ], transactional=False),
+    # 有料会員一覧用の活動サマリ（トリガで差分更新＋夜間ロールオーバー）
+    Migration(4, "user_activity_summary", [
+        """
+        CREATE TABLE IF NOT EXISTS user_activity_summary (
+            user_id           VARCHAR(64) PRIMARY KEY,
+            last_intake_date  DATE,
+            days_30           INTEGER NOT NULL DEFAULT 0,
+            has_meal_feedback BOOLEAN NOT NULL DEFAULT FALSE,
+            token_expires_at  TIMESTAMP,
+            updated_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_user_activity_last_intake ON user_activity_summary (last_intake_date DESC NULLS LAST, user_id)",
+        # --- user_nutrition_daily：新しい日の INSERT だけを文単位で集約して反映 ---
+        """
+        CREATE OR REPLACE FUNCTION trg_activity_nutrition_ins() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_activity_summary AS s (user_id, last_intake_date, days_30, updated_at)
+            SELECT user_id, max(date), count(*) FILTER (WHERE date >= current_date - 30), now()
+            FROM new_rows GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_intake_date = GREATEST(s.last_intake_date, excluded.last_intake_date),
+                days_30 = s.days_30 + excluded.days_30,
+                updated_at = now();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS activity_nutrition_ins ON user_nutrition_daily",
+        """
+        CREATE TRIGGER activity_nutrition_ins AFTER INSERT ON user_nutrition_daily
+        REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT
+        EXECUTE FUNCTION trg_activity_nutrition_ins()
+        """,
+        # 削除は稀なので対象ユーザーだけ再計算
+        """
+        CREATE OR REPLACE FUNCTION trg_activity_nutrition_del() RETURNS trigger AS $$
+        BEGIN
+            UPDATE user_activity_summary s SET
+                last_intake_date = a.last_date,
+                days_30 = a.days_30,
+                updated_at = now()
+            FROM (
+                SELECT o.user_id,
+                       (SELECT max(n.date) FROM user_nutrition_daily n WHERE n.user_id = o.user_id) AS last_date,
+                       (SELECT count(*) FROM user_nutrition_daily n
+                         WHERE n.user_id = o.user_id AND n.date >= current_date - 30) AS days_30
+                FROM (SELECT DISTINCT user_id FROM old_rows) o
+            ) a
+            WHERE s.user_id = a.user_id;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS activity_nutrition_del ON user_nutrition_daily",
+        """
+        CREATE TRIGGER activity_nutrition_del AFTER DELETE ON user_nutrition_daily
+        REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT
+        EXECUTE FUNCTION trg_activity_nutrition_del()
+        """,
+        # --- tokens：連携・期限 ---
+        """
+        CREATE OR REPLACE FUNCTION trg_activity_tokens() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_activity_summary AS s (user_id, token_expires_at, updated_at)
+            VALUES (NEW.user_id, NEW.expires_at, now())
+            ON CONFLICT (user_id) DO UPDATE SET token_expires_at = excluded.token_expires_at, updated_at = now();
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS activity_tokens ON tokens",
+        """
+        CREATE TRIGGER activity_tokens AFTER INSERT OR UPDATE OF expires_at ON tokens
+        FOR EACH ROW EXECUTE FUNCTION trg_activity_tokens()
+        """,
+        # --- requests：食事分析の実績 ---
+        """
+        CREATE OR REPLACE FUNCTION trg_activity_meal_feedback() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_activity_summary AS s (user_id, has_meal_feedback, updated_at)
+            VALUES (NEW.user_id, TRUE, now())
+            ON CONFLICT (user_id) DO UPDATE SET has_meal_feedback = TRUE, updated_at = now()
+            WHERE NOT s.has_meal_feedback;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS activity_meal_feedback ON requests",
+        """
+        CREATE TRIGGER activity_meal_feedback AFTER INSERT ON requests
+        FOR EACH ROW WHEN (NEW.request_type = 'meal_feedback' AND NEW.user_id IS NOT NULL)
+        EXECUTE FUNCTION trg_activity_meal_feedback()
+        """,
+        # --- 夜間ロールオーバー（全件再計算）：初回バックフィルも兼ねる ---
+        """
+        CREATE OR REPLACE FUNCTION refresh_user_activity_summary() RETURNS integer AS $$
+        DECLARE n integer;
+        BEGIN
+            INSERT INTO user_activity_summary AS s
+                (user_id, last_intake_date, days_30, has_meal_feedback, token_expires_at, updated_at)
+            SELECT u.user_id,
+                   nd.last_date,
+                   COALESCE(nd.days_30, 0),
+                   EXISTS (SELECT 1 FROM requests r WHERE r.user_id = u.user_id AND r.request_type = 'meal_feedback'),
+                   t.expires_at,
+                   now()
+            FROM (
+                SELECT user_id FROM tokens
+                UNION SELECT user_id FROM user_nutrition_daily
+                UNION SELECT user_id FROM requests WHERE request_type = 'meal_feedback' AND user_id IS NOT NULL
+            ) u
+            LEFT JOIN tokens t ON t.user_id = u.user_id
+            LEFT JOIN (
+                SELECT user_id, max(date) AS last_date,
+                       count(*) FILTER (WHERE date >= current_date - 30) AS days_30
+                FROM user_nutrition_daily GROUP BY user_id
+            ) nd ON nd.user_id = u.user_id
+            ON CONFLICT (user_id) DO UPDATE SET
+                last_intake_date  = excluded.last_intake_date,
+                days_30           = excluded.days_30,
+                has_meal_feedback = excluded.has_meal_feedback,
+                token_expires_at  = excluded.token_expires_at,
+                updated_at        = now()
+            WHERE (s.last_intake_date, s.days_30, s.has_meal_feedback, s.token_expires_at)
+                  IS DISTINCT FROM
+                  (excluded.last_intake_date, excluded.days_30, excluded.has_meal_feedback, excluded.token_expires_at);
+            GET DIAGNOSTICS n = ROW_COUNT;
+            RETURN n;
+        END $$ LANGUAGE plpgsql
+        """,
+        "SELECT refresh_user_activity_summary()",
+    ]),
+    Migration(5, "user_rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS user_rollups (
+            user_id      VARCHAR(64) NOT NULL,
+            period_type  VARCHAR(8)  NOT NULL,
+            period_start DATE        NOT NULL,
+            days_logged  INTEGER     NOT NULL DEFAULT 0,
+            avg_kcal     NUMERIC(7, 1),
+            avg_p        NUMERIC(6, 1),
+            avg_f        NUMERIC(6, 1),
+            avg_c        NUMERIC(6, 1),
+            weight_days  INTEGER     NOT NULL DEFAULT 0,
+            avg_weight   NUMERIC(5, 2),
+            weight_delta NUMERIC(5, 2),
+            goal_days    INTEGER     NOT NULL DEFAULT 0,
+            pct_in_goal  NUMERIC(5, 1),
+            updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, period_type, period_start)
+        )
+        """,
+        # (user_id, date) の組から影響する週（ISO: 月曜始まり）と月を再集計する
+        # 目標内 = その日の目標 kcal の ±ROLLUP_GOAL_TOLERANCE 以内（目標・摂取の両方がある日が母数）
+        _refresh_user_rollups_sql(_ROLLUP_GOAL_JOIN_DAILY),
+        # 文単位トリガ：変更行の (user_id, date) をまとめて1回だけ再集計
+        """
+        CREATE OR REPLACE FUNCTION trg_user_rollups() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_user_rollups(array_agg(c.user_id::text), array_agg(c.date))
+            FROM (SELECT DISTINCT user_id, date FROM changed_rows) c;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        *_rollup_trigger_steps("user_nutrition_daily"),
+        *_rollup_trigger_steps("user_metrics_daily"),
+        *_rollup_trigger_steps("user_goals_daily"),
+        # 初回バックフィル
+        """
+        SELECT refresh_user_rollups(array_agg(x.user_id::text), array_agg(x.date))
+        FROM (
+            SELECT user_id, date FROM user_nutrition_daily
+            UNION SELECT user_id, date FROM user_metrics_daily
+        ) x
+        """,
+    ]),
+    Migration(6, "user_goal_intervals", [
+        """
+        CREATE TABLE IF NOT EXISTS user_goal_intervals (
+            user_id    VARCHAR(64) NOT NULL,
+            valid_from DATE        NOT NULL,
+            valid_to   DATE,
+            kcal       NUMERIC(7, 1),
+            p          NUMERIC(6, 1),
+            f          NUMERIC(6, 1),
+            c          NUMERIC(6, 1),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, valid_from),
+            CHECK (valid_to IS NULL OR valid_to > valid_from)
+        )
+        """,
+        # 既存の日次行を「連続していて値が同じ日」ごとに1区間へ畳む（gaps-and-islands）
+        """
+        INSERT INTO user_goal_intervals (user_id, valid_from, valid_to, kcal, p, f, c, created_at, updated_at)
+        SELECT user_id, min(date), max(date) + 1, kcal, p, f, c, min(created_at), max(updated_at)
+        FROM (
+            SELECT x.*, count(*) FILTER (WHERE x.brk) OVER (PARTITION BY x.user_id ORDER BY x.date) AS grp
+            FROM (
+                SELECT user_id, date, kcal, p, f, c, created_at, updated_at,
+                       (lag(date) OVER w IS DISTINCT FROM date - 1
+                        OR (lag(kcal) OVER w, lag(p) OVER w, lag(f) OVER w, lag(c) OVER w)
+                           IS DISTINCT FROM (kcal, p, f, c)) AS brk
+                FROM user_goals_daily
+                WINDOW w AS (PARTITION BY user_id ORDER BY date)
+            ) x
+        ) y
+        GROUP BY user_id, grp, kcal, p, f, c
+        ON CONFLICT (user_id, valid_from) DO NOTHING
+        """,
+        # ロールアップの目標内判定を区間テーブルに切り替え
+        _refresh_user_rollups_sql(_ROLLUP_GOAL_JOIN_INTERVALS),
+        """
+        CREATE OR REPLACE FUNCTION trg_user_rollups_goals() RETURNS trigger AS $$
+        BEGIN
+            -- 区間に掛かる「栄養の記録がある日」だけが目標内判定に影響する
+            PERFORM refresh_user_rollups(array_agg(x.user_id::text), array_agg(x.date))
+            FROM (
+                SELECT DISTINCT n.user_id, n.date
+                FROM changed_rows c
+                JOIN user_nutrition_daily n
+                  ON n.user_id = c.user_id AND n.date >= c.valid_from
+                 AND (c.valid_to IS NULL OR n.date < c.valid_to)
+            ) x;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """,
+        *_rollup_trigger_steps("user_goal_intervals", "trg_user_rollups_goals"),
+        # 旧テーブルへの書き込みは止めたのでトリガだけ外す（テーブル自体は確認後に手動で削除）
+        "DROP TRIGGER IF EXISTS rollups_insert ON user_goals_daily",
+        "DROP TRIGGER IF EXISTS rollups_update ON user_goals_daily",
+        "DROP TRIGGER IF EXISTS rollups_delete ON user_goals_daily",
+    ]),
+    Migration(7, "sync_runs", [
+        """
+        CREATE TABLE IF NOT EXISTS sync_runs (
+            id          BIGSERIAL PRIMARY KEY,
+            job         VARCHAR(64) NOT NULL,
+            started_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ,
+            duration_ms INTEGER,
+            status      VARCHAR(16) NOT NULL DEFAULT 'running',
+            stats       JSONB
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_sync_runs_job_started ON sync_runs (job, started_at DESC)",
+    ]),
+    Migration(8, "user_sync_watermarks", [
+        """
+        CREATE TABLE IF NOT EXISTS user_sync_watermarks (
+            user_id        VARCHAR(64) NOT NULL,
+            kind           VARCHAR(16) NOT NULL,
+            synced_through DATE        NOT NULL,
+            last_synced_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_status    VARCHAR(16) NOT NULL DEFAULT 'ok',
+            last_error     TEXT,
+            PRIMARY KEY (user_id, kind)
+        )
+        """,
+    ]),
+    Migration(9, "rate_limit_buckets", [
+        """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            name       VARCHAR(64)      PRIMARY KEY,
+            tokens     DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ      NOT NULL
+        )
+        """,
+    ]),
+    Migration(10, "line_outbox", [
+        """
+        CREATE TABLE IF NOT EXISTS line_outbox (
+            id              BIGSERIAL    PRIMARY KEY,
+            to_user_id      VARCHAR(64)  NOT NULL,
+            messages        JSONB        NOT NULL,
+            retry_key       VARCHAR(36)  NOT NULL UNIQUE,
+            request_id      INTEGER,
+            status          VARCHAR(16)  NOT NULL DEFAULT 'pending',
+            attempts        INTEGER      NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ  NOT NULL DEFAULT now(),
+            locked_until    TIMESTAMPTZ,
+            last_error      TEXT,
+            created_at      TIMESTAMPTZ  NOT NULL DEFAULT now(),
+            sent_at         TIMESTAMPTZ
+        )
+        """,
+        # ディスパッチャが見るのは未送信だけ（送信済みは部分インデックスから外れる）
+        """
+        CREATE INDEX IF NOT EXISTS ix_line_outbox_due
+            ON line_outbox (next_attempt_at, id)
+            WHERE status IN ('pending', 'sending')
+        """,
+    ]),
+    Migration(11, "line_outbox_multicast", [
+        "ALTER TABLE line_outbox ADD COLUMN IF NOT EXISTS to_user_ids TEXT[]",
+        "ALTER TABLE line_outbox ADD COLUMN IF NOT EXISTS request_ids INTEGER[]",
+        "ALTER TABLE line_outbox ALTER COLUMN to_user_id DROP NOT NULL",
+    ]),
+]
+
+
+# =========================
+# 実行
+# =========================
+def _ensure_history_table(conn) -> None:
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version     INTEGER PRIMARY KEY,
+            name        TEXT NOT NULL,
+            applied_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+            duration_ms INTEGER
+        )
+    """))
+
+
+def applied_versions() -> List[int]:
+    with get_engine().begin() as conn:
+        _ensure_history_table(conn)
+        return [r[0] for r in conn.execute(text("SELECT version FROM schema_migrations ORDER BY version"))]
+
+
+def migration_status() -> List[dict]:
+    done = set(applied_versions())
+    return [{"version": m.version, "name": m.name, "applied": m.version in done} for m in MIGRATIONS]
+
+
+def _run_steps(conn, m: Migration, concurrently: bool) -> None:
+    for step in m.steps:
+        if callable(step):
+            step(conn, concurrently)
+        elif "{concurrently}" in step:
+            conn.execute(text(step.format(concurrently="CONCURRENTLY" if concurrently else "")))
+        else:
+            conn.execute(text(step))
+
+
+def apply_migrations(target: Optional[int] = None, concurrently: bool = True) -> List[int]:
+    """
+    未適用のマイグレーションを順に適用し、適用した version のリストを返す。
+    concurrently=False ならインデックス作成をロック付き（高速・テーブルはブロック）で行う。
+    """
+    engine = get_engine()
+    applied: List[int] = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+        try:
+            _ensure_history_table(lock_conn)
+            done = {r[0] for r in lock_conn.execute(text("SELECT version FROM schema_migrations"))}
+            for m in sorted(MIGRATIONS, key=lambda x: x.version):
+                if m.version in done or (target is not None and m.version > target):
+                    continue
+                started = time.perf_counter()
+                logger.info("migration start", extra={"version": m.version, "migration": m.name})
+                if m.transactional:
+                    with engine.begin() as conn:
+                        _run_steps(conn, m, concurrently=False)
+                        _record(conn, m, started)
+                else:
+                    _run_steps(lock_conn, m, concurrently=concurrently)
+                    _record(lock_conn, m, started)
+                applied.append(m.version)
+                logger.info("migration done", extra={"version": m.version, "migration": m.name})
+            # 先の月のパーティションを補充（冪等）
+            ensure_request_partitions()
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+    return applied
+
+
+def _record(conn, m: Migration, started: float) -> None:
+    conn.execute(
+        text("INSERT INTO schema_migrations (version, name, duration_ms) VALUES (:v, :n, :d)"),
+        {"v": m.version, "n": m.name, "d": int((time.perf_counter() - started) * 1000)},
+    )
@@ -0,0 +1,53 @@
+# utils/pagination.py
+"""
+キーセット（カーソル）ページング用のカーソル変換。
+カーソルは「最後に返した行の並び替えキー」を JSON→base64url にした不透明な文字列。
+"""
+import base64
+import json
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+class InvalidCursor(ValueError):
+    """カーソル文字列が壊れている / 想定キーが無い"""
+    pass
+
+
+def encode_cursor(values: Dict[str, Any]) -> str:
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(
+    token: Optional[str],
+    keys: Sequence[str],
+    types: Optional[Dict[str, Callable[[Any], Any]]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    空なら None。keys が揃っていなければ InvalidCursor。
+    types（例: {"timestamp": datetime.fromisoformat, "id": int}）を渡すとその型に変換し、変換できなければ InvalidCursor
+    （クエリに渡す前に検証して 400 にするため）。
+    """
+    if not token:
+        return None
+    try:
+        pad = "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(token + pad).decode("utf-8"))
+    except Exception as e:
+        raise InvalidCursor(f"invalid cursor: {e}")
+    if not isinstance(values, dict) or any(k not in values for k in keys):
+        raise InvalidCursor("invalid cursor: missing keys")
+    for k, conv in (types or {}).items():
+        try:
+            values[k] = conv(values[k])
+        except (TypeError, ValueError, OverflowError) as e:
+            raise InvalidCursor(f"invalid cursor: {k}: {e}")
+    return values
+
+
+def next_cursor(rows: List[Dict[str, Any]], limit: int, keys: Sequence[str]) -> Optional[str]:
+    """1ページ分埋まっていれば最終行のキーでカーソルを作る（足りなければ最終ページ）"""
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor({k: last.get(k) for k in keys})
@@ -0,0 +1,120 @@
+# utils/pg_events.py
+"""
+requests の変更通知（pg_notify）をプロセス内の購読者へ配る。
+- プロセスごとに LISTEN 専用接続を1本だけ張り、受信スレッドがキューへファンアウトする
+- 行データ（ユーザー名込み）は受信スレッドで1回だけ取得し、全購読者で共有する
+- SSE エンドポイント（/events/requests）から subscribe() して使う
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from utils.db import REQUEST_EVENTS_CHANNEL, get_engine, get_request_row
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_MAX = 100
+
+
+class RequestEventHub:
+    def __init__(self, channel: str = REQUEST_EVENTS_CHANNEL):
+        self.channel = channel
+        self._subs: Set["queue.Queue[Dict]"] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- 購読 ----
+    def subscribe(self) -> "queue.Queue[Dict]":
+        q: "queue.Queue[Dict]" = queue.Queue(maxsize=SUBSCRIBER_QUEUE_MAX)
+        with self._lock:
+            self._subs.add(q)
+        self._ensure_started()
+        return q
+
+    def unsubscribe(self, q: "queue.Queue[Dict]") -> None:
+        with self._lock:
+            self._subs.discard(q)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+    # ---- 受信スレッド ----
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="pg-request-events", daemon=True)
+            self._thread.start()
+
+    def _connect(self):
+        # プールから切り離した専用接続（プールの枠を占有しない）
+        fairy = get_engine().raw_connection()
+        fairy.detach()
+        conn = getattr(fairy, "driver_connection", None) or fairy.connection
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                backoff = 1.0
+                logger.info("listening for request events", extra={"channel": self.channel})
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        self._dispatch(n.payload)
+            except Exception:
+                logger.exception("request event listener error; reconnecting", extra={"backoff_sec": backoff})
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _dispatch(self, payload: str) -> None:
+        if self.subscriber_count() == 0:
+            return
+        try:
+            ev = json.loads(payload)
+        except ValueError:
+            return
+        row = None
+        try:
+            row = get_request_row(int(ev.get("id")))
+        except Exception:
+            logger.exception("request event row fetch failed", extra={"request_db_id": ev.get("id")})
+        msg = {"event": ev.get("event"), "id": ev.get("id"), "status": ev.get("status"), "data": row}
+        with self._lock:
+            subs = list(self._subs)
+        for q in subs:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # 遅い購読者には resync を促す（古いイベントを捨てる）
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait({"event": "resync", "id": None, "status": None, "data": None})
+
+
+hub = RequestEventHub()
@@ -0,0 +1,177 @@
+# utils/range_planner.py
+"""
+Calomeal の期間取得（start_date〜end_date）の窓サイズを決める。
+- エンドポイントごとに「1日あたりの所要時間 / レスポンスサイズ」を EWMA で学習（utils.caromil が observe）
+- 窓 = 目標レイテンシ・目標サイズに収まる最大日数（RANGE_MIN_DAYS〜RANGE_MAX_DAYS）
+- タイムアウト / 5xx / 413 なら窓を半分に割って取り直し、以後の上限も半分に下げる（成功が続けば戻す）
+学習値はプロセス内だけ（再起動で RANGE_DEFAULT_DAYS から学び直す）。
+"""
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+RANGE_TARGET_LATENCY_SEC = float(os.getenv("RANGE_TARGET_LATENCY_SEC", "8"))   # timeout=30 に対して余裕を持たせる
+RANGE_TARGET_BYTES = int(os.getenv("RANGE_TARGET_BYTES", str(512 * 1024)))
+RANGE_MIN_DAYS = int(os.getenv("RANGE_MIN_DAYS", "1"))
+RANGE_MAX_DAYS = int(os.getenv("RANGE_MAX_DAYS", "31"))
+RANGE_DEFAULT_DAYS = int(os.getenv("RANGE_DEFAULT_DAYS", "7"))                  # 学習前（従来の CHUNK_DAYS）
+RANGE_EWMA_ALPHA = 0.3
+
+Window = Tuple[date, date]
+
+
+def window_days_of(a: date, b: date) -> int:
+    return (b - a).days + 1
+
+
+def is_splittable_error(exc: BaseException) -> bool:
+    """窓を小さくすれば通る見込みのあるエラーか（認証エラー等は割っても無駄なので False）"""
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    return status is not None and (status >= 500 or status == 413)
+
+
+@dataclass
+class _EndpointStats:
+    sec_per_day: Optional[float] = None
+    bytes_per_day: Optional[float] = None
+    ceiling: int = RANGE_MAX_DAYS        # 失敗で半減、成功で +1
+    samples: int = 0
+    failures: int = 0
+
+
+class RangePlanner:
+    def __init__(
+        self,
+        target_latency_sec: float = RANGE_TARGET_LATENCY_SEC,
+        target_bytes: int = RANGE_TARGET_BYTES,
+        min_days: int = RANGE_MIN_DAYS,
+        max_days: int = RANGE_MAX_DAYS,
+        default_days: int = RANGE_DEFAULT_DAYS,
+    ):
+        self.target_latency_sec = target_latency_sec
+        self.target_bytes = target_bytes
+        self.min_days = max(1, min_days)
+        self.max_days = max(self.min_days, max_days)
+        self.default_days = default_days
+        self._stats: Dict[str, _EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, endpoint: str) -> _EndpointStats:
+        st = self._stats.get(endpoint)
+        if st is None:
+            st = self._stats[endpoint] = _EndpointStats(ceiling=self.max_days)
+        return st
+
+    # -------------------------
+    # 学習
+    # -------------------------
+    def observe(self, endpoint: str, days: int, latency_sec: float, nbytes: int) -> None:
+        """成功した1呼び出しの実績（utils.caromil から呼ばれる）"""
+        days = max(1, days)
+        with self._lock:
+            st = self._get(endpoint)
+            spd, bpd = latency_sec / days, nbytes / days
+            if st.samples == 0:
+                st.sec_per_day, st.bytes_per_day = spd, bpd
+            else:
+                st.sec_per_day += RANGE_EWMA_ALPHA * (spd - st.sec_per_day)
+                st.bytes_per_day += RANGE_EWMA_ALPHA * (bpd - st.bytes_per_day)
+            st.samples += 1
+            if days >= st.ceiling:
+                st.ceiling = min(self.max_days, st.ceiling + 1)
+
+    def observe_failure(self, endpoint: str, days: int) -> None:
+        with self._lock:
+            st = self._get(endpoint)
+            st.failures += 1
+            st.ceiling = max(self.min_days, min(st.ceiling, days // 2))
+
+    # -------------------------
+    # 計画
+    # -------------------------
+    def _days_for(self, st: _EndpointStats) -> int:
+        if st.samples == 0:
+            days = min(self.default_days, st.ceiling)
+        else:
+            days = st.ceiling
+            if st.sec_per_day:
+                days = min(days, int(self.target_latency_sec / st.sec_per_day))
+            if st.bytes_per_day:
+                days = min(days, int(self.target_bytes / st.bytes_per_day))
+        return max(self.min_days, min(self.max_days, days))
+
+    def window_days(self, endpoint: str) -> int:
+        with self._lock:
+            return self._days_for(self._get(endpoint))
+
+    def plan(self, endpoint: str, start: date, end: date) -> List[Window]:
+        """[start, end] を現時点の窓サイズで分割する（並列実行向けに先に全部決める場合）"""
+        step = self.window_days(endpoint)
+        out: List[Window] = []
+        cur = start
+        while cur <= end:
+            b = min(cur + timedelta(days=step - 1), end)
+            out.append((cur, b))
+            cur = b + timedelta(days=1)
+        return out
+
+    def run(
+        self,
+        endpoint: str,
+        start: date,
+        end: date,
+        fetch: Callable[[date, date], Any],
+    ) -> Iterator[Tuple[date, date, Any, Optional[Exception]]]:
+        """
+        [start, end] を順に取得する。窓サイズは1回ごとに学習値から決め直す。
+        割れるエラーなら半分ずつ取り直し、割れない（または1日まで割った）エラーは (a, b, None, exc) で返して続行。
+        """
+        pending: List[Window] = []
+        cur = start
+        while pending or cur <= end:
+            if pending:
+                a, b = pending.pop()
+            else:
+                a = cur
+                b = min(cur + timedelta(days=self.window_days(endpoint) - 1), end)
+                cur = b + timedelta(days=1)
+            try:
+                result = fetch(a, b)
+            except Exception as e:
+                days = window_days_of(a, b)
+                if is_splittable_error(e) and days > self.min_days:
+                    self.observe_failure(endpoint, days)
+                    mid = a + timedelta(days=days // 2 - 1)
+                    logger.info("range split", extra={"endpoint": endpoint, "start": str(a), "end": str(b), "error": str(e)})
+                    pending.append((mid + timedelta(days=1), b))  # 前半から先に取る
+                    pending.append((a, mid))
+                    continue
+                yield a, b, None, e
+                continue
+            yield a, b, result, None
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                name: {
+                    "window_days": self._days_for(st),
+                    "sec_per_day": None if st.sec_per_day is None else round(st.sec_per_day, 4),
+                    "bytes_per_day": None if st.bytes_per_day is None else round(st.bytes_per_day),
+                    "ceiling": st.ceiling,
+                    "samples": st.samples,
+                    "failures": st.failures,
+                }
+                for name, st in self._stats.items()
+            }
+
+
+planner = RangePlanner()
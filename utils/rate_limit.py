@@ -0,0 +1,201 @@
+# utils/rate_limit.py
+"""
+外部API呼び出し用のトークンバケット。
+- TokenBucket … プロセス内・スレッドセーフ。rate_per_sec で補充、burst まで貯められる。acquire() は取れるまで待つ（timeout 付き）
+- PgTokenBucket … rate_limit_buckets テーブルで全ワーカー / 全インスタンス共通の1つのバケット
+- SharedRateLimiter … 上の2つを backend で切り替え＋優先度クラス＋待ち時間メトリクス
+優先度は contextvar（with rate_priority("interactive"): ...）。batch は残量 reserve を残して待つので、
+Webhook など interactive の呼び出しがバックフィルより先に通る。
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from utils.db import take_rate_limit_tokens
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# 既定は batch（スレッドプール等で contextvar が引き継がれない経路は低優先度で動く）
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("rate_priority", default=PRIORITY_BATCH)
+
+
+def set_priority(name: str) -> contextvars.Token:
+    if name not in PRIORITIES:
+        raise ValueError(f"unknown priority: {name}")
+    return _priority.set(name)
+
+
+def reset_priority(token: contextvars.Token) -> None:
+    _priority.reset(token)
+
+
+@contextmanager
+def rate_priority(name: str) -> Iterator[None]:
+    token = set_priority(name)
+    try:
+        yield
+    finally:
+        reset_priority(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+class RateLimitTimeout(RuntimeError):
+    """max_wait 以内にトークンが取れなかった"""
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, burst: Optional[float] = None):
+        if rate_per_sec <= 0:
+            raise ValueError("rate_per_sec must be > 0")
+        self.rate = float(rate_per_sec)
+        self.capacity = float(burst if burst is not None else max(1.0, rate_per_sec))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_sec = 0.0  # 累計待ち時間（統計用）
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens: float = 1.0, reserve: float = 0.0) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens + reserve:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None, reserve: float = 0.0) -> bool:
+        """
+        取れたら True。timeout 秒以内に取れなければ False。
+        reserve > 0 なら残量が reserve を割らない時だけ取る（低優先度の呼び出し用）。
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens + reserve:
+                    self._tokens -= tokens
+                    self.waited_sec += now - start
+                    return True
+                wait = (tokens + reserve - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class PgTokenBucket:
+    """
+    rate_limit_buckets の1行を全プロセスで共有するトークンバケット。
+    取れない時は DB が返す概算待ち時間（最大 poll_sec）だけ眠って取り直す（他プロセスとの取り合いに備えジッタ付き）。
+    """
+
+    def __init__(self, name: str, rate_per_sec: float, burst: Optional[float] = None, poll_sec: float = 1.0):
+        if rate_per_sec <= 0:
+            raise ValueError("rate_per_sec must be > 0")
+        self.name = name
+        self.rate = float(rate_per_sec)
+        self.capacity = float(burst if burst is not None else max(1.0, rate_per_sec))
+        self.poll_sec = poll_sec
+        self.waited_sec = 0.0
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None, reserve: float = 0.0) -> bool:
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            wait = take_rate_limit_tokens(self.name, self.rate, self.capacity, tokens, reserve)
+            now = time.monotonic()
+            if wait <= 0:
+                self.waited_sec += now - start
+                return True
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(min(wait, self.poll_sec) + random.uniform(0, 0.05))
+
+
+class SharedRateLimiter:
+    """
+    外部API1つ分のリミッタ。backend="postgres" なら全ワーカー共通（DB に繋がらない時はプロセス内にフォールバック）、
+    backend="local" ならプロセス内だけ。優先度ごとに reserve（残しておく量）と max_wait（待つ上限）を持つ。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate_per_sec: float,
+        burst: float,
+        backend: str = "postgres",
+        reserves: Optional[Dict[str, float]] = None,
+        max_wait: Optional[Dict[str, Optional[float]]] = None,
+    ):
+        self.name = name
+        self.backend = backend
+        self.local = TokenBucket(rate_per_sec, burst=burst)
+        self.pg = PgTokenBucket(name, rate_per_sec, burst=burst) if backend == "postgres" else None
+        self.reserves = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BATCH: 0.0, **(reserves or {})}
+        self.max_wait = {PRIORITY_INTERACTIVE: None, PRIORITY_BATCH: None, **(max_wait or {})}
+        self._lock = threading.Lock()
+        self._stats = {p: {"calls": 0, "timeouts": 0, "waited_sec": 0.0, "max_wait_sec": 0.0} for p in PRIORITIES}
+        self._fallbacks = 0
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """現在の優先度でトークンを取る。max_wait 以内に取れなければ RateLimitTimeout"""
+        prio = current_priority()
+        reserve, timeout = self.reserves[prio], self.max_wait[prio]
+        t0 = time.monotonic()
+        ok = False
+        if self.pg is not None:
+            try:
+                ok = self.pg.acquire(tokens, timeout=timeout, reserve=reserve)
+            except Exception as e:
+                # DB 障害で外部API呼び出しまで止めない（このプロセス内だけで絞る）
+                with self._lock:
+                    self._fallbacks += 1
+                logger.warning("rate limiter fallback to local", extra={"limiter": self.name, "error": str(e)})
+                remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - t0))
+                ok = self.local.acquire(tokens, timeout=remaining, reserve=reserve)
+        else:
+            ok = self.local.acquire(tokens, timeout=timeout, reserve=reserve)
+
+        waited = time.monotonic() - t0
+        with self._lock:
+            st = self._stats[prio]
+            st["calls"] += 1
+            st["waited_sec"] += waited
+            st["max_wait_sec"] = max(st["max_wait_sec"], waited)
+            if not ok:
+                st["timeouts"] += 1
+        if not ok:
+            raise RateLimitTimeout(f"{self.name}: no token within {timeout}s ({prio})")
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "backend": self.backend,
+                "rate_per_sec": self.local.rate,
+                "burst": self.local.capacity,
+                "reserves": dict(self.reserves),
+                "fallbacks": self._fallbacks,
+                "priorities": {
+                    p: {
+                        **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in st.items()},
+                        "avg_wait_sec": round(st["waited_sec"] / st["calls"], 3) if st["calls"] else 0.0,
+                    }
+                    for p, st in self._stats.items()
+                },
+            }
@@ -0,0 +1,193 @@
+# utils/response_utils.py
+"""
+期間系APIのレスポンス形式と圧縮。
+- ?format=columnar … 日ごとの dict の配列を「列ごとの配列」に変換（キー名の繰り返しを無くす）
+- ?format=msgpack または Accept: application/msgpack … MessagePack で返す（msgpack 未導入時は JSON）
+- OrjsonProvider … orjson があれば Flask の JSON シリアライザを置き換える（無ければ標準のまま）
+- gzip_response … 一定サイズ以上の JSON / MessagePack を gzip 圧縮（after_request で使用）
+- stream_rows_response … ?stream=1 用。行イテレータを JSON 配列として少しずつ送る（メモリ一定）
+"""
+import gzip
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+
+from flask import current_app, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 任意依存
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - 任意依存
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1400"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+_COMPRESSIBLE = {"application/json", MSGPACK_MIMETYPE}
+
+
+def _default(o: Any):
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# =========================
+# JSON プロバイダ（orjson）
+# =========================
+class OrjsonProvider(DefaultJSONProvider):
+    """dumps/loads だけ orjson に差し替える。日本語はそのまま UTF-8 で出力"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def install_json_provider(app) -> None:
+    if orjson is not None and os.getenv("JSON_PROVIDER", "orjson").lower() == "orjson":
+        app.json = OrjsonProvider(app)
+
+
+# =========================
+# 列指向（columnar）変換
+# =========================
+def wants_columnar() -> bool:
+    return (request.args.get("format") or "").strip().lower() == "columnar"
+
+
+def wants_msgpack() -> bool:
+    if msgpack is None:
+        return False
+    if (request.args.get("format") or "").strip().lower() == "msgpack":
+        return True
+    # Accept: */* では JSON のまま。明示的に msgpack の方が高い時だけ切り替える
+    accept = request.accept_mimetypes
+    return accept[MSGPACK_MIMETYPE] > accept["application/json"]
+
+
+def response_variant() -> str:
+    """ETag に混ぜる表現の識別子（同じデータでも形式が違えば別の ETag にする）"""
+    if wants_stream():
+        return "stream+json"
+    return f"{'columnar' if wants_columnar() else 'rows'}+{'msgpack' if wants_msgpack() else 'json'}"
+
+
+def to_columnar(rows: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """
+    [{"date": "2024-01-01", "kcal": 1800}, ...] → {"date": [...], "kcal": [...]}
+    列順は最初の行に合わせる（欠けているキーは None）。
+    """
+    if not rows:
+        return {}
+    keys = list(rows[0].keys())
+    for r in rows[1:]:
+        for k in r.keys():
+            if k not in keys:
+                keys.append(k)
+    return {k: [r.get(k) for r in rows] for k in keys}
+
+
+def shape_rows(rows: List[Dict[str, Any]]):
+    """?format=columnar なら列指向へ、それ以外はそのまま"""
+    return to_columnar(rows) if wants_columnar() else rows
+
+
+def shape_grouped(groups: Dict[str, List[Dict[str, Any]]]):
+    """{user_id: rows} の各 rows に shape_rows を適用"""
+    if not wants_columnar():
+        return groups
+    return {k: to_columnar(v) for k, v in groups.items()}
+
+
+# =========================
+# レスポンス生成
+# =========================
+def payload_response(body: Dict[str, Any], status: int = 200):
+    """MessagePack 希望なら msgpack、それ以外は app.json（orjson / 標準）で返す"""
+    if wants_msgpack():
+        data = msgpack.packb(body, default=_default, use_bin_type=True)
+        resp = current_app.response_class(data, status=status, mimetype=MSGPACK_MIMETYPE)
+    else:
+        resp = current_app.json.response(body)
+        resp.status_code = status
+    resp.vary.add("Accept")
+    return resp
+
+
+def gzip_response(resp):
+    """
+    after_request 用。Accept-Encoding: gzip かつ GZIP_MIN_BYTES 以上の JSON / MessagePack だけ圧縮する。
+    圧縮後の ETag は弱い ETag にする（表現が変わるため）。
+    """
+    if (
+        resp.direct_passthrough
+        or resp.is_streamed
+        or resp.status_code != 200
+        or "Content-Encoding" in resp.headers
+        or resp.mimetype not in _COMPRESSIBLE
+        or "gzip" not in (request.headers.get("Accept-Encoding") or "").lower()
+    ):
+        return resp
+    data = resp.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return resp
+    resp.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# =========================
+# ストリーミング（?stream=1）
+# =========================
+STREAM_CHUNK_ROWS = 200
+
+
+def wants_stream() -> bool:
+    return (request.args.get("stream") or "").strip().lower() in ("1", "true")
+
+
+def stream_rows_response(rows: Iterable[Dict[str, Any]], envelope: Optional[Dict[str, Any]] = None):
+    """
+    {"...envelope..., "data": [row, row, ...]} を STREAM_CHUNK_ROWS 行ずつ書き出す。
+    列指向・MessagePack・gzip には対応しない（常に行形式の JSON）。
+    """
+    dumps = current_app.json.dumps
+    head = dumps(envelope or {})[:-1]
+    head = head + (', "data": [' if head != "{" else '"data": [')
+
+    def generate():
+        yield head
+        buf: List[str] = []
+        first = True
+        for row in rows:
+            buf.append(("" if first else ",") + dumps(row))
+            first = False
+            if len(buf) >= STREAM_CHUNK_ROWS:
+                yield "".join(buf)
+                buf = []
+        if buf:
+            yield "".join(buf)
+        yield "]}"
+
+    return current_app.response_class(stream_with_context(generate()), mimetype="application/json")